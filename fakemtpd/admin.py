@@ -0,0 +1,62 @@
+import logging
+import os
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+from fakemtpd import query
+from fakemtpd.metrics import Metrics
+
+log = logging.getLogger("admin")
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(Metrics.instance().render())
+
+
+class AdminServer(object):
+    """Small HTTP listener, separate from the SMTP port, serving the
+    daemon's introspection endpoints from its IOLoop. Given envelopes (a
+    fakemtpd.query.EnvelopeIndex), it serves the query API as well."""
+
+    def __init__(self, io_loop, envelopes=None, capture=None):
+        self.io_loop = io_loop
+        self.handlers = [
+            (r'/metrics', MetricsHandler),
+        ]
+        if envelopes is not None:
+            self.handlers.extend(query.handlers(envelopes, capture))
+        self.http_server = None
+        self.unix_sockets = []
+
+    def _server(self):
+        if self.http_server is None:
+            application = tornado.web.Application(self.handlers)
+            self.http_server = tornado.httpserver.HTTPServer(application, io_loop=self.io_loop)
+        return self.http_server
+
+    def listen(self, port, address=''):
+        self._server().listen(port, address)
+        log.info("Admin HTTP server listening on [%s]:%d", address, port)
+
+    def listen_unix(self, path):
+        """Listen on a unix socket at path (which only the owner can use)"""
+        self._server().add_socket(tornado.netutil.bind_unix_socket(path))
+        self.unix_sockets.append((path, os.stat(path).st_ino))
+        log.info("Admin HTTP server listening on %s", path)
+
+    def stop(self):
+        if self.http_server:
+            self.http_server.stop()
+        # Only remove sockets which are still ours: after a handoff, the new
+        # process may already have put its own in their place
+        for path, inode in self.unix_sockets:
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.unlink(path)
+            except OSError:
+                pass
+        self.unix_sockets = []
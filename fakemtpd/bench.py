@@ -0,0 +1,433 @@
+"""Load generator and benchmark suite for fakemtpd.
+
+Opens lots of concurrent client sessions against an SMTP server (either
+one that is already running or one spawned for the run) and plays a
+scripted command mix over each of them, then reports throughput, latency
+percentiles and the server's memory use."""
+
+import errno
+import json
+import logging
+import optparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import tornado.ioloop
+
+from fakemtpd.connection import Connection
+
+# Client scripts. Each step is a list of lines which are sent together
+# (pipelined if there is more than one); the next step starts once a reply
+# to every line in the step has arrived. The banner is always waited for
+# first, and every script ends in QUIT. STARTTLS upgrades the connection as
+# soon as its reply comes back.
+SCENARIOS = {
+    'banner': [],
+    'helo_mail_rcpt': [
+        ['HELO bench.example.com'],
+        ['MAIL FROM:<sender@bench.example.com>'],
+        ['RCPT TO:<rcpt@example.com>'],
+    ],
+    'starttls': [
+        ['EHLO bench.example.com'],
+        ['STARTTLS'],
+        ['EHLO bench.example.com'],
+        ['MAIL FROM:<sender@bench.example.com>'],
+    ],
+    'pipelined': [
+        ['EHLO bench.example.com'],
+        ['MAIL FROM:<sender@bench.example.com>', 'RCPT TO:<rcpt@example.com>', 'RSET'] * 4,
+        ['NOOP'] * 16,
+    ],
+    # Connect/banner/QUIT churn, while a fixed set of resident sessions
+    # send NOOPs back to back; their latency shows how fairly the server
+    # splits its time between accepting and serving
+    'storm': [],
+}
+
+# Scenarios which also run resident sessions
+RESIDENT_SCENARIOS = ('storm',)
+
+# Lines fed over and over into an SMTPSession (which has already said
+# HELO) by the in-process 'dispatch' mode
+DISPATCH_LINES = [
+    'MAIL FROM:<sender@bench.example.com>\r\n',
+    'RCPT TO:<rcpt@example.com>\r\n',
+    'NOOP\r\n',
+    'MAIL FROM:<sender@bench.example.com>\r\n',
+    'RSET\r\n',
+]
+
+log = logging.getLogger("bench")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def process_tree_memory(pid):
+    """Return (rss, peak rss) in bytes of pid and all of its children, as
+    reported by /proc. Returns (None, None) where /proc isn't available."""
+    pids = set([pid])
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    # the comm field may contain spaces, but is in parens
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            if ppid == pid:
+                pids.add(int(entry))
+    except OSError:
+        return (None, None)
+    rss = peak = 0
+    for p in pids:
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        peak += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return (rss, peak)
+
+
+class BenchClient(object):
+    """One scripted client session"""
+
+    def __init__(self, bench, script):
+        self.bench = bench
+        self.script = script + [['QUIT']]
+        self.step = -1
+        self.pending = 1
+        self.conn = None
+        self.latencies = bench.latencies
+
+    def start(self):
+        self.started = time.time()
+        self.sock = socket.socket(self.bench.family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(self.bench.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._failed(os.strerror(err))
+            return
+        self.bench.io_loop.add_handler(self.sock.fileno(), self._connect_ready, self.bench.io_loop.WRITE | self.bench.io_loop.ERROR)
+
+    def _connect_ready(self, fd, events):
+        self.bench.io_loop.remove_handler(fd)
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._failed(os.strerror(err))
+            return
+        self.bench.connect_latencies.append(time.time() - self.started)
+        self.conn = Connection(self.bench.io_loop)
+        self.conn.on_data(self._handle_line)
+        self.conn.on_closed(self._closed)
+        self.sent_at = self.started
+        self.conn.connect(self.sock, self.bench.address)
+
+    def _handle_line(self, line):
+        if line[3:4] == '-':
+            return
+        self.pending -= 1
+        if self.pending:
+            return
+        now = time.time()
+        self.latencies.append(now - self.sent_at)
+        if line[:1] not in ('2', '3') and line[:3] != '554':
+            self.bench.unexpected += 1
+        if self.step >= 0 and self.script[self.step] == ['STARTTLS']:
+            self.conn.starttls(server_side=False)
+        self._next_step(now)
+
+    def _next_step(self, now):
+        self.step += 1
+        if self.step >= len(self.script):
+            self.conn.close()
+            return
+        lines = self.script[self.step]
+        self.pending = len(lines)
+        self.bench.commands += len(lines)
+        self.sent_at = now
+        self.conn.write(''.join(line + '\r\n' for line in lines))
+
+    def _closed(self):
+        if self.step < len(self.script):
+            self._failed('closed early')
+        else:
+            self.bench.session_done(self)
+
+    def _failed(self, reason):
+        self.bench.errors[reason] = self.bench.errors.get(reason, 0) + 1
+        if self.conn is None:
+            self.sock.close()
+        self.bench.session_done(self)
+
+
+class ResidentClient(BenchClient):
+    """A session which stays open for the whole run, sending one NOOP at a
+    time and timing each reply"""
+
+    def __init__(self, bench):
+        super(ResidentClient, self).__init__(bench, [['NOOP']])
+        self.latencies = bench.resident_latencies
+
+    def _next_step(self, now):
+        self.step = 0
+        self.pending = 1
+        self.sent_at = now
+        self.conn.write('NOOP\r\n')
+
+    def _closed(self):
+        if not self.bench.done:
+            self._failed('resident closed early')
+
+    def _failed(self, reason):
+        self.bench.errors[reason] = self.bench.errors.get(reason, 0) + 1
+        if self.conn is None:
+            self.sock.close()
+
+
+class Bench(object):
+    """Keep `concurrency` sessions running until `sessions` have completed,
+    plus `residents` long-lived sessions alongside them"""
+
+    def __init__(self, address, scenario, concurrency, sessions, family=socket.AF_INET, residents=0):
+        self.address = address
+        self.family = family
+        self.script = SCENARIOS[scenario]
+        self.concurrency = concurrency
+        self.sessions = sessions
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.started_sessions = 0
+        self.finished_sessions = 0
+        self.commands = 0
+        self.unexpected = 0
+        self.errors = {}
+        self.latencies = []
+        self.connect_latencies = []
+        self.resident_latencies = []
+        self.residents = [ResidentClient(self) for _ in range(residents)]
+        self.done = False
+
+    def _start_one(self):
+        BenchClient(self, self.script).start()
+
+    def session_done(self, client):
+        self.finished_sessions += 1
+        if self.started_sessions < self.sessions:
+            self.started_sessions += 1
+            # Don't recurse if connections are failing synchronously
+            self.io_loop.add_callback(self._start_one)
+        elif self.finished_sessions >= self.sessions:
+            self.done = True
+            self.io_loop.stop()
+
+    def run(self):
+        for resident in self.residents:
+            resident.start()
+        start = time.time()
+        for _ in range(min(self.concurrency, self.sessions)):
+            self.started_sessions += 1
+            self._start_one()
+        self.io_loop.start()
+        elapsed = time.time() - start
+        for resident in self.residents:
+            if resident.conn is not None:
+                resident.conn.close()
+        latencies = sorted(self.latencies)
+        connect_latencies = sorted(self.connect_latencies)
+        results = {
+            'sessions': self.finished_sessions,
+            'concurrency': self.concurrency,
+            'elapsed': elapsed,
+            'connections_per_sec': self.finished_sessions / elapsed,
+            'commands': self.commands,
+            'commands_per_sec': self.commands / elapsed,
+            'unexpected_replies': self.unexpected,
+            'errors': self.errors,
+            'latency': {
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'p999': percentile(latencies, 0.999),
+                'max': latencies[-1] if latencies else None,
+            },
+            'connect_latency': {
+                'p50': percentile(connect_latencies, 0.5),
+                'p99': percentile(connect_latencies, 0.99),
+                'p999': percentile(connect_latencies, 0.999),
+            },
+        }
+        if self.residents:
+            resident_latencies = sorted(self.resident_latencies)
+            results['residents'] = len(self.residents)
+            results['resident_commands'] = len(resident_latencies)
+            results['resident_latency'] = {
+                'p50': percentile(resident_latencies, 0.5),
+                'p99': percentile(resident_latencies, 0.99),
+                'p999': percentile(resident_latencies, 0.999),
+                'max': resident_latencies[-1] if resident_latencies else None,
+            }
+        return results
+
+
+def run_dispatch(commands):
+    """Feed command lines straight into an SMTPSession over a connection
+    that discards its output, to measure the cost of command handling alone"""
+    from fakemtpd.smtpsession import SMTPSession, SMTP_HELO
+
+    class NullConnection(Connection):
+        def write(self, data, callback=None, st=True):
+            if callback:
+                callback()
+
+        def pause_reading(self):
+            pass
+
+        def close(self):
+            pass
+
+    conn = NullConnection(None)
+    conn.address = ('127.0.0.1', 0)
+    session = SMTPSession(conn)
+    session._connect()
+    session._state = SMTP_HELO
+    lines = DISPATCH_LINES
+    num_lines = len(lines)
+    start = time.time()
+    for i in xrange(commands):
+        conn._signal_data(lines[i % num_lines])
+    elapsed = time.time() - start
+    return {
+        'commands': commands,
+        'elapsed': elapsed,
+        'commands_per_sec': commands / elapsed,
+    }
+
+
+def spawn_server(opts):
+    """Start a fakemtpd on a free local port; returns (process, address)"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    args = [sys.executable, '-c', 'import fakemtpd.server; fakemtpd.server.SMTPD().run()',
+            '--bind', '127.0.0.1', '--port', str(port), '--hostname', 'bench']
+    if opts.config_path:
+        args += ['--config-path', opts.config_path]
+    if opts.tls_cert:
+        args += ['--tls-cert', opts.tls_cert, '--tls-key', opts.tls_key]
+    if opts.workers:
+        args += ['--workers', str(opts.workers)]
+    if opts.accept_batch:
+        args += ['--accept-batch', str(opts.accept_batch)]
+    if opts.listen_backlog:
+        args += ['--listen-backlog', str(opts.listen_backlog)]
+    process = subprocess.Popen(args)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return (process, ('127.0.0.1', port))
+        except socket.error:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise SystemExit('spawned server did not come up')
+
+
+def format_report(name, results):
+    lines = ['scenario: %s' % name]
+    for key in ('sessions', 'concurrency', 'commands', 'residents', 'resident_commands', 'unexpected_replies'):
+        if key in results:
+            lines.append('  %-20s %d' % (key, results[key]))
+    for key in ('connections_per_sec', 'commands_per_sec', 'elapsed'):
+        if key in results:
+            lines.append('  %-20s %.1f' % (key, results[key]))
+    for key in ('latency', 'connect_latency', 'resident_latency'):
+        if results.get(key):
+            lines.append('  %-20s %s' % (key, ' '.join(
+                '%s=%.2fms' % (p, v * 1000) for p, v in sorted(results[key].items()) if v is not None)))
+    if results.get('errors'):
+        lines.append('  %-20s %s' % ('errors', results['errors']))
+    for key in ('server_rss', 'server_peak_rss'):
+        if results.get(key) is not None:
+            lines.append('  %-20s %.1fMB' % (key, results[key] / 1048576.0))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]', description=(
+        'Scenarios: %s, and dispatch (in-process, no server). Runs all of them by default.' % ', '.join(sorted(SCENARIOS))))
+    parser.add_option('-H', '--host', default='127.0.0.1', help='Server to benchmark (default %default)')
+    parser.add_option('-p', '--port', type=int, default=25, help='Port of the server to benchmark (default %default)')
+    parser.add_option('--spawn', action='store_true', default=False,
+                      help='Start a fakemtpd on a free local port and benchmark that instead')
+    parser.add_option('-c', '--config-path', default=None, help='Config file for the spawned server')
+    parser.add_option('--tls-cert', default=None, help='Certificate for the spawned server (needed for starttls)')
+    parser.add_option('--tls-key', default=None, help='Key for the spawned server (needed for starttls)')
+    parser.add_option('-w', '--workers', type=int, default=None, help='Worker processes for the spawned server')
+    parser.add_option('--accept-batch', type=int, default=None, help='accept_batch for the spawned server')
+    parser.add_option('--listen-backlog', type=int, default=None, help='listen_backlog for the spawned server')
+    parser.add_option('--server-pid', type=int, default=None, help='Report the memory use of this (already running) server')
+    parser.add_option('-C', '--concurrency', type=int, default=1000, help='Concurrent sessions (default %default)')
+    parser.add_option('--residents', type=int, default=50,
+                      help='Long-lived sessions to keep busy during the storm scenario (default %default)')
+    parser.add_option('-n', '--sessions', type=int, default=10000, help='Sessions per scenario (default %default)')
+    parser.add_option('--dispatch-commands', type=int, default=500000,
+                      help='Commands to run through the dispatch scenario (default %default)')
+    parser.add_option('--json', action='store_true', default=False, help='Write results as JSON to stdout')
+    parser.add_option('-o', '--output', default=None, help='Also write JSON results to this file')
+    (opts, args) = parser.parse_args()
+    scenarios = args or sorted(SCENARIOS) + ['dispatch']
+    for scenario in scenarios:
+        if scenario not in SCENARIOS and scenario != 'dispatch':
+            parser.error('unknown scenario %s' % scenario)
+    if 'starttls' in scenarios and opts.spawn and not opts.tls_cert:
+        if args:
+            parser.error('the starttls scenario needs --tls-cert and --tls-key')
+        scenarios.remove('starttls')
+    logging.basicConfig(stream=sys.stderr, level=logging.WARN)
+
+    process = None
+    server_pid = opts.server_pid
+    address = (opts.host, opts.port)
+    if opts.spawn and any(s != 'dispatch' for s in scenarios):
+        process, address = spawn_server(opts)
+        server_pid = process.pid
+    family = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)[0][0]
+
+    results = {'started': time.time(), 'scenarios': {}}
+    try:
+        for scenario in scenarios:
+            if scenario == 'dispatch':
+                result = run_dispatch(opts.dispatch_commands)
+            else:
+                residents = opts.residents if scenario in RESIDENT_SCENARIOS else 0
+                result = Bench(address, scenario, opts.concurrency, opts.sessions, family, residents).run()
+                if server_pid:
+                    result['server_rss'], result['server_peak_rss'] = process_tree_memory(server_pid)
+            results['scenarios'][scenario] = result
+            if not opts.json:
+                print format_report(scenario, result)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if opts.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,496 @@
+import Queue
+import array
+import bisect
+import collections
+import errno
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from fakemtpd.metrics import Metrics
+
+log = logging.getLogger("capture")
+metrics = Metrics.instance()
+
+# Every record is this header, then the envelope (the sender and the
+# recipients, separated by NULs), then the body
+_HEADER = struct.Struct('<4sBxxxQdIIQ')
+_MAGIC = 'FMC1'
+_FLAGS_OFFSET = 4
+_DELETED = 0x01
+
+# Segment number in the index for records which are gone
+_GONE = 0xFFFFFFFF
+
+CapturedMessage = collections.namedtuple('CapturedMessage', 'id timestamp session sender recipients body')
+
+
+def prepare_capture_dir(directory, uid=None, gid=None):
+    """Create the capture directory, owned by uid and gid (if given)"""
+    if not os.path.isdir(directory):
+        os.mkdir(directory, 0755)
+        if uid or gid:
+            os.chown(directory, uid if uid else -1, gid if gid else -1)
+
+
+class Segment(object):
+    """One segment file, mapped into memory and filled from the front"""
+
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self.capacity = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.capacity)
+        finally:
+            os.close(fd)
+        self.used = 0
+        self.live = 0
+        self.first_id = None
+        self.last_id = None
+        self.sealed = False
+        self.compacting = False
+
+    @classmethod
+    def create(cls, number, path, capacity):
+        """Create a new segment file of capacity bytes. It's filled with
+        zeros rather than left sparse, so that running out of disk space is
+        an IOError here instead of a SIGBUS when the map is written to."""
+        block = '\0' * 1048576
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for start in xrange(0, capacity, len(block)):
+                    f.write(block[:capacity - start])
+        except (IOError, OSError):
+            os.unlink(path)
+            raise
+        return cls(number, path)
+
+    def header(self, offset):
+        """(flags, id, timestamp, session, envelope length, body length) of
+        the record at offset, or None if there isn't one"""
+        if offset + _HEADER.size > self.capacity:
+            return None
+        fields = _HEADER.unpack_from(self.map, offset)
+        if fields[0] != _MAGIC:
+            return None
+        return fields[1:]
+
+    def scan(self):
+        """Yield (offset, length, flags, id, timestamp, session, envelope)
+        for every complete record, and leave used just past the last one"""
+        offset = 0
+        while True:
+            header = self.header(offset)
+            if header is None:
+                break
+            flags, record_id, timestamp, session, envelope_length, body_length = header
+            length = _HEADER.size + envelope_length + body_length
+            if offset + length > self.capacity:
+                break
+            start = offset + _HEADER.size
+            yield offset, length, flags, record_id, timestamp, session, self.map[start:start + envelope_length]
+            offset += length
+        self.used = offset
+
+    def seal(self):
+        """Write the segment out and give back its unused tail. Runs on the
+        compaction thread; nothing is appended to a sealed segment."""
+        self.map.flush()
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # Already dropped
+                return
+            raise
+        try:
+            os.ftruncate(fd, self.used)
+        finally:
+            os.close(fd)
+
+
+class CaptureStore(object):
+    """Captured SMTP transactions, kept in append-only segment files which
+    are memory-mapped.
+
+    Records are appended to the current segment until it fills up; then
+    it's sealed and the next one, which a background thread has already
+    created, takes over. Segments are only ever created on that thread: a
+    record which comes along while the next segment isn't ready yet, or
+    which is bigger than a segment, is not captured (see
+    metrics.capture_skipped). Each record is found through an
+    in-memory index of (segment, offset, timestamp) arrays by id, plus
+    sender and recipient to id maps, which is rebuilt from the segments'
+    headers on startup. Bodies are returned as buffer objects pointing
+    straight into the map.
+
+    Deleting a record only sets a flag in its header. Once less than
+    compact_ratio of a sealed segment is live, a background thread copies
+    what's left into a fresh file, which then replaces the segment. At most
+    max_segments segments are kept (0 for no limit); beyond that the oldest
+    is dropped.
+
+    Only the IOLoop thread may use the store. timestamps are expected to
+    (mostly) increase with ids, which find relies on to search by time."""
+
+    def __init__(self, directory, io_loop, prefix='capture', segment_size=67108864,
+                 max_segments=0, compact_ratio=0.5):
+        self.directory = directory
+        self.io_loop = io_loop
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.compact_ratio = compact_ratio
+        self._segments = {}
+        self._active = None
+        self._spare = None
+        self._preparing = False
+        self._next_segment = 1
+        self._first_id = 1
+        self._next_id = 1
+        self._count = 0
+        self._segment_of = array.array('L')
+        self._offset_of = array.array('L')
+        self._timestamps = array.array('d')
+        self._by_sender = {}
+        self._by_recipient = {}
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='capture')
+        self._thread.daemon = True
+        self._thread.start()
+        self._load()
+        self._prepare_spare()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        """Bytes used by all segments"""
+        return sum(segment.used for segment in self._segments.itervalues())
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s.%08d.seg' % (self.prefix, number))
+
+    def _load(self):
+        pattern = re.compile(r'^%s\.(\d+)\.seg(\.compact)?$' % re.escape(self.prefix))
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            if match.group(2) or not os.path.getsize(path):
+                # Left over from a compaction (or a segment) which never
+                # got finished
+                os.unlink(path)
+                continue
+            found.append((int(match.group(1)), path))
+        segments = []
+        for number, path in found:
+            segment = Segment(number, path)
+            header = segment.header(0)
+            if header is None:
+                # Never written to
+                os.unlink(path)
+            else:
+                segments.append((header[1], segment))
+            self._next_segment = max(self._next_segment, number + 1)
+        # Segment numbers are handed out ahead of time, so the order of
+        # the records is what counts
+        segments.sort()
+        for _, segment in segments:
+            segment.sealed = True
+            self._segments[segment.number] = segment
+            for offset, length, flags, record_id, timestamp, session, envelope in segment.scan():
+                self._next_id = max(self._next_id, record_id + 1)
+                if flags & _DELETED:
+                    continue
+                envelope = envelope.split('\0')
+                self._index(segment, record_id, offset, length, timestamp, envelope[0], envelope[1:])
+        if self._segments:
+            log.info("Loaded %d captured messages from %d segments", len(self), len(self._segments))
+        for segment in self._segments.values():
+            self._maybe_compact(segment)
+
+    def _index(self, segment, record_id, offset, length, timestamp, sender, recipients):
+        if not self._timestamps:
+            self._first_id = record_id
+        # Ids of records which were compacted away before a restart
+        while self._first_id + len(self._segment_of) < record_id:
+            self._segment_of.append(_GONE)
+            self._offset_of.append(0)
+            self._timestamps.append(timestamp)
+        self._segment_of.append(segment.number)
+        self._offset_of.append(offset)
+        self._timestamps.append(timestamp)
+        self._by_sender.setdefault(sender.lower(), array.array('L')).append(record_id)
+        for recipient in set(recipient.lower() for recipient in recipients):
+            self._by_recipient.setdefault(recipient, array.array('L')).append(record_id)
+        segment.live += length
+        self._count += 1
+        if segment.first_id is None:
+            segment.first_id = record_id
+        segment.last_id = record_id
+        self._next_id = max(self._next_id, record_id + 1)
+
+    def append(self, sender, recipients, body=None, session=0, timestamp=None):
+        """Capture one transaction. body may be a str or bytearray, or a
+        list of them. Returns the new record's id, or None if it was
+        skipped."""
+        if timestamp is None:
+            timestamp = time.time()
+        envelope = '\0'.join([sender] + list(recipients))
+        if body is None:
+            body = []
+        elif not isinstance(body, list):
+            body = [body]
+        body_length = sum(len(chunk) for chunk in body)
+        length = _HEADER.size + len(envelope) + body_length
+        if length > self.segment_size:
+            metrics.capture_skipped.inc('too_big')
+            return None
+        segment = self._active
+        if segment is None or segment.used + length > segment.capacity:
+            segment = self._rotate()
+            if segment is None:
+                metrics.capture_skipped.inc('no_segment')
+                return None
+        offset = segment.used
+        # The header goes in last, so a half-written record is never seen
+        segment.map.seek(offset + _HEADER.size)
+        segment.map.write(envelope)
+        for chunk in body:
+            segment.map.write(buffer(chunk))
+        record_id = self._next_id
+        _HEADER.pack_into(segment.map, offset, _MAGIC, 0, record_id, timestamp, session, len(envelope), body_length)
+        segment.used += length
+        self._index(segment, record_id, offset, length, timestamp, sender, recipients)
+        return record_id
+
+    def get(self, record_id):
+        """The CapturedMessage with the given id, or None"""
+        index = record_id - self._first_id
+        if index < 0 or index >= len(self._segment_of) or self._segment_of[index] == _GONE:
+            return None
+        segment = self._segments[self._segment_of[index]]
+        offset = self._offset_of[index]
+        flags, _, timestamp, session, envelope_length, body_length = segment.header(offset)
+        start = offset + _HEADER.size
+        envelope = segment.map[start:start + envelope_length].split('\0')
+        body = buffer(segment.map, start + envelope_length, body_length)
+        return CapturedMessage(record_id, timestamp, session, envelope[0], envelope[1:], body)
+
+    def find(self, sender=None, recipient=None, since=None, until=None, limit=None):
+        """Ids of the live records matching everything given, oldest first.
+        Addresses are compared case-insensitively; since and until are
+        timestamps (since inclusive, until exclusive)."""
+        if recipient is not None:
+            candidates = self._by_recipient.get(recipient.lower(), ())
+            if sender is not None:
+                senders = set(self._by_sender.get(sender.lower(), ()))
+                candidates = [record_id for record_id in candidates if record_id in senders]
+        elif sender is not None:
+            candidates = self._by_sender.get(sender.lower(), ())
+        else:
+            start = bisect.bisect_left(self._timestamps, since) if since is not None else 0
+            candidates = xrange(self._first_id + start, self._first_id + len(self._timestamps))
+        results = []
+        for record_id in candidates:
+            index = record_id - self._first_id
+            if index < 0 or self._segment_of[index] == _GONE:
+                continue
+            timestamp = self._timestamps[index]
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                continue
+            results.append(record_id)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def delete(self, record_id):
+        """Forget a record; returns whether there was one. Its space is
+        reclaimed when its segment is compacted."""
+        index = record_id - self._first_id
+        if index < 0 or index >= len(self._segment_of) or self._segment_of[index] == _GONE:
+            return False
+        segment = self._segments[self._segment_of[index]]
+        offset = self._offset_of[index]
+        self._mark_deleted(segment, offset)
+        self._segment_of[index] = _GONE
+        self._count -= 1
+        self._maybe_compact(segment)
+        return True
+
+    def _mark_deleted(self, segment, offset):
+        flags, _, _, _, envelope_length, body_length = segment.header(offset)
+        segment.map[offset + _FLAGS_OFFSET] = chr(flags | _DELETED)
+        segment.live -= _HEADER.size + envelope_length + body_length
+
+    def _rotate(self):
+        """Seal the current segment and switch to the spare one. Returns None
+        (leaving the current segment be) if the spare isn't ready yet."""
+        if self._spare is None:
+            self._prepare_spare()
+            return None
+        if self._active is not None:
+            self._active.sealed = True
+            self._queue.put((self._active.seal, ()))
+            self._maybe_compact(self._active)
+        segment, self._spare = self._spare, None
+        self._segments[segment.number] = segment
+        self._active = segment
+        self._prepare_spare()
+        while self.max_segments and len(self._segments) > self.max_segments:
+            self._drop(min((s for s in self._segments.itervalues() if s is not segment),
+                           key=lambda s: s.first_id))
+        return segment
+
+    def _prepare_spare(self):
+        if self._spare is not None or self._preparing:
+            return
+        number = self._next_segment
+        self._next_segment += 1
+        self._preparing = True
+        self._queue.put((self._create_spare, (number,)))
+
+    def _create_spare(self, number):
+        """Runs on the compaction thread"""
+        try:
+            segment = Segment.create(number, self._path(number), self.segment_size)
+        except (IOError, OSError, mmap.error), e:
+            log.error("Could not create capture segment %s: %s", self._path(number), e)
+            segment = None
+        self.io_loop.add_callback(lambda: self._spare_ready(segment))
+
+    def _spare_ready(self, segment):
+        self._preparing = False
+        self._spare = segment
+
+    def _drop(self, segment):
+        """Throw away a whole segment, and everything in it"""
+        del self._segments[segment.number]
+        if segment.first_id is not None:
+            for record_id in xrange(segment.first_id, segment.last_id + 1):
+                index = record_id - self._first_id
+                if index >= 0 and self._segment_of[index] == segment.number:
+                    self._segment_of[index] = _GONE
+                    self._count -= 1
+        # Trim what's gone off the front of the index
+        gone = 0
+        while gone < len(self._segment_of) and self._segment_of[gone] == _GONE:
+            gone += 1
+        if gone:
+            del self._segment_of[:gone]
+            del self._offset_of[:gone]
+            del self._timestamps[:gone]
+            self._first_id += gone
+            self._prune_addresses()
+        # Outstanding bodies keep the map itself alive
+        os.unlink(segment.path)
+        log.info("Dropped capture segment %s", segment.path)
+
+    def _prune_addresses(self):
+        for by_address in (self._by_sender, self._by_recipient):
+            for address, ids in by_address.items():
+                if ids[-1] < self._first_id:
+                    del by_address[address]
+                elif ids[0] < self._first_id:
+                    by_address[address] = array.array('L', ids[bisect.bisect_left(ids, self._first_id):])
+
+    def _maybe_compact(self, segment):
+        if not segment.sealed or segment.compacting or not segment.used:
+            return
+        if segment.live >= segment.used * self.compact_ratio:
+            return
+        live = []
+        if segment.first_id is not None:
+            for record_id in xrange(segment.first_id, segment.last_id + 1):
+                index = record_id - self._first_id
+                if index >= 0 and self._segment_of[index] == segment.number:
+                    offset = self._offset_of[index]
+                    _, _, _, _, envelope_length, body_length = segment.header(offset)
+                    live.append((record_id, offset, _HEADER.size + envelope_length + body_length))
+        segment.compacting = True
+        self._queue.put((self._compact, (segment, live)))
+
+    def _compact(self, segment, live):
+        """Copy the live records of a sealed segment into a new file. Runs
+        on the compaction thread."""
+        path = segment.path + '.compact'
+        offsets = []
+        try:
+            with open(path, 'wb') as f:
+                position = 0
+                for _, offset, length in live:
+                    f.write(buffer(segment.map, offset, length))
+                    offsets.append(position)
+                    position += length
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError), e:
+            log.error("Could not compact %s: %s", segment.path, e)
+            path = None
+        self.io_loop.add_callback(lambda: self._compacted(segment, live, offsets, path))
+
+    def _compacted(self, segment, live, offsets, path):
+        segment.compacting = False
+        if path is None:
+            return
+        if self._segments.get(segment.number) is not segment:
+            # Dropped in the meantime
+            os.unlink(path)
+            return
+        if not live:
+            del self._segments[segment.number]
+            os.unlink(path)
+            os.unlink(segment.path)
+            log.info("Removed empty capture segment %s", segment.path)
+            return
+        os.rename(path, segment.path)
+        compacted = Segment(segment.number, segment.path)
+        compacted.sealed = True
+        compacted.used = compacted.capacity
+        compacted.first_id = segment.first_id
+        compacted.last_id = segment.last_id
+        for (record_id, _, length), offset in zip(live, offsets):
+            compacted.live += length
+            index = record_id - self._first_id
+            if index >= 0 and self._segment_of[index] == segment.number:
+                self._offset_of[index] = offset
+            else:
+                # Deleted while it was being copied
+                self._mark_deleted(compacted, offset)
+        self._segments[segment.number] = compacted
+        log.info("Compacted capture segment %s from %d to %d bytes", segment.path, segment.used, compacted.used)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Error in capture thread")
+
+    def close(self):
+        """Finish any compaction, and write out the current segment"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._active is not None:
+            self._active.seal()
+            self._active = None
+        if self._spare is not None:
+            os.unlink(self._spare.path)
+            self._spare = None
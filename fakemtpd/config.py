@@ -43,6 +43,10 @@ class Config(object):
     """Allowable SMTP versions"""
     smtp_versions = ('SMTP', 'ESMTP')
 
+    """Allowable listener address families and TLS modes"""
+    listener_families = ('inet', 'inet6')
+    listener_modes = ('plain', 'starttls', 'tls')
+
     """Known SSL versions.
     On Python 2.7.8+ with OpenSSL 1.0+, you want "ssl23" to get maximum security and compatibility.
 
@@ -64,20 +68,91 @@ class Config(object):
         'smtp_ver': 'SMTP',
         'tls_cert': None,
         'tls_key': None,
+        'tls_session_tickets': True,
         'timeout': 30,
         'daemonize': False,
         'pid_file': None,
         'log_file': None,
+        'log_queue_size': 0,
         'logging_method': 'stderr',
         'ssl_version': 'ssl23',
         'syslog_host': 'localhost',
         'syslog_port': 514,
         'syslog_domain_socket': None,
+        'workers': 1,
+        'admin_address': '127.0.0.1',
+        'admin_port': None,
+        'admin_socket': None,
+        'query_max_messages': 100000,
+        'query_max_age': 3600,
+        'listen_backlog': 128,
+        'accept_batch': 64,
+        'max_sessions': 0,
+        'profile_dir': None,
+        'profile_duration': 30,
+        'profile_interval': 0.005,
+        'timing_hooks': False,
+        'handoff_timeout': 30,
+        'drain_timeout': 300,
+        'max_loop_lag': 0,
+        'loop_lag_interval': 0.1,
+        'tcp_nodelay': True,
+        'tcp_defer_accept': 0,
+        'tcp_fastopen': 0,
+        'so_rcvbuf': None,
+        'so_sndbuf': None,
+        'listeners': None,
+        'txn_log': None,
+        'accept_mail': False,
+        'max_message_size': 10485760,
+        'spool_dir': None,
+        'spool_threads': 1,
+        'capture_dir': None,
+        'recipient_policy': None,
+        'greylist': False,
+        'greylist_delay': 300,
+        'greylist_retry_window': 86400,
+        'greylist_ttl': 3024000,
+        'greylist_by_network': True,
+        'greylist_max_entries': 1000000,
+        'greylist_file': None,
+        'greylist_snapshot_interval': 300,
+        'ip_connection_rate': 0,
+        'net_connection_rate': 0,
+        'ip_command_rate': 0,
+        'net_command_rate': 0,
+        'ip_max_sessions': 0,
+        'net_max_sessions': 0,
+        'rate_limit_burst': 10,
+        'rate_limit_tarpit': 0,
+        'rate_limit_max_entries': 100000,
+        'sender_policy': None,
+        'capture_segment_size': 67108864,
+        'capture_max_segments': 0,
+        'txn_log_flush_bytes': 65536,
+        'txn_log_flush_interval': 1,
     }
 
+    # Parameters which take effect as soon as a reloaded snapshot is swapped
+    # in (per-session ones for new sessions only). The rest are only looked
+    # at on startup, so changing them takes a restart.
+    reloadable = frozenset((
+        'hostname', 'mtd', 'smtp_ver', 'timeout', 'verbose',
+        'tls_cert', 'tls_key', 'ssl_version', 'tls_session_tickets',
+        'max_message_size', 'recipient_policy', 'sender_policy',
+        'max_sessions', 'accept_batch', 'tcp_nodelay',
+        'profile_dir', 'profile_duration', 'handoff_timeout', 'drain_timeout',
+    ))
+
     def __init__(self):
         """Initialize the object. You should always use instance()"""
         self._config = copy.copy(self._parameters)
+        self.opts = None
+        self.path = None
+        # Changes which reload() couldn't apply
+        self.deferred = []
+        # What merge_listeners() replaced
+        self._requested = {}
 
     @classmethod
     def instance(cls):
@@ -98,6 +173,8 @@ class Config(object):
 
     def read_file(self, path):
         """Merge in options from a YAML file."""
+        # Absolute, for reload(): daemonizing changes the working directory
+        self.path = os.path.abspath(path)
         with open(path) as f:
             return self.read_file_obj(f)
 
@@ -110,6 +187,37 @@ class Config(object):
                     self._config[key] = data[key]
         return self._validate()
 
+    def reload(self):
+        """Build a new snapshot from the command-line options and YAML file
+        this one was built from, and make it the instance. Returns an
+        error, if the new snapshot doesn't validate, and then nothing
+        changes. Objects holding on to this snapshot keep seeing it as it is.
+
+        Parameters which aren't reloadable keep their current values in the
+        new snapshot; the ones which were changed are listed in its deferred
+        attribute."""
+        config = self.__class__()
+        try:
+            error = config.merge_opts(self.opts) if self.opts is not None else None
+            if not error and self.path:
+                error = config.read_file(self.path)
+        except (IOError, yaml.YAMLError), e:
+            error = "Could not read %s: %s" % (self.path, e)
+        if error:
+            return error
+        for key in sorted(self._parameters):
+            if key in self.reloadable:
+                continue
+            if config._config[key] != self._requested.get(key, self._config[key]):
+                config.deferred.append(key)
+            config._config[key] = self._config[key]
+        config._requested = self._requested
+        error = config._validate()
+        if error:
+            return error
+        Config._instance = config
+        return None
+
     def write(self):
         """Writes the current config to stdout, as YAML"""
         print yaml.dump(self._config, default_flow_style=False),
@@ -119,6 +227,24 @@ class Config(object):
             return "PID file path must be absolute"
         if self._config['log_file'] and not os.path.isabs(self._config['log_file']):
             return "Log file path must be absolute"
+        if self._config['spool_dir'] and not os.path.isabs(self._config['spool_dir']):
+            return "Spool directory path must be absolute"
+        if not isinstance(self._config['max_message_size'], int) or self._config['max_message_size'] < 0:
+            return "max_message_size must be a non-negative integer (0 for no limit)"
+        if not isinstance(self._config['spool_threads'], int) or self._config['spool_threads'] < 1:
+            return "spool_threads must be a positive integer"
+        if self._config['capture_dir'] and not os.path.isabs(self._config['capture_dir']):
+            return "Capture directory path must be absolute"
+        if not isinstance(self._config['capture_segment_size'], int) or self._config['capture_segment_size'] < 1:
+            return "capture_segment_size must be a positive integer"
+        if not isinstance(self._config['capture_max_segments'], int) or self._config['capture_max_segments'] < 0:
+            return "capture_max_segments must be a non-negative integer (0 for no limit)"
+        if self._config['txn_log'] and not os.path.isabs(self._config['txn_log']):
+            return "Transaction log path must be absolute"
+        if not isinstance(self._config['txn_log_flush_bytes'], int) or self._config['txn_log_flush_bytes'] < 0:
+            return "txn_log_flush_bytes must be a non-negative integer"
+        if not isinstance(self._config['txn_log_flush_interval'], (int, float)) or self._config['txn_log_flush_interval'] <= 0:
+            return "txn_log_flush_interval must be a positive number of seconds"
         if self._config['smtp_ver'] not in ('SMTP', 'ESMTP'):
             return "smtp_ver must be in ('SMTP', 'ESMTP')"
         if self._config['logging_method'] not in self.logging_methods:
@@ -129,6 +255,47 @@ class Config(object):
             return "Allowed values for ssl_version are (%s), got '%s'" % (','.join(("'" + s + "'") for s in self.ssl_versions), self._config['ssl_version'])
         if self._config['tls_cert']:
             self._config['smtp_ver'] = 'ESMTP'
+        if not isinstance(self._config['workers'], int) or self._config['workers'] < 1:
+            return "workers must be a positive integer"
+        if self._config['admin_port'] is not None and not isinstance(self._config['admin_port'], int):
+            return "admin_port must be a port number"
+        for key in ('ip_connection_rate', 'net_connection_rate', 'ip_command_rate', 'net_command_rate',
+                    'rate_limit_burst', 'rate_limit_tarpit'):
+            if not isinstance(self._config[key], (int, float)) or self._config[key] < 0:
+                return "%s must be a non-negative number" % key
+        for key in ('greylist_delay', 'greylist_retry_window', 'greylist_ttl', 'greylist_max_entries', 'greylist_snapshot_interval'):
+            if not isinstance(self._config[key], int) or self._config[key] < 1:
+                return "%s must be a positive integer" % key
+        for key in ('ip_max_sessions', 'net_max_sessions'):
+            if not isinstance(self._config[key], int) or self._config[key] < 0:
+                return "%s must be a non-negative integer (0 for no limit)" % key
+        if not isinstance(self._config['rate_limit_max_entries'], int) or self._config['rate_limit_max_entries'] < 2:
+            return "rate_limit_max_entries must be an integer of at least 2"
+        for key in ('query_max_messages', 'query_max_age'):
+            if not isinstance(self._config[key], int) or self._config[key] < 0:
+                return "%s must be a non-negative integer (0 for no limit)" % key
+        for key in ('profile_duration', 'profile_interval', 'handoff_timeout', 'drain_timeout'):
+            if not isinstance(self._config[key], (int, float)) or self._config[key] <= 0:
+                return "%s must be a positive number of seconds" % key
+        if not isinstance(self._config['max_sessions'], int) or self._config['max_sessions'] < 0:
+            return "max_sessions must be a non-negative integer (0 for no limit)"
+        if not isinstance(self._config['max_loop_lag'], (int, float)) or self._config['max_loop_lag'] < 0:
+            return "max_loop_lag must be a non-negative number of seconds (0 for no limit)"
+        if not isinstance(self._config['loop_lag_interval'], (int, float)) or self._config['loop_lag_interval'] <= 0:
+            return "loop_lag_interval must be a positive number of seconds"
+        for key in ('listen_backlog', 'accept_batch'):
+            if not isinstance(self._config[key], int) or self._config[key] < 1:
+                return "%s must be a positive integer" % key
+        for key in ('tcp_defer_accept', 'tcp_fastopen', 'log_queue_size'):
+            if not isinstance(self._config[key], int) or self._config[key] < 0:
+                return "%s must be a non-negative integer" % key
+        for key in ('so_rcvbuf', 'so_sndbuf'):
+            if self._config[key] is not None and (not isinstance(self._config[key], int) or self._config[key] < 1):
+                return "%s must be a positive integer (in bytes)" % key
+        if self._config['listeners'] is not None:
+            error = self._validate_listeners(self._config['listeners'])
+            if error:
+                return error
         if bool(self._config['daemonize']) and not bool(self._config['pid_file']):
             return 'Cannot specify to daemonize without a pid-file, or vice versa'
         if self._config['logging_method'] == 'file':
@@ -140,9 +307,58 @@ class Config(object):
                     return "must specify both a syslog host and a port"
         return None
 
-    def merge_sock(self, sock):
-        self._config['port'] = int(sock.getsockname()[1])
-        self._config['address'] = sock.getsockname()[0]
+    def _validate_listeners(self, listeners):
+        if not isinstance(listeners, list) or not listeners:
+            return "listeners must be a non-empty list"
+        for listener in listeners:
+            if not isinstance(listener, dict):
+                return "each listener must be a mapping, got %r" % (listener,)
+            unknown = set(listener) - set(('family', 'address', 'port', 'mode'))
+            if unknown:
+                return "unknown listener keys: %s" % ','.join(sorted(unknown))
+            if not isinstance(listener.get('port'), int):
+                return "each listener needs a port"
+            if listener.get('family', 'inet') not in self.listener_families:
+                return "listener family must be in (%s)" % ','.join(self.listener_families)
+            if listener.get('mode', 'plain') not in self.listener_modes:
+                return "listener mode must be in (%s)" % ','.join(self.listener_modes)
+            if listener.get('mode', 'plain') != 'plain' and not self._config['tls_cert']:
+                return "listener on port %d needs tls_cert and tls_key for mode %s" % (listener['port'], listener['mode'])
+        return None
+
+    @property
+    def listener_specs(self):
+        """The listeners to bind, with every key filled in. Without a
+        listeners option, this is the single address/port listener (which
+        offers STARTTLS if there is a certificate)."""
+        if self._config['listeners'] is None:
+            listeners = [{'address': self._config['address'], 'port': self._config['port'],
+                          'mode': 'starttls' if self._config['tls_cert'] else 'plain'}]
+        else:
+            listeners = self._config['listeners']
+        specs = []
+        for listener in listeners:
+            address = listener.get('address')
+            family = listener.get('family') or ('inet6' if address and ':' in address else 'inet')
+            if address is None:
+                address = '::' if family == 'inet6' else '0.0.0.0'
+            specs.append({
+                'family': family,
+                'address': address,
+                'port': listener['port'],
+                'mode': listener.get('mode', 'plain'),
+            })
+        return specs
+
+    def merge_listeners(self, listeners):
+        """Record the actual addresses of bound Listeners (which matters
+        for port 0). address and port are set from the first one."""
+        specs = [listener.to_spec() for listener in listeners]
+        self._requested = dict((key, self._config[key]) for key in ('listeners', 'address', 'port'))
+        if self._config['listeners'] is not None:
+            self._config['listeners'] = specs
+        self._config['address'] = specs[0]['address']
+        self._config['port'] = specs[0]['port']
 
     @property
     def port(self):
@@ -1,38 +1,81 @@
 import errno
-import functools
 import logging
-import select
 import socket
-import sys
 import ssl
 import time
 
-import tornado.iostream
-
+from fakemtpd.metrics import Metrics
 from fakemtpd.signals import Signalable
 
 CLOSED = "closed"
 CONNECTED = "connected"
 
+# errnos which just mean "try again when the loop says the socket is ready"
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR)
+_SSL_WANT = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
 log = logging.getLogger("connection")
 
+metrics = Metrics.instance()
+
+
+def _would_block(e):
+    if isinstance(e, ssl.SSLError):
+        return e.args[0] in _SSL_WANT
+    return e.args[0] in _ERRNO_WOULDBLOCK
+
+
 class Connection(Signalable):
-    """Wrapper around tornado.iostream.IOStream"""
+    """Non-blocking line-oriented transport driven directly by the IOLoop.
+
+    The socket is registered with the loop once; reads are framed into lines
+    straight out of the receive buffer and each line is handed to the 'data'
+    signal (delimiter included) without bouncing through another loop
+    iteration. read_bytes switches to counting off a fixed number of bytes
+    instead, for payloads which aren't made of lines."""
     _signals = ["connected", "closed", "timeout", "data"]
 
-    def __init__(self, io_loop, timeout=-1):
+    # Largest chunk to pull off the socket per recv()
+    read_chunk_size = 4096
+
+    # If set, a line which grows longer than this is signalled in pieces
+    # (without a trailing newline) instead of being buffered up whole
+    max_line_length = None
+
+    # Size of the buffers read_bytes fills
+    read_bytes_chunk_size = 65536
+
+    def __init__(self, io_loop, timeout=-1, max_buffer_size=104857600, timer_wheel=None):
         super(Connection, self).__init__()
         self.io_loop = io_loop
         self.state = CLOSED
         self.timeout = timeout
+        self.timer_wheel = timer_wheel
+        self.deadline = None
+        self.max_buffer_size = max_buffer_size
         self._timeout_handle = None
+        self._read_buffer = ''
+        self._write_buffer = []
+        self._write_callbacks = []
+        self._reading = True
+        self._corked = False
+        self._handshaking = False
+        self._handshake_started = None
+        self._events = None
+        self._bytes_remaining = 0
+        self._bytes_buffer = None
+        self._bytes_view = None
+        self._bytes_filled = 0
+        self._bytes_chunk_callback = None
+        self._bytes_callback = None
 
     @staticmethod
     def _format_address(address):
-        if isinstance(address, tuple) and len(address) == 2:
+        # inet6 addresses are (host, port, flowinfo, scopeid)
+        if isinstance(address, tuple) and len(address) >= 2:
             return "[%s]:%d" % (address[0], address[1])
         else:
-            return "%s" % address
+            return "%s" % (address,)
 
     def connect(self, sock, address):
         log.info("Starting connection from %s", self._format_address(address))
@@ -40,29 +83,113 @@ class Connection(Signalable):
         self.address = address
         self.sock.setblocking(0)
         self.state = CONNECTED
-        self.stream = tornado.iostream.IOStream(self.sock, io_loop=self.io_loop)
-        self.stream.set_close_callback(self.close)
+        self._events = self.io_loop.READ | self.io_loop.ERROR
+        self.io_loop.add_handler(self.sock.fileno(), self._handle_events, self._events)
         self.on_timeout(self._timeout, first=True)
         self._set_timeout()
         self._signal_connected()
-        self._read()
 
-    def starttls(self, **ssl_options):
+    def starttls(self, server_side=True, ssl_context=None, **ssl_options):
+        """Start a TLS handshake, either from ssl_context (an
+        ssl.SSLContext) or from ssl.wrap_socket options"""
         assert self.state == CONNECTED
         log.debug("starting TLS session")
-        self.sock = ssl.wrap_socket(self.sock, server_side=True,
-                do_handshake_on_connect=False,
-                **ssl_options)
-        self.io_loop.remove_handler(self.sock.fileno())
-        self.stream = tornado.iostream.SSLIOStream(self.sock, io_loop = self.io_loop)
-        self.stream.set_close_callback(self.close)
-        self._read()
+        if ssl_context is not None:
+            self.sock = ssl_context.wrap_socket(self.sock, server_side=server_side,
+                                                do_handshake_on_connect=False)
+        else:
+            self.sock = ssl.wrap_socket(self.sock, server_side=server_side,
+                                        do_handshake_on_connect=False,
+                                        **ssl_options)
+        self._handshake_started = time.time()
+        # Anything the client pipelined after STARTTLS was sent in the clear
+        # and must not be interpreted once the session is encrypted
+        self._read_buffer = ''
+        self._reading = True
+        self._handshaking = True
+        self._do_handshake()
+
+    def read_bytes(self, num_bytes, chunk_callback, callback):
+        """Read exactly num_bytes, then go back to reading lines.
+
+        The bytes are received straight into preallocated bytearrays of up
+        to read_bytes_chunk_size bytes (with recv_into), and each one is
+        handed to chunk_callback as soon as it is full; the connection never
+        touches it again, so it can be kept without copying. callback is
+        called once all num_bytes have arrived. Either callback may pause
+        reading."""
+        assert not self._bytes_remaining
+        self._bytes_chunk_callback = chunk_callback
+        self._bytes_callback = callback
+        self._bytes_remaining = num_bytes
+        if num_bytes:
+            self._new_bytes_buffer()
+        else:
+            self._bytes_done()
+
+    def _new_bytes_buffer(self):
+        self._bytes_buffer = bytearray(min(self._bytes_remaining, self.read_bytes_chunk_size))
+        self._bytes_view = memoryview(self._bytes_buffer)
+        self._bytes_filled = 0
+
+    def _bytes_received(self, size):
+        """Account for size bytes having been put into the current buffer"""
+        self._bytes_filled += size
+        self._bytes_remaining -= size
+        if self._bytes_filled < len(self._bytes_buffer):
+            return
+        buffer = self._bytes_buffer
+        self._bytes_buffer = self._bytes_view = None
+        if self._bytes_remaining:
+            self._new_bytes_buffer()
+        self._bytes_chunk_callback(buffer)
+        if not self._bytes_remaining and self.state != CLOSED:
+            self._bytes_done()
+
+    def _bytes_done(self):
+        callback = self._bytes_callback
+        self._bytes_chunk_callback = self._bytes_callback = None
+        callback()
+
+    def _consume_bytes(self, data, start):
+        """Copy as much of data[start:] as read_bytes still wants into its
+        buffers; returns the offset of the first byte left over"""
+        view = memoryview(data)
+        while self._bytes_remaining and start < len(data) and self.state != CLOSED:
+            size = min(len(self._bytes_buffer) - self._bytes_filled, len(data) - start)
+            self._bytes_view[self._bytes_filled:self._bytes_filled + size] = view[start:start + size]
+            start += size
+            self._bytes_received(size)
+        return start
+
+    def pause_reading(self):
+        """Stop delivering lines until resume_reading is called. Lines which
+        are already buffered are held on to."""
+        self._reading = False
+        self._update_handler()
+
+    def resume_reading(self):
+        if self._reading or self.state == CLOSED:
+            return
+        self._reading = True
+        self._update_handler()
+        if self._read_buffer:
+            self.io_loop.add_callback(lambda: self.data_received(''))
 
     def _timeout(self):
         self._timeout_handle = None
 
+    def timed_out(self):
+        """Called by the timer wheel once self.deadline has passed"""
+        self._signal_timeout()
+
     def _set_timeout(self):
         if self.timeout > 0:
+            if self.timer_wheel:
+                # Pushing the deadline back doesn't touch the wheel at all
+                self.deadline = self.timer_wheel.now + self.timeout
+                self.timer_wheel.schedule(self)
+                return
             if self._timeout_handle:
                 self.io_loop.remove_timeout(self._timeout_handle)
             self._timeout_handle = self.io_loop.add_timeout(time.time() + self.timeout, self._signal_timeout)
@@ -71,27 +198,202 @@ class Connection(Signalable):
         if self.state == CLOSED:
             return
         self.state = CLOSED
-        if not self.stream.closed():
-            self.stream.close()
+        self.io_loop.remove_handler(self.sock.fileno())
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self._read_buffer = ''
+        self._write_buffer = []
+        self._write_callbacks = []
+        self._bytes_remaining = 0
+        self._bytes_buffer = self._bytes_view = None
+        self._bytes_chunk_callback = self._bytes_callback = None
+        if self.timer_wheel:
+            self.timer_wheel.cancel(self)
         if self._timeout_handle:
             self.io_loop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
         self._signal_closed()
         log.info("Connection from %s closed", self._format_address(self.address))
 
-    def _handle_data(self, data):
-        self._signal_data(data)
-        self._read()
+    def _handle_events(self, fd, events):
+        if self.state == CLOSED:
+            return
+        if self._handshaking:
+            self._do_handshake()
+            return
+        if events & self.io_loop.READ:
+            self._handle_read()
+            if self.state == CLOSED:
+                return
+        if events & self.io_loop.WRITE:
+            self._handle_write()
+            if self.state == CLOSED:
+                return
+        if events & self.io_loop.ERROR:
+            self.close()
+            return
+        self._update_handler()
+
+    def _update_handler(self):
+        if self.state == CLOSED or self._handshaking:
+            return
+        events = self.io_loop.ERROR
+        if self._reading:
+            events |= self.io_loop.READ
+        if self._write_buffer:
+            events |= self.io_loop.WRITE
+        self._set_events(events)
 
-    def _read(self):
-        # Add this callback in a roundabout way to work around a regression
-        # in Tornado 1.2 that causes stack overflows if you do this the
-        # naive way
-        self.stream.io_loop.add_callback(functools.partial(self.stream.read_until, "\n", self._handle_data))
+    def _set_events(self, events):
+        if events != self._events:
+            self._events = events
+            self.io_loop.update_handler(self.sock.fileno(), events)
+
+    def _do_handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._set_events(self.io_loop.READ | self.io_loop.ERROR)
+                return
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._set_events(self.io_loop.WRITE | self.io_loop.ERROR)
+                return
+            log.warn("TLS handshake with %s failed: %s", self._format_address(self.address), e)
+            metrics.tls_handshake_failures.inc()
+            self.close()
+            return
+        except socket.error, e:
+            log.debug("Error during TLS handshake with %s: %s", self._format_address(self.address), e)
+            metrics.tls_handshake_failures.inc()
+            self.close()
+            return
+        log.debug("TLS handshake with %s complete", self._format_address(self.address))
+        metrics.tls_handshake.observe(time.time() - self._handshake_started)
+        if getattr(self.sock, 'session_reused', False):
+            metrics.tls_resumed.inc()
+        self._handshaking = False
+        # Send anything that was queued up while we were negotiating
+        self._flush()
+
+    def _handle_read(self):
+        while self._reading:
+            try:
+                if self._bytes_remaining and not self._read_buffer:
+                    # Payload goes straight into the read_bytes buffer
+                    wanted = len(self._bytes_buffer) - self._bytes_filled
+                    size = self.sock.recv_into(self._bytes_view[self._bytes_filled:], wanted)
+                    chunk = None
+                else:
+                    wanted = self.read_chunk_size
+                    chunk = self.sock.recv(wanted)
+                    size = len(chunk)
+            except socket.error, e:
+                if _would_block(e):
+                    return
+                log.debug("Error reading from %s: %s", self._format_address(self.address), e)
+                self.close()
+                return
+            if not size:
+                self.close()
+                return
+            if chunk is None:
+                metrics.bytes_in.value += size
+                self._set_timeout()
+                self._bytes_received(size)
+            else:
+                self.data_received(chunk)
+            if self.state == CLOSED or self._handshaking:
+                return
+            # SSL may have decrypted more than we asked for; that data will
+            # never make the socket readable again, so keep draining it
+            if size < wanted and not (isinstance(self.sock, ssl.SSLSocket) and self.sock.pending()):
+                return
+
+    def data_received(self, data):
+        """Split the buffered byte stream into lines and signal each one.
+
+        Every complete line that is already buffered is handled in one pass,
+        and anything written in response is held back and flushed with a
+        single send once the pass is done. Bytes wanted by read_bytes are
+        passed over to it on the way."""
+        metrics.bytes_in.value += len(data)
+        if self._read_buffer:
+            data = self._read_buffer + data
+        start = 0
+        self._corked = True
+        try:
+            while self._reading:
+                if self._bytes_remaining:
+                    start = self._consume_bytes(data, start)
+                    if self.state == CLOSED:
+                        return
+                    if self._bytes_remaining:
+                        break
+                    continue
+                end = data.find('\n', start) + 1
+                if not end:
+                    if self.max_line_length is None or len(data) - start <= self.max_line_length:
+                        break
+                    end = len(data)
+                self._signal_data(data[start:end])
+                start = end
+                if self.state == CLOSED or self._handshaking:
+                    return
+        finally:
+            self._corked = False
+        self._read_buffer = data[start:] if start else data
+        if len(self._read_buffer) > self.max_buffer_size:
+            log.warn("Reached maximum read buffer size from %s", self._format_address(self.address))
+            self.close()
+            return
+        self._flush()
         self._set_timeout()
 
+    def _flush(self):
+        if self.state == CLOSED or self._handshaking:
+            return
+        if self._write_buffer:
+            self._handle_write()
+        self._update_handler()
+
+    def _handle_write(self):
+        if len(self._write_buffer) > 1:
+            self._write_buffer = [''.join(self._write_buffer)]
+        while self._write_buffer:
+            data = self._write_buffer[0]
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if _would_block(e):
+                    break
+                log.debug("Error writing to %s: %s", self._format_address(self.address), e)
+                self.close()
+                return
+            if not sent:
+                break
+            metrics.bytes_out.value += sent
+            if sent < len(data):
+                self._write_buffer[0] = data[sent:]
+                break
+            self._write_buffer.pop(0)
+        if not self._write_buffer and self._write_callbacks:
+            callbacks, self._write_callbacks = self._write_callbacks, []
+            for callback in callbacks:
+                callback()
+
     def write(self, data, callback=None, st=True):
-        """Write some data to the connection (asynchronously)"""
-        self.stream.write(data, callback)
-        if st:
-            self._set_timeout()
+        """Write some data to the connection (asynchronously). callback is
+        called once everything written so far has been flushed."""
+        if self.state == CLOSED:
+            return
+        self._write_buffer.append(data)
+        if callback:
+            self._write_callbacks.append(callback)
+        if not self._corked:
+            self._flush()
+            # A corked pass resets the timeout once it has been flushed
+            if st:
+                self._set_timeout()
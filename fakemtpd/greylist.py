@@ -0,0 +1,232 @@
+import array
+import errno
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+from fakemtpd.ratelimit import address_keys
+
+log = logging.getLogger("greylist")
+
+# Snapshot header: magic, capacity, then the young and old generations'
+# entry counts. Each generation's keys, first and last arrays follow.
+_MAGIC = 'FGL1'
+_HEADER = struct.Struct('<4sIII')
+
+
+def triplet_key(peer, sender, recipient):
+    """64-bit key for a triplet, the same in every process (unlike hash()),
+    so that snapshots can be read back after a restart. Never 0."""
+    digest = hashlib.md5('%s\0%s\0%s' % (peer, sender.lower(), recipient.lower())).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+
+class TripletTable(object):
+    """Fixed-size open-addressing (linear probing) hash table from triplet
+    keys to the times, in whole seconds, at which they were first and last
+    seen. A first time of 0 means the triplet has passed. Entries are never
+    removed; Greylist throws whole tables away instead.
+
+    Each slot takes 16 bytes, in three flat arrays."""
+
+    def __init__(self, capacity):
+        assert capacity & (capacity - 1) == 0, "capacity must be a power of two"
+        self.capacity = capacity
+        self.count = 0
+        self.keys = array.array('L', [0]) * capacity
+        self.first = array.array('I', [0]) * capacity
+        self.last = array.array('I', [0]) * capacity
+
+    def _slot(self, key):
+        keys = self.keys
+        mask = self.capacity - 1
+        i = key & mask
+        while keys[i] and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key):
+        """(first, last) for key, or None"""
+        i = self._slot(key)
+        if not self.keys[i]:
+            return None
+        return self.first[i], self.last[i]
+
+    def set(self, key, first, last):
+        i = self._slot(key)
+        if not self.keys[i]:
+            self.keys[i] = key
+            self.count += 1
+        self.first[i] = first
+        self.last[i] = last
+
+    def copy(self):
+        table = TripletTable.__new__(TripletTable)
+        table.capacity = self.capacity
+        table.count = self.count
+        table.keys = self.keys[:]
+        table.first = self.first[:]
+        table.last = self.last[:]
+        return table
+
+    def items(self):
+        for i in xrange(self.capacity):
+            if self.keys[i]:
+                yield self.keys[i], self.first[i], self.last[i]
+
+    def write(self, f):
+        for values in (self.keys, self.first, self.last):
+            values.tofile(f)
+
+    @classmethod
+    def read(cls, f, capacity, count):
+        table = cls.__new__(cls)
+        table.capacity = capacity
+        table.count = count
+        table.keys = array.array('L')
+        table.first = array.array('I')
+        table.last = array.array('I')
+        for values in (table.keys, table.first, table.last):
+            values.fromfile(f, capacity)
+        return table
+
+
+class Greylist(object):
+    """Greylisting: the first time a (peer, sender, recipient) triplet turns
+    up, it is turned away for delay seconds. If it comes back after that,
+    but within retry_window seconds, it passes, and keeps passing for as
+    long as it is seen at least every ttl seconds.
+
+    With by_network, the peer is its /24 (or /64), so that senders who
+    retry from another host of the same pool aren't held up twice.
+
+    Triplets are kept in two generations of TripletTable, each holding up to
+    half of max_entries at most half full: about 32 bytes per entry of
+    max_entries in all. When the young one fills up, the old one is thrown
+    away; triplets found in the old one are copied back into the young one,
+    so anything in use stays around.
+
+    If path is given, the tables are read from it at startup, and written
+    back by snapshot() (from a background thread) and save()."""
+
+    def __init__(self, delay=300, retry_window=86400, ttl=3024000, max_entries=1000000, by_network=True, path=None):
+        self.delay = delay
+        self.retry_window = retry_window
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.by_network = by_network
+        self.path = path
+        self.capacity = 1
+        while self.capacity < max_entries:
+            self.capacity *= 2
+        self.young = TripletTable(self.capacity)
+        self.old = TripletTable(self.capacity)
+        self._writing = False
+        if path:
+            self.load()
+
+    def __len__(self):
+        return self.young.count + self.old.count
+
+    def _rotate(self):
+        self.old = self.young
+        self.young = TripletTable(self.capacity)
+
+    def check(self, peer, sender, recipient, now=None):
+        """None if the triplet may pass, or else how many more seconds it
+        has to wait"""
+        if now is None:
+            now = time.time()
+        now = int(now)
+        key = triplet_key(address_keys(peer)[1 if self.by_network else 0], sender, recipient)
+        entry = self.young.get(key)
+        if entry is None:
+            entry = self.old.get(key)
+        if entry is not None:
+            first, last = entry
+            if first == 0 and now - last > self.ttl:
+                entry = None
+            elif first and now - first > self.retry_window:
+                entry = None
+        if self.young.count >= self.max_entries // 2 and self.young.get(key) is None:
+            self._rotate()
+        if entry is None:
+            self.young.set(key, now, now)
+            return self.delay
+        first, last = entry
+        if first and now - first < self.delay:
+            self.young.set(key, first, now)
+            return self.delay - (now - first)
+        self.young.set(key, 0, now)
+        return None
+
+    def load(self):
+        """Read the tables back from path, if it's there. A snapshot of a
+        different size is read into tables of the current size."""
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                log.error("Could not read greylist %s: %s", self.path, e)
+            return
+        with f:
+            try:
+                magic, capacity, young, old = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != _MAGIC:
+                    raise ValueError("not a greylist snapshot")
+                tables = [TripletTable.read(f, capacity, young), TripletTable.read(f, capacity, old)]
+            except (struct.error, ValueError, EOFError), e:
+                log.error("Could not read greylist %s: %s", self.path, e)
+                return
+        if capacity != self.capacity:
+            resized = []
+            for table in tables:
+                new = TripletTable(self.capacity)
+                for key, first, last in table.items():
+                    if new.count >= self.max_entries // 2:
+                        break
+                    new.set(key, first, last)
+                resized.append(new)
+            tables = resized
+        self.young, self.old = tables
+        log.info("Loaded %d greylist triplets from %s", len(self), self.path)
+
+    def _write(self, young, old):
+        """Write tables to path, atomically"""
+        temporary = '%s.tmp' % self.path
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, young.capacity, young.count, old.count))
+                young.write(f)
+                old.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temporary, self.path)
+        except (IOError, OSError), e:
+            log.error("Could not write greylist %s: %s", self.path, e)
+
+    def save(self):
+        """Write the tables out now"""
+        if self.path:
+            self._write(self.young, self.old)
+
+    def snapshot(self):
+        """Write copies of the tables out from a background thread, unless
+        the last snapshot is still being written"""
+        if not self.path or self._writing:
+            return
+        self._writing = True
+        # Nothing is ever written to the old generation
+        young, old = self.young.copy(), self.old
+
+        def write():
+            try:
+                self._write(young, old)
+            finally:
+                self._writing = False
+        thread = threading.Thread(target=write, name='greylist')
+        thread.daemon = True
+        thread.start()
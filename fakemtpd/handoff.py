@@ -0,0 +1,159 @@
+import _multiprocessing
+import json
+import logging
+import os
+import select
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+from fakemtpd.listener import FAMILIES, Listener
+
+log = logging.getLogger("handoff")
+
+# A replacement process finds the socket to take its listeners from here
+HANDOFF_ENV = 'FAKEMTPD_HANDOFF_SOCKET'
+
+
+class HandoffError(Exception):
+    pass
+
+
+def _read_line(sock):
+    """Read up to a newline, a byte at a time: reading any further could
+    swallow the byte a file descriptor is attached to"""
+    line = []
+    while True:
+        c = sock.recv(1)
+        if not c:
+            raise HandoffError("connection closed")
+        if c == '\n':
+            return ''.join(line)
+        line.append(c)
+
+
+class Handoff(object):
+    """The running process's half of a graceful restart: start a replacement
+    (the same command line, with HANDOFF_ENV pointing at a unix socket),
+    pass it the listening sockets, and wait for it to be ready.
+
+    The exchange over the unix socket is:
+
+    old -> new -- a JSON list of listener specs, then each listener's fd
+    new -> old -- "ready", once nothing can stop it from starting up
+    old -> new -- "released", once the old process has stopped accepting
+    and let go of the pid file
+
+    All of this happens in a background thread, which calls back from it:
+    release between the last two steps (it should only return once the old
+    process is out of the way), then handed_off. failed is called instead
+    if anything goes wrong first, in which case the old process carries on."""
+
+    def __init__(self, listeners, release, handed_off, failed, timeout=30):
+        self.listeners = listeners
+        self.release = release
+        self.handed_off = handed_off
+        self.failed = failed
+        self.timeout = timeout
+        self.process = None
+        self._directory = None
+        self._server = None
+
+    def start(self, argv, cwd=None):
+        self._directory = tempfile.mkdtemp(prefix='fakemtpd-handoff-')
+        path = os.path.join(self._directory, 'handoff.sock')
+        try:
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(path)
+            self._server.listen(1)
+            env = dict(os.environ)
+            env[HANDOFF_ENV] = path
+            self.process = subprocess.Popen(argv, cwd=cwd, env=env, close_fds=True)
+        except (socket.error, OSError):
+            self._cleanup()
+            raise
+        log.info("Started pid %d to hand the listeners over to", self.process.pid)
+        thread = threading.Thread(target=self._run, name='handoff')
+        thread.daemon = True
+        thread.start()
+
+    def _cleanup(self):
+        if self._server is not None:
+            self._server.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _run(self):
+        try:
+            try:
+                self._hand_off()
+            finally:
+                self._cleanup()
+        except (socket.error, OSError, HandoffError), e:
+            log.error("Could not hand the listeners over to pid %d: %s", self.process.pid, e)
+            self.failed()
+            return
+        log.info("Handed the listeners over to pid %d", self.process.pid)
+        # Last: the old process may be on its way out as soon as this runs
+        self.handed_off()
+
+    def _hand_off(self):
+        self._server.settimeout(self.timeout)
+        sock, _ = self._server.accept()
+        try:
+            sock.settimeout(self.timeout)
+            sock.sendall(json.dumps([listener.to_spec() for listener in self.listeners]) + '\n')
+            for listener in self.listeners:
+                _multiprocessing.sendfd(sock.fileno(), listener.fileno())
+            reply = _read_line(sock)
+            if reply != 'ready':
+                raise HandoffError("unexpected reply %r" % reply)
+            self.release()
+            sock.sendall('released\n')
+        finally:
+            sock.close()
+
+
+class Takeover(object):
+    """The replacement's half of a graceful restart: connect to the socket
+    at path, collect the listeners, and tell the old process once ready.
+    Every method raises HandoffError (or socket.error) on failure."""
+
+    def __init__(self, path, timeout=30):
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+
+    def listeners(self):
+        try:
+            specs = json.loads(_read_line(self.sock))
+        except ValueError, e:
+            raise HandoffError("bad listener specs: %s" % e)
+        listeners = []
+        for spec in specs:
+            # recvfd knows nothing about the socket's timeout
+            readable, _, _ = select.select([self.sock], [], [], self.timeout)
+            if not readable:
+                raise HandoffError("timed out waiting for a listener")
+            try:
+                fd = _multiprocessing.recvfd(self.sock.fileno())
+            except OSError, e:
+                raise HandoffError("could not receive a listener: %s" % e)
+            listener = Listener.from_spec(spec)
+            listener.sock = socket.fromfd(fd, FAMILIES[listener.family], socket.SOCK_STREAM)
+            os.close(fd)
+            listener.sock.setblocking(0)
+            listeners.append(listener)
+        return listeners
+
+    def ready(self):
+        """Tell the old process to stop accepting, and wait until it has"""
+        try:
+            self.sock.sendall('ready\n')
+            reply = _read_line(self.sock)
+        finally:
+            self.sock.close()
+        if reply != 'released':
+            raise HandoffError("unexpected reply %r" % reply)
@@ -0,0 +1,64 @@
+import socket
+
+FAMILIES = {
+    'inet': socket.AF_INET,
+    'inet6': getattr(socket, 'AF_INET6', None),
+}
+
+
+class Listener(object):
+    """One address the server accepts connections on, along with the TLS
+    mode of the sessions started from it:
+
+    plain -- no TLS at all
+    starttls -- STARTTLS is offered after EHLO
+    tls -- the TLS handshake happens before the banner (as on port 465)"""
+
+    def __init__(self, family, address, port, mode):
+        self.family = family
+        self.address = address
+        self.port = port
+        self.mode = mode
+        self.sock = None
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(spec['family'], spec['address'], spec['port'], spec['mode'])
+
+    def to_spec(self):
+        return {'family': self.family, 'address': self.address, 'port': self.port, 'mode': self.mode}
+
+    def bind(self, backlog, listen=True, reuse_port=False, tune=None):
+        """Create the listening socket. tune, if given, is called on the
+        socket before it is bound. If the port was 0, self.port is updated
+        to the one the kernel picked."""
+        sock = socket.socket(FAMILIES[self.family], socket.SOCK_STREAM, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.family == 'inet6' and hasattr(socket, 'IPV6_V6ONLY'):
+            # Let an inet listener have the same port
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        if tune:
+            tune(sock)
+        sock.bind((self.address, self.port))
+        if listen:
+            sock.listen(backlog)
+        self.address, self.port = sock.getsockname()[:2]
+        self.sock = sock
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        return self.sock.accept()
+
+    def __str__(self):
+        return '[%s]:%d (%s)' % (self.address, self.port, self.mode)
@@ -0,0 +1,135 @@
+import Queue
+import logging
+import threading
+
+from fakemtpd.metrics import Metrics
+
+metrics = Metrics.instance()
+
+
+class BatchFileHandler(logging.FileHandler):
+    """FileHandler which doesn't flush after every record; QueuedHandler
+    flushes it once per batch instead"""
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+
+class _Swap(object):
+    def __init__(self, target):
+        self.target = target
+
+
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+_STOP = object()
+
+
+class QueuedHandler(logging.Handler):
+    """Hand records off to a background thread, which passes them on to the
+    target handler in batches. emit() never blocks: when more than maxsize
+    records are waiting, new ones are dropped and counted.
+
+    Records cross threads unformatted, so anything passed as a logging
+    argument must not be mutated after the call."""
+
+    # Most records to take off the queue before flushing the target
+    batch_size = 512
+
+    def __init__(self, target, maxsize):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._thread = threading.Thread(target=self._run, name='logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            metrics.log_records_dropped.inc()
+
+    def set_target(self, target, timeout=5):
+        """Switch to a new target handler (say, after reopening log files).
+        Everything already queued goes to the old one, which is then closed.
+        If the queue stays full for timeout seconds, the new target is closed
+        instead and False returned."""
+        try:
+            self.queue.put(_Swap(target), timeout=timeout)
+        except Queue.Full:
+            target.close()
+            return False
+        return True
+
+    def flush(self, timeout=5):
+        """Wait (for up to timeout seconds) until everything queued so far
+        has been written"""
+        if not self._thread.is_alive():
+            return
+        marker = _Flush()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except Queue.Full:
+            return
+        marker.done.wait(timeout)
+
+    def close(self, timeout=5):
+        """Write out everything queued, then stop the thread. Gives up
+        after timeout seconds if the target is stuck."""
+        if self._thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except Queue.Full:
+                pass
+            else:
+                self._thread.join(timeout)
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            for item in batch:
+                if isinstance(item, logging.LogRecord):
+                    self.target.handle(item)
+                elif isinstance(item, _Flush):
+                    self._flush_target()
+                    item.done.set()
+                elif isinstance(item, _Swap):
+                    self._flush_target()
+                    self.target.close()
+                    self.target = item.target
+                elif item is _STOP:
+                    self._flush_target()
+                    self.target.close()
+                    return
+            self._flush_target()
+
+    def _flush_target(self):
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            self.target.handle(logging.makeLogRecord({
+                'name': 'logging',
+                'levelno': logging.WARN,
+                'levelname': logging.getLevelName(logging.WARN),
+                'msg': 'Log queue full; dropped %d records',
+                'args': (dropped - self._reported_dropped,),
+            }))
+            self._reported_dropped = dropped
+        self.target.flush()
@@ -0,0 +1,144 @@
+import bisect
+
+
+class Counter(object):
+    """A monotonically increasing count"""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield (self.name, '', self.value)
+
+
+class LabeledCounter(object):
+    """A family of counters, one per value of a single label. Callers are
+    responsible for keeping the set of label values small."""
+    kind = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        for label_value, value in sorted(self.values.iteritems()):
+            yield (self.name, '{%s="%s"}' % (self.label, label_value), value)
+
+
+class Gauge(object):
+    """A value which is read from a function whenever metrics are collected"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        yield (self.name, '', self.function() if self.function else 0)
+
+
+class Histogram(object):
+    """Counts of observations falling into fixed buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield (self.name + '_bucket', '{le="%r"}' % bound, cumulative)
+        yield (self.name + '_bucket', '{le="+Inf"}', self.count)
+        yield (self.name + '_sum', '', self.sum)
+        yield (self.name + '_count', '', self.count)
+
+
+# Buckets (in seconds) for per-command and per-session timings
+COMMAND_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1)
+SESSION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600)
+HANDSHAKE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+
+class Metrics(object):
+    """Singleton holding the daemon's in-process metrics. Use the instance
+    method to get handles to it.
+
+    Everything here is a plain attribute update, with no locking and no
+    formatting, so it is cheap enough to use on every command; all of the
+    formatting happens in render()."""
+
+    def __init__(self):
+        self.connections_accepted = Counter('fakemtpd_connections_accepted_total', 'Connections accepted')
+        self.connections_shed = LabeledCounter('fakemtpd_connections_shed_total', 'Connections turned away with 421 because of overload, by reason', 'reason')
+        self.connections_closed = Counter('fakemtpd_connections_closed_total', 'Connections closed')
+        self.connections_timed_out = Counter('fakemtpd_connections_timed_out_total', 'Connections closed for being idle')
+        self.commands = LabeledCounter('fakemtpd_commands_total', 'Commands received, by verb', 'verb')
+        self.responses = LabeledCounter('fakemtpd_responses_total', 'Replies sent, by code', 'code')
+        self.policy_decisions = LabeledCounter('fakemtpd_policy_decisions_total',
+                                               'Senders and recipients matched by a policy rule, by check and action', 'decision')
+        self.rate_limited = LabeledCounter('fakemtpd_rate_limited_total',
+                                           'Connections and commands refused or tarpitted for going over a rate limit, by limit', 'limit')
+        self.greylist = LabeledCounter('fakemtpd_greylist_total', 'Recipients checked against the greylist, by result', 'result')
+        self.relay_denied = Counter('fakemtpd_relay_denied_total', 'Recipients rejected with relay access denied')
+        self.messages_accepted = Counter('fakemtpd_messages_accepted_total', 'Messages accepted with accept_mail')
+        self.messages_rejected = Counter('fakemtpd_messages_rejected_total', 'Messages rejected after DATA (too large, or a spool error)')
+        self.starttls = Counter('fakemtpd_starttls_total', 'Sessions upgraded with STARTTLS')
+        self.tls_handshake = Histogram('fakemtpd_tls_handshake_seconds', 'Time from starting TLS to a completed handshake', HANDSHAKE_BUCKETS)
+        self.tls_handshake_failures = Counter('fakemtpd_tls_handshake_failures_total', 'TLS handshakes which failed')
+        self.tls_resumed = Counter('fakemtpd_tls_resumed_total', 'TLS handshakes which resumed a session (where Python can tell)')
+        self.log_records_dropped = Counter('fakemtpd_log_records_dropped_total', 'Log records dropped because the log queue was full')
+        self.bytes_in = Counter('fakemtpd_received_bytes_total', 'Bytes read from clients')
+        self.bytes_out = Counter('fakemtpd_sent_bytes_total', 'Bytes written to clients')
+        self.sessions = Gauge('fakemtpd_sessions', 'Live sessions')
+        self.loop_lag = Gauge('fakemtpd_loop_lag_seconds', 'How late the event loop last ran a timer')
+        self.greylist_entries = Gauge('fakemtpd_greylist_entries', 'Triplets in the greylist')
+        self.rate_limit_entries = Gauge('fakemtpd_rate_limit_entries', 'Hosts and networks the rate limiter is keeping track of')
+        self.captured = Gauge('fakemtpd_captured_messages', 'Transactions in the capture store')
+        self.capture_bytes = Gauge('fakemtpd_capture_bytes', 'Bytes used by capture segments')
+        self.capture_skipped = LabeledCounter('fakemtpd_capture_skipped_total', 'Transactions not captured, by reason', 'reason')
+        self.session_duration = Histogram('fakemtpd_session_duration_seconds', 'Session duration', SESSION_BUCKETS)
+        self.command_latency = Histogram('fakemtpd_command_seconds', 'Time spent handling a command', COMMAND_BUCKETS)
+
+    @classmethod
+    def instance(cls):
+        """Get a handle to the Metrics singleton"""
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    def collect(self):
+        """All of the metrics"""
+        return [m for m in self.__dict__.itervalues() if hasattr(m, 'samples')]
+
+    def render(self):
+        """Render in the Prometheus text exposition format"""
+        lines = []
+        for metric in sorted(self.collect(), key=lambda m: m.name):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
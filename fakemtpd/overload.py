@@ -0,0 +1,43 @@
+import logging
+import time
+
+log = logging.getLogger("overload")
+
+
+class LagMonitor(object):
+    """Keep track of how far behind the IOLoop is running, by setting a
+    timer every interval seconds and seeing how late it fires.
+
+    Once the lag goes over threshold, overloaded is set; it's cleared again
+    once the lag is back under half of that, so that it doesn't flap."""
+
+    def __init__(self, io_loop, threshold, interval=0.1):
+        self.io_loop = io_loop
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = 0.0
+        self.overloaded = False
+        self._expected = None
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        self._expected = time.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(self._expected, self._tick)
+
+    def _tick(self):
+        self.lag = max(time.time() - self._expected, 0.0)
+        if self.overloaded and self.lag < self.threshold / 2:
+            self.overloaded = False
+            log.info("Event loop lag down to %.3fs; accepting sessions again", self.lag)
+        elif not self.overloaded and self.lag > self.threshold:
+            self.overloaded = True
+            log.warn("Event loop lag is %.3fs; turning new sessions away", self.lag)
+        self._schedule()
@@ -0,0 +1,313 @@
+import array
+import bisect
+import collections
+import heapq
+import logging
+import threading
+import time
+
+from fakemtpd.config import Config
+
+log = logging.getLogger("policy")
+
+ACTIONS = ('accept', 'reject', 'tempfail')
+
+_REPLIES = {
+    'reject': ('554 5.7.1', 'address rejected'),
+    'tempfail': ('450 4.7.1', 'address temporarily rejected'),
+}
+
+
+class PolicyError(Exception):
+    pass
+
+
+class Rule(collections.namedtuple('Rule', ['action', 'text'])):
+    """What to do with a matching address: accept, reject or tempfail,
+    optionally with the text to reply with"""
+
+    def reply(self, address, kind):
+        """The reply to refuse address with (None to accept it). kind is
+        'Sender' or 'Recipient'."""
+        if self.action == 'accept':
+            return None
+        code, text = _REPLIES[self.action]
+        return "%s <%s>: %s" % (code, address, self.text or "%s %s" % (kind, text))
+
+
+class _Strings(object):
+    """A list of strings, packed into one string and an array of offsets
+    rather than kept as a string object each. Append them all, then pack()
+    before reading any. They are joined a chunk at a time along the way, so
+    that no one join copies them all."""
+
+    chunk = 10000
+
+    def __init__(self):
+        self._chunks = []
+        self._parts = []
+        self._data = ''
+        self._offsets = array.array('L', [0])
+
+    def append(self, string):
+        self._parts.append(string)
+        self._offsets.append(self._offsets[-1] + len(string))
+        if len(self._parts) == self.chunk:
+            self._chunks.append(''.join(self._parts))
+            self._parts = []
+
+    def pack(self):
+        self._chunks.append(''.join(self._parts))
+        self._data = ''.join(self._chunks)
+        self._chunks = self._parts = None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
+
+
+class PolicyTable(object):
+    """Rules from one policy file, compiled into flat arrays.
+
+    Each line of the file is "key action [reply text]"; blank lines and
+    lines starting with # are skipped. A key with an @ in it is an address,
+    anything else a domain, which also matches its subdomains. An address
+    rule beats a domain rule, and a longer domain beats a shorter one. If
+    a key is listed twice, the later line wins. Keys are case-insensitive.
+
+    Addresses live in a sorted array of their hashes, next to arrays of
+    the addresses themselves and of rule numbers. Domains live in a trie of
+    their labels, last label first, whose edges are a sorted array of
+    hash((parent, label)) next to arrays of parents, labels and child nodes.
+    Either way, a lookup is a binary search per address or label, checking
+    the key itself for any entry with a matching hash, and the whole table
+    takes the keys plus a few bytes each (as long as there are only so many
+    distinct replies)."""
+
+    # While compiling, give other threads a turn every this many lines or keys
+    yield_lines = 10000
+
+    def __init__(self, lines, name='<rules>'):
+        self.name = name
+        rules = []
+        rule_numbers = {}
+        addresses = {}
+        edges = {}
+        node_rules = array.array('H', [0])
+        for number, line in enumerate(lines, 1):
+            if number % self.yield_lines == 0:
+                time.sleep(0)
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 2)
+            if len(parts) < 2 or parts[1].lower() not in ACTIONS:
+                raise PolicyError("%s line %d: expected \"key %s [text]\"" % (name, number, '|'.join(ACTIONS)))
+            rule = Rule(parts[1].lower(), parts[2] if len(parts) > 2 else None)
+            if rule not in rule_numbers:
+                if len(rules) >= 0xFFFF:
+                    raise PolicyError("%s line %d: too many different replies" % (name, number))
+                rules.append(rule)
+                rule_numbers[rule] = len(rules)
+            key = parts[0].lower()
+            if '@' in key:
+                addresses[key] = rule_numbers[rule]
+                continue
+            node = 0
+            for label in reversed(key.strip('.').split('.')):
+                edge = (node, label)
+                child = edges.get(edge)
+                if child is None:
+                    child = edges[edge] = len(node_rules)
+                    node_rules.append(0)
+                node = child
+            node_rules[node] = rule_numbers[rule]
+        self.rules = [None] + rules
+        # _by_hash is done going through a dict before its first pair, and
+        # popping entries as they go into the arrays means the dicts aren't
+        # freed all at once at the end either
+        self._address_hashes = array.array('l')
+        self._address_keys = _Strings()
+        self._address_rules = array.array('H')
+        for value, key in self._by_hash(addresses):
+            self._address_hashes.append(value)
+            self._address_keys.append(key)
+            self._address_rules.append(addresses.pop(key))
+        self._address_keys.pack()
+        self._edge_hashes = array.array('l')
+        self._edge_parents = array.array('I')
+        self._edge_labels = _Strings()
+        self._edge_nodes = array.array('I')
+        for value, edge in self._by_hash(edges):
+            self._edge_hashes.append(value)
+            self._edge_parents.append(edge[0])
+            self._edge_labels.append(edge[1])
+            self._edge_nodes.append(edges.pop(edge))
+        self._edge_labels.pack()
+        self._node_rules = node_rules
+        self.addresses = len(self._address_hashes)
+        self.domains = sum(1 for rule in node_rules if rule)
+
+    def _by_hash(self, keys):
+        """(hash, key) for each of keys, in order of hash. Sorting millions
+        of keys in one go would hold the GIL for seconds, so this sorts runs
+        of yield_lines keys and merges them, giving other threads a turn
+        in between. Runs are sorted backwards and merged off their ends, to
+        let go of the pairs as they are used."""
+        runs = []
+        run = []
+        for key in keys:
+            run.append((hash(key), key))
+            if len(run) == self.yield_lines:
+                run.sort(reverse=True)
+                runs.append(run)
+                run = []
+                time.sleep(0)
+        if run:
+            run.sort(reverse=True)
+            runs.append(run)
+        heap = [(rest.pop(), rest) for rest in runs]
+        heapq.heapify(heap)
+        number = 0
+        while heap:
+            pair, rest = heap[0]
+            yield pair
+            if rest:
+                heapq.heapreplace(heap, (rest.pop(), rest))
+            else:
+                heapq.heappop(heap)
+            number += 1
+            if number % self.yield_lines == 0:
+                time.sleep(0)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(f, path)
+
+    def __len__(self):
+        return self.addresses + self.domains
+
+    @staticmethod
+    def _find(hashes, value, matches):
+        """The index of the entry with hash value for which matches(index)
+        is true, or None. Keys with the same hash sit next to each other."""
+        i = bisect.bisect_left(hashes, value)
+        while i < len(hashes) and hashes[i] == value:
+            if matches(i):
+                return i
+            i += 1
+        return None
+
+    def lookup(self, address):
+        """The Rule for address, or None"""
+        address = address.lower()
+        i = self._find(self._address_hashes, hash(address), lambda i: self._address_keys[i] == address)
+        if i is not None:
+            return self.rules[self._address_rules[i]]
+        found = 0
+        node = 0
+        for label in reversed(address.rpartition('@')[2].strip('.').split('.')):
+            i = self._find(self._edge_hashes, hash((node, label)),
+                           lambda i: self._edge_parents[i] == node and self._edge_labels[i] == label)
+            if i is None:
+                break
+            node = self._edge_nodes[i]
+            found = self._node_rules[node] or found
+        return self.rules[found] if found else None
+
+
+class Policy(object):
+    """Singleton holding the recipient_policy and sender_policy tables.
+    Use the instance method to get handles to it.
+
+    The tables are loaded at startup, before workers are forked, so that
+    workers share them. On reload, new tables are compiled on a background
+    thread and swapped in from the IOLoop in one assignment, so a session
+    never sees half of a reload; if anything goes wrong, the old tables
+    stay."""
+
+    def __init__(self):
+        self.tables = (None, None)
+        self._reloading = False
+        self._reload_again = False
+
+    @classmethod
+    def instance(cls):
+        """Get a handle to the Policy singleton"""
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def config(self):
+        # Whichever snapshot is current when the tables are built
+        return Config.instance()
+
+    @property
+    def configured(self):
+        return bool(self.config.recipient_policy or self.config.sender_policy)
+
+    def build(self):
+        """Compile tables from the current config. Raises on unreadable or
+        bad files."""
+        tables = []
+        for path in (self.config.recipient_policy, self.config.sender_policy):
+            if not path:
+                tables.append(None)
+                continue
+            started = time.time()
+            try:
+                table = PolicyTable.load(path)
+            except IOError, e:
+                raise PolicyError("Could not read policy %s: %s" % (path, e))
+            log.info("Loaded %d addresses and %d domains from %s in %.2fs", table.addresses, table.domains, path, time.time() - started)
+            tables.append(table)
+        return tuple(tables)
+
+    def load(self):
+        """Load the tables right away. Returns an error, if any."""
+        try:
+            self.tables = self.build()
+        except PolicyError, e:
+            log.error("%s", e)
+            return str(e)
+        return None
+
+    def reload(self, io_loop):
+        """Rebuild the tables in the background"""
+        if self._reloading:
+            self._reload_again = True
+            return
+        self._reloading = True
+        thread = threading.Thread(target=self._build_in_background, args=(io_loop,), name='policy')
+        thread.daemon = True
+        thread.start()
+
+    def _build_in_background(self, io_loop):
+        try:
+            tables = self.build()
+        except PolicyError, e:
+            log.error("%s; keeping the old policy", e)
+            tables = None
+        io_loop.add_callback(self._reloaded, io_loop, tables)
+
+    def _reloaded(self, io_loop, tables):
+        if tables is not None:
+            self.tables = tables
+        self._reloading = False
+        if self._reload_again:
+            self._reload_again = False
+            self.reload(io_loop)
+
+    def recipient(self, address):
+        """The recipient Rule for address, or None"""
+        table = self.tables[0]
+        return table.lookup(address) if table is not None and address else None
+
+    def sender(self, address):
+        """The sender Rule for address, or None"""
+        table = self.tables[1]
+        return table.lookup(address) if table is not None and address else None
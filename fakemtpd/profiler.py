@@ -0,0 +1,113 @@
+import functools
+import logging
+import os
+import signal
+import time
+
+from fakemtpd.connection import Connection
+from fakemtpd.metrics import COMMAND_BUCKETS, HANDSHAKE_BUCKETS, Histogram, Metrics
+from fakemtpd.smtpsession import SMTPSession
+
+log = logging.getLogger("profiler")
+
+
+class SamplingProfiler(object):
+    """Statistical profiler for the main thread, which is where the IOLoop
+    runs. Every interval seconds of CPU time (ITIMER_PROF, so an idle
+    process isn't sampled), the SIGPROF handler walks the interrupted stack
+    and counts it. Stacks are written in the collapsed format that flame
+    graph tools read: one "outer;...;inner count" line per stack."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self._names = {}
+        self._previous_handler = None
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def start(self):
+        self.stacks = {}
+        self.samples = 0
+        self.started = time.time()
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.started = None
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return name
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self._name(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        key = ';'.join(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems(), key=lambda item: -item[1]):
+                f.write('%s %d\n' % (stack, count))
+
+
+# Methods timed by install_timing_hooks: (class, method, metric name,
+# metric help, buckets)
+TIMING_HOOKS = [
+    (SMTPSession, '_handle_data', 'fakemtpd_hook_handle_data_seconds', 'Time spent in SMTPSession._handle_data', COMMAND_BUCKETS),
+    (Connection, 'write', 'fakemtpd_hook_connection_write_seconds', 'Time spent in Connection.write', COMMAND_BUCKETS),
+    (Connection, '_do_handshake', 'fakemtpd_hook_tls_handshake_seconds', 'Time spent in each TLS handshake step', HANDSHAKE_BUCKETS),
+]
+
+_originals = {}
+
+
+def _timed(method, histogram):
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        started = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(time.time() - started)
+    return timed
+
+
+def install_timing_hooks():
+    """Wrap the methods in TIMING_HOOKS with timers which feed histograms.
+    Until this is called, they are the plain methods, so the hooks cost
+    nothing. Only objects which look the methods up afterwards are timed
+    (sessions bind _handle_data when they're created)."""
+    metrics = Metrics.instance()
+    for cls, name, metric, help, buckets in TIMING_HOOKS:
+        if (cls, name) in _originals:
+            continue
+        histogram = Histogram(metric, help, buckets)
+        setattr(metrics, _metric_attribute(metric), histogram)
+        _originals[cls, name] = cls.__dict__[name]
+        setattr(cls, name, _timed(cls.__dict__[name], histogram))
+
+
+def remove_timing_hooks():
+    metrics = Metrics.instance()
+    for cls, name, metric, _, _ in TIMING_HOOKS:
+        if (cls, name) in _originals:
+            setattr(cls, name, _originals.pop((cls, name)))
+            delattr(metrics, _metric_attribute(metric))
+
+
+def _metric_attribute(metric):
+    return metric[len('fakemtpd_'):-len('_seconds')]
@@ -0,0 +1,322 @@
+import array
+import bisect
+import time
+
+import tornado.web
+
+from fakemtpd.txnlog import dumps
+
+
+class Query(object):
+    """What to look for in an EnvelopeIndex: every field given has to
+    match. Addresses are compared case-insensitively; since and until are
+    timestamps (since inclusive, until exclusive) and after is an id."""
+
+    def __init__(self, recipient=None, sender=None, peer=None, since=None, until=None, after=None):
+        self.recipient = recipient.lower() if recipient is not None else None
+        self.sender = sender.lower() if sender is not None else None
+        self.peer = peer
+        self.since = since
+        self.until = until
+        self.after = after
+
+    @property
+    def unfiltered(self):
+        """Whether this matches everything"""
+        return all(value is None for value in (self.recipient, self.sender, self.peer, self.since, self.until, self.after))
+
+    def matches(self, entry):
+        if self.after is not None and entry['id'] <= self.after:
+            return False
+        if self.since is not None and entry['time'] < self.since:
+            return False
+        if self.until is not None and entry['time'] >= self.until:
+            return False
+        if self.sender is not None and entry['sender'].lower() != self.sender:
+            return False
+        if self.peer is not None and entry['peer'] != self.peer:
+            return False
+        if self.recipient is not None and not any(r.lower() == self.recipient for r in entry['recipients']):
+            return False
+        return True
+
+
+class _Waiter(object):
+    def __init__(self, query, callback):
+        self.query = query
+        self.callback = callback
+        self.timeout = None
+
+
+class EnvelopeIndex(object):
+    """The envelopes of recently finished transactions, for the query API.
+
+    Entries are dicts (see SMTPD._transaction_finished) which get an 'id'
+    when they're added, and are indexed by recipient, sender and peer. At
+    most max_messages are kept, none of them older than max_age seconds (0
+    for no limit on either).
+
+    wait() long-polls: its callback is called with the first entry
+    matching a query, as soon as there is one."""
+
+    def __init__(self, io_loop, max_messages=100000, max_age=3600):
+        self.io_loop = io_loop
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.last_id = 0
+        self._entries = []
+        self._times = array.array('d')
+        self._first_id = 1
+        self._head = 0
+        self._count = 0
+        self._by_recipient = {}
+        self._by_sender = {}
+        self._by_peer = {}
+        self._waiters = {}
+
+    def __len__(self):
+        return self._count
+
+    def _keys(self, entry):
+        """(index, key) pairs for an entry"""
+        yield self._by_sender, entry['sender'].lower()
+        yield self._by_peer, entry['peer']
+        for recipient in set(r.lower() for r in entry['recipients']):
+            yield self._by_recipient, recipient
+
+    def add(self, entry):
+        """Add an entry, and wake up anyone waiting for it. Returns its id."""
+        self.last_id += 1
+        entry['id'] = self.last_id
+        self._entries.append(entry)
+        self._times.append(entry['time'])
+        self._count += 1
+        for index, key in self._keys(entry):
+            index.setdefault(key, []).append(entry['id'])
+        self.expire()
+        self._wake(entry)
+        return entry['id']
+
+    def get(self, entry_id):
+        position = entry_id - self._first_id
+        if position < self._head or position >= len(self._entries):
+            return None
+        return self._entries[position]
+
+    def find(self, query, limit=None):
+        """Entries matching query, oldest first"""
+        self.expire()
+        if query.recipient is not None:
+            candidates = self._by_recipient.get(query.recipient, ())
+        elif query.sender is not None:
+            candidates = self._by_sender.get(query.sender, ())
+        elif query.peer is not None:
+            candidates = self._by_peer.get(query.peer, ())
+        else:
+            start = self._head
+            if query.since is not None:
+                start = max(start, bisect.bisect_left(self._times, query.since))
+            if query.after is not None:
+                start = max(start, query.after + 1 - self._first_id)
+            candidates = xrange(self._first_id + start, self._first_id + len(self._entries))
+        if query.after is not None and candidates and not isinstance(candidates, xrange):
+            candidates = candidates[bisect.bisect_right(candidates, query.after):]
+        results = []
+        for entry_id in candidates:
+            entry = self.get(entry_id)
+            if entry is None or not query.matches(entry):
+                continue
+            results.append(entry)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def delete(self, query):
+        """Remove the entries matching query; returns them"""
+        entries = self.find(query)
+        for entry in entries:
+            self._entries[entry['id'] - self._first_id] = None
+            self._count -= 1
+        return entries
+
+    def expire(self):
+        """Drop whatever is past max_messages or max_age"""
+        cutoff = time.time() - self.max_age if self.max_age else None
+        while self._head < len(self._entries):
+            entry = self._entries[self._head]
+            if entry is not None:
+                if not ((self.max_messages and self._count > self.max_messages) or
+                        (cutoff is not None and entry['time'] < cutoff)):
+                    break
+                self._entries[self._head] = None
+                self._count -= 1
+            self._head += 1
+        # Only move everything down once a good part of it is dead
+        if self._head > 1024 and self._head * 2 > len(self._entries):
+            self._trim()
+
+    def _trim(self):
+        del self._entries[:self._head]
+        del self._times[:self._head]
+        self._first_id += self._head
+        self._head = 0
+        for index in (self._by_recipient, self._by_sender, self._by_peer):
+            for key, ids in index.items():
+                if ids[-1] < self._first_id:
+                    del index[key]
+                elif ids[0] < self._first_id:
+                    del ids[:bisect.bisect_left(ids, self._first_id)]
+
+    def wait(self, query, callback, timeout):
+        """Call callback with the first entry matching query, which may
+        already be there, or with None after timeout seconds (right away
+        for 0). Returns something to pass to cancel."""
+        found = self.find(query, limit=1)
+        if found or timeout <= 0:
+            callback(found[0] if found else None)
+            return None
+        waiter = _Waiter(query, callback)
+        self._waiters.setdefault(query.recipient, []).append(waiter)
+        waiter.timeout = self.io_loop.add_timeout(time.time() + timeout, lambda: self._timed_out(waiter))
+        return waiter
+
+    def cancel(self, waiter):
+        if waiter is None:
+            return
+        waiters = self._waiters.get(waiter.query.recipient, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[waiter.query.recipient]
+            self.io_loop.remove_timeout(waiter.timeout)
+
+    def _timed_out(self, waiter):
+        self.cancel(waiter)
+        waiter.callback(None)
+
+    def _wake(self, entry):
+        if not self._waiters:
+            return
+        # Waiters are filed under the recipient they want, if any
+        candidates = list(self._waiters.get(None, ()))
+        for recipient in set(r.lower() for r in entry['recipients']):
+            candidates.extend(self._waiters.get(recipient, ()))
+        for waiter in candidates:
+            if waiter.query.matches(entry):
+                self.cancel(waiter)
+                waiter.callback(entry)
+
+
+class QueryHandler(tornado.web.RequestHandler):
+    """Base for the query API's handlers. The query comes from the
+    recipient, sender, peer, since, until and after arguments."""
+
+    def initialize(self, envelopes, capture=None):
+        self.envelopes = envelopes
+        self.capture = capture
+
+    def _number(self, name, kind):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return kind(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "%s must be a number" % name)
+
+    def query(self):
+        return Query(
+            recipient=self.get_argument('recipient', None),
+            sender=self.get_argument('sender', None),
+            peer=self.get_argument('peer', None),
+            since=self._number('since', float),
+            until=self._number('until', float),
+            after=self._number('after', int),
+        )
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(dumps(data))
+
+
+class MessagesHandler(QueryHandler):
+    """GET /messages lists matching envelopes (up to limit, default 100);
+    DELETE /messages forgets them, along with their captured copies. A
+    DELETE has to have a filter, or all=1 to forget everything."""
+
+    def get(self):
+        limit = self._number('limit', int) or 100
+        self.write_json({
+            'messages': self.envelopes.find(self.query(), limit),
+            'last_id': self.envelopes.last_id,
+        })
+
+    def delete(self):
+        query = self.query()
+        if query.unfiltered and self.get_argument('all', None) != '1':
+            raise tornado.web.HTTPError(400, "a filter or all=1 is required")
+        entries = self.envelopes.delete(query)
+        if self.capture is not None:
+            for entry in entries:
+                if entry.get('capture_id') is not None:
+                    self.capture.delete(entry['capture_id'])
+        self.write_json({'deleted': len(entries)})
+
+
+class MessageHandler(QueryHandler):
+    """GET /messages/<id>; /messages/<id>/body gets the captured body"""
+
+    def get(self, entry_id, body=None):
+        entry = self.envelopes.get(int(entry_id))
+        if entry is None:
+            raise tornado.web.HTTPError(404)
+        if not body:
+            self.write_json(entry)
+            return
+        captured = None
+        if self.capture is not None and entry.get('capture_id') is not None:
+            captured = self.capture.get(entry['capture_id'])
+        if captured is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'message/rfc822')
+        self.write(str(captured.body))
+
+
+class WaitHandler(QueryHandler):
+    """GET /wait long-polls for the first envelope matching the query, for
+    up to timeout seconds (default 30; 0 just checks). Answers 204 if
+    nothing turns up. Without after, envelopes which are already there
+    count."""
+
+    max_timeout = 300
+
+    @tornado.web.asynchronous
+    def get(self):
+        timeout = self._number('timeout', float)
+        if timeout is None:
+            timeout = 30
+        timeout = min(timeout, self.max_timeout)
+        self.waiter = None
+        self.waiter = self.envelopes.wait(self.query(), self._found, timeout)
+
+    def _found(self, entry):
+        self.waiter = None
+        if entry is None:
+            self.set_status(204)
+            self.finish()
+        else:
+            self.write_json(entry)
+            self.finish()
+
+    def on_connection_close(self):
+        self.envelopes.cancel(self.waiter)
+
+
+def handlers(envelopes, capture=None):
+    """Routes for the query API, for AdminServer"""
+    kwargs = {'envelopes': envelopes, 'capture': capture}
+    return [
+        (r'/messages', MessagesHandler, kwargs),
+        (r'/messages/(\d+)(/body)?', MessageHandler, kwargs),
+        (r'/wait', WaitHandler, kwargs),
+    ]
@@ -0,0 +1,155 @@
+import socket
+import time
+
+_V4_MAPPED = '\0' * 10 + '\xff\xff'
+
+
+def address_keys(address):
+    """(host, network) keys for an IP address: the packed address, and its
+    /24 (IPv4) or /64 (IPv6). IPv4-mapped IPv6 addresses count as IPv4.
+    Anything else is used as it is, for both."""
+    try:
+        packed = socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+    except (socket.error, TypeError, UnicodeError):
+        return address, address
+    if len(packed) == 16 and packed.startswith(_V4_MAPPED):
+        packed = packed[12:]
+    if len(packed) == 4:
+        return packed, packed[:3]
+    return packed, packed[:8]
+
+
+class GenerationalDict(object):
+    """Dict which holds on to at most about max_entries keys, forgetting the
+    ones which haven't been touched for longest. New keys go into the young
+    generation; when that's full, it becomes the old one (and the old one
+    is thrown away). A key found in the old generation is moved back into
+    the young one."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._young = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def get(self, key, default=None):
+        value = self._young.get(key)
+        if value is None:
+            value = self._old.pop(key, None)
+            if value is None:
+                return default
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self._young and len(self._young) >= self.max_entries // 2:
+            self._old = self._young
+            self._young = {}
+        self._young[key] = value
+        self._old.pop(key, None)
+
+
+class RateTable(object):
+    """Token buckets, one per key, each filling at rate tokens a second and
+    holding up to burst seconds' worth (at least one).
+
+    Buckets are kept the way GCRA does: as the time at which the bucket will
+    be full again, which is one float per key. A key whose time has passed
+    is a full bucket, so forgetting it costs nothing, which is what makes a
+    GenerationalDict good enough."""
+
+    def __init__(self, rate, burst, max_entries):
+        self.interval = 1.0 / rate
+        self.tolerance = max(rate * burst - 1, 0) * self.interval
+        self.buckets = GenerationalDict(max_entries)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def check(self, key, now):
+        """The new full time for key, if it has a token to spare; else None"""
+        full_at = max(self.buckets.get(key, now), now)
+        if full_at - now > self.tolerance:
+            return None
+        return full_at + self.interval
+
+    def take(self, key, full_at):
+        self.buckets[key] = full_at
+
+
+class RateLimiter(object):
+    """Per-host and per-network limits on connections a second, commands a
+    second and concurrent sessions. A rate or session limit of 0 is no limit.
+
+    connect() and command() return None when a peer is within its limits,
+    and otherwise the name of the limit it hit."""
+
+    def __init__(self, ip_connection_rate=0, net_connection_rate=0, ip_command_rate=0, net_command_rate=0,
+                 ip_max_sessions=0, net_max_sessions=0, burst=10, tarpit=0, max_entries=100000):
+        def table(rate):
+            return RateTable(rate, burst, max_entries) if rate else None
+        self.connection_rates = (table(ip_connection_rate), table(net_connection_rate))
+        self.command_rates = (table(ip_command_rate), table(net_command_rate))
+        self.max_sessions = (ip_max_sessions, net_max_sessions)
+        self.tarpit = tarpit
+        self.sessions = ({}, {})
+
+    @classmethod
+    def from_config(cls, config):
+        """A RateLimiter for config, or None if it doesn't limit anything"""
+        limits = dict((key, getattr(config, key)) for key in (
+            'ip_connection_rate', 'net_connection_rate', 'ip_command_rate', 'net_command_rate',
+            'ip_max_sessions', 'net_max_sessions'))
+        if not any(limits.values()):
+            return None
+        return cls(burst=config.rate_limit_burst, tarpit=config.rate_limit_tarpit,
+                   max_entries=config.rate_limit_max_entries, **limits)
+
+    def __len__(self):
+        """How many peers are being kept track of"""
+        return sum(len(table) for table in self.connection_rates + self.command_rates if table is not None)
+
+    def _take(self, tables, keys, names):
+        now = time.time()
+        taken = []
+        for table, key, name in zip(tables, keys, names):
+            if table is None:
+                continue
+            full_at = table.check(key, now)
+            if full_at is None:
+                return name
+            taken.append((table, key, full_at))
+        # Only use up tokens once every bucket has one to spare
+        for table, key, full_at in taken:
+            table.take(key, full_at)
+        return None
+
+    def connect(self, address):
+        """Account for a new session from address, unless that's over a
+        limit. Every accepted connect must be followed by a disconnect."""
+        keys = address_keys(address)
+        for sessions, key, limit, name in zip(self.sessions, keys, self.max_sessions, ('ip_sessions', 'net_sessions')):
+            if limit and sessions.get(key, 0) >= limit:
+                return name
+        limited = self._take(self.connection_rates, keys, ('ip_connections', 'net_connections'))
+        if limited:
+            return limited
+        for sessions, key in zip(self.sessions, keys):
+            sessions[key] = sessions.get(key, 0) + 1
+        return None
+
+    def disconnect(self, address):
+        for sessions, key in zip(self.sessions, address_keys(address)):
+            count = sessions.get(key, 0) - 1
+            if count > 0:
+                sessions[key] = count
+            else:
+                sessions.pop(key, None)
+
+    def command(self, address):
+        """Account for a command from address"""
+        if self.command_rates == (None, None):
+            return None
+        return self._take(self.command_rates, address_keys(address), ('ip_commands', 'net_commands'))
@@ -0,0 +1,68 @@
+class SessionRegistry(object):
+    """All of the live SMTPSessions in this process, keyed by session id.
+
+    Sessions are also indexed by peer IP and by SMTP state (kept up to date
+    through the session's state_changed signal) so that per-peer and
+    per-state counts are a dict lookup rather than a scan. Adding and
+    removing a session are O(1)."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._by_peer = {}
+        self._by_state = {}
+
+    def add(self, session):
+        self._sessions[session.id] = session
+        self._by_peer.setdefault(session.peer, set()).add(session.id)
+        self._by_state.setdefault(session.state, set()).add(session.id)
+        session.on_state_changed(self._state_changed)
+
+    def remove(self, session):
+        if self._sessions.pop(session.id, None) is None:
+            return
+        self._discard(self._by_peer, session.peer, session.id)
+        self._discard(self._by_state, session.state, session.id)
+
+    @staticmethod
+    def _discard(index, key, session_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(session_id)
+            if not ids:
+                del index[key]
+
+    def _state_changed(self, session, old_state, new_state):
+        if session.id not in self._sessions:
+            return
+        self._discard(self._by_state, old_state, session.id)
+        self._by_state.setdefault(new_state, set()).add(session.id)
+
+    def get(self, session_id, default=None):
+        return self._sessions.get(session_id, default)
+
+    def for_peer(self, peer):
+        """All of the live sessions from the given IP"""
+        return [self._sessions[i] for i in self._by_peer.get(peer, ())]
+
+    def count_for_peer(self, peer):
+        return len(self._by_peer.get(peer, ()))
+
+    def count_in_state(self, state):
+        return len(self._by_state.get(state, ()))
+
+    def counts_by_state(self):
+        return dict((state, len(ids)) for state, ids in self._by_state.iteritems())
+
+    @property
+    def peer_count(self):
+        """Number of distinct peers with at least one live session"""
+        return len(self._by_peer)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session):
+        return session.id in self._sessions
+
+    def __iter__(self):
+        return self._sessions.itervalues()
@@ -11,23 +11,75 @@ import pwd
 import signal
 import socket
 import sys
+import tempfile
+import threading
+import time
 import tornado.ioloop
 
+from fakemtpd.admin import AdminServer
+from fakemtpd.capture import CaptureStore, prepare_capture_dir
 from fakemtpd.better_lockfile import BetterLockfile
 from fakemtpd.config import Config
-from fakemtpd.connection import Connection
+from fakemtpd.greylist import Greylist
+from fakemtpd.connection import Connection, CLOSED
+from fakemtpd.handoff import HANDOFF_ENV, Handoff, HandoffError, Takeover
+from fakemtpd.listener import Listener
+from fakemtpd.logqueue import BatchFileHandler, QueuedHandler
+from fakemtpd.metrics import Metrics
+from fakemtpd.overload import LagMonitor
+from fakemtpd.policy import Policy
+from fakemtpd.profiler import SamplingProfiler, install_timing_hooks
+from fakemtpd.query import EnvelopeIndex
+from fakemtpd.ratelimit import RateLimiter
+from fakemtpd.registry import SessionRegistry
 from fakemtpd.smtpsession import SMTPSession
 from fakemtpd.signals import Signalable
+from fakemtpd.supervisor import Supervisor
+from fakemtpd.timerwheel import TimerWheel
+from fakemtpd.spool import Spool, prepare_spool_dir
+from fakemtpd.tls import ServerContext
+from fakemtpd.txnlog import TransactionLog
+
+# Python 2 doesn't export TCP_FASTOPEN; this is its value on Linux
+TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN', 23 if sys.platform.startswith('linux') else None)
 
 
 class SMTPD(Signalable):
     _signals = ('stop', 'hup', 'stop_user')
 
+    # Most refused connections to hold on to at once with rate_limit_tarpit
+    max_tarpitted = 1000
+
     def __init__(self):
         super(SMTPD, self).__init__()
-        self.connections = []
+        self.connections = SessionRegistry()
         self.config = Config.instance()
         self.uid = self.gid = None
+        self.supervisor = None
+        self._reuse_port = False
+        self.timer_wheel = TimerWheel()
+        self.worker_index = 0
+        self.txn_log = None
+        self.spool = None
+        self.capture = None
+        self.admin = None
+        self.envelopes = None
+        self.rate_limiter = None
+        self.lag_monitor = None
+        self.profiler = None
+        self.greylist = None
+        self.listeners = []
+        self.pidfile = None
+        self.handoff = None
+        self.draining = False
+        self._daemon_context = None
+        self._tarpitted = 0
+        # What a replacement is started with on SIGUSR2 (daemonizing
+        # changes the working directory)
+        self._argv = [sys.executable] + sys.argv
+        self._cwd = os.getcwd()
+        self.metrics = Metrics.instance()
+        self.metrics.sessions.function = lambda: len(self.connections)
 
     def handle_opts(self):
         parser = optparse.OptionParser()
@@ -71,6 +123,27 @@ class SMTPD(Signalable):
         parser.add_option(
             '--log-file', action='store', default=self.config.log_file,
             help="File to write logs to (only valid if logging method is 'file')")
+        parser.add_option(
+            '--accept-mail', action='store_true', default=self.config.accept_mail,
+            help="Accept messages instead of rejecting every recipient")
+        parser.add_option(
+            '--spool-dir', action='store', default=self.config.spool_dir,
+            help="Directory to keep accepted messages in (default: throw them away)")
+        parser.add_option(
+            '--capture-dir', action='store', default=self.config.capture_dir,
+            help="Directory to keep an indexed capture of every transaction in")
+        parser.add_option(
+            '--greylist', action='store_true', default=self.config.greylist,
+            help="Tempfail the first attempt from every (network, sender, recipient) triplet")
+        parser.add_option(
+            '--recipient-policy', action='store', default=self.config.recipient_policy,
+            help="File of recipient addresses and domains to accept, reject or tempfail")
+        parser.add_option(
+            '--sender-policy', action='store', default=self.config.sender_policy,
+            help="File of sender addresses and domains to accept, reject or tempfail")
+        parser.add_option(
+            '--txn-log', action='store', default=self.config.txn_log,
+            help="File to append a JSON record of every finished session to")
         parser.add_option(
             '--syslog-domain-socket', action='store', default=self.config.syslog_domain_socket,
             help="Syslog domain socket to write to (default %default, overrides syslog host if provided)")
@@ -80,6 +153,21 @@ class SMTPD(Signalable):
         parser.add_option(
             '--syslog-port', type=int, action='store', default=self.config.syslog_port,
             help="Syslog port to write to (default %default, only valid of logging method is 'syslog')")
+        parser.add_option(
+            '--admin-port', type=int, action='store', default=self.config.admin_port,
+            help="Serve metrics over HTTP on this port (default: off; workers use consecutive ports)")
+        parser.add_option(
+            '--admin-socket', action='store', default=self.config.admin_socket,
+            help="Serve metrics and the query API over HTTP on this unix socket (workers add .N)")
+        parser.add_option(
+            '--listen-backlog', type=int, action='store', default=self.config.listen_backlog,
+            help="Length of the listen queue (default %default)")
+        parser.add_option(
+            '--accept-batch', type=int, action='store', default=self.config.accept_batch,
+            help="Most connections to accept per loop iteration (default %default)")
+        parser.add_option(
+            '-w', '--workers', type=int, action='store', default=self.config.workers,
+            help="Number of worker processes to accept connections in (default %default)")
         (opts, _) = parser.parse_args()
         return opts
 
@@ -117,41 +205,422 @@ class SMTPD(Signalable):
         elif add_signals:
             self.on_stop(self._signal_stop_user)
 
-    def _restore_privs(self):
+    def _regain_privs(self):
         if self.config.group:
             os.setegid(os.getgid())
         if self.config.user:
             os.seteuid(os.getuid())
+
+    def _restore_privs(self):
+        self._regain_privs()
         self._signal_stop_user()
 
-    def bind(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setblocking(0)
-        sock.bind((self.config.address, self.config.port))
-        sock.listen(128)
-        return sock
+    def bind(self, listen=True, reuse_port=False):
+        """Bind every configured listener; returns the Listeners"""
+        listeners = []
+        try:
+            for spec in self.config.listener_specs:
+                listener = Listener.from_spec(spec)
+                listener.bind(self.config.listen_backlog, listen=listen, reuse_port=reuse_port, tune=self.tune_listener)
+                listeners.append(listener)
+        except socket.error:
+            for listener in listeners:
+                listener.close()
+            raise
+        return listeners
+
+    def tune_listener(self, sock):
+        """Apply the configured socket options to a listening socket. Buffer
+        sizes are inherited by the sockets accepted from it (and have to be
+        set before listen() for the window scale to take them into account)."""
+        if self.config.so_rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config.so_rcvbuf)
+        if self.config.so_sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.config.so_sndbuf)
+        if self.config.tcp_defer_accept:
+            # SMTP servers speak first, so a deferred connection is only
+            # handed to us once the client gives up waiting and sends
+            # something, or the kernel gives up after this many seconds.
+            # Only useful for weeding out clients that never complete the
+            # handshake.
+            if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, self.config.tcp_defer_accept)
+            else:
+                logging.warn("TCP_DEFER_ACCEPT is not supported on this platform; ignoring tcp_defer_accept")
+        if self.config.tcp_fastopen:
+            if TCP_FASTOPEN is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, self.config.tcp_fastopen)
+            else:
+                logging.warn("TCP_FASTOPEN is not supported on this platform; ignoring tcp_fastopen")
 
-    def create_loop(self, sock):
+    def create_loop(self, listeners):
         io_loop = tornado.ioloop.IOLoop.instance()
-        new_connection_handler = functools.partial(self.connection_ready, io_loop, sock)
-        io_loop.add_handler(sock.fileno(), new_connection_handler, io_loop.READ)
+        self.listeners = listeners
+        self.on_hup(self._reload_config, first=True)
+        # HUP handlers log and take locks, which can't be done safely from
+        # inside a signal handler
+        signal.signal(signal.SIGHUP, lambda signum, frame: io_loop.add_callback_from_signal(self._signal_hup))
+        for listener in listeners:
+            new_connection_handler = functools.partial(self.connection_ready, io_loop, listener)
+            io_loop.add_handler(listener.fileno(), new_connection_handler, io_loop.READ)
+        self.start_handoff(io_loop)
+        self.start_timers(io_loop)
+        self.start_lag_monitor(io_loop)
+        self.start_profiler(io_loop)
+        self.start_policy(io_loop)
+        self.start_rate_limiter()
+        self.start_greylist(io_loop)
+        self.start_txn_log(io_loop)
+        self.start_spool(io_loop)
+        self.start_capture(io_loop)
+        self.start_admin(io_loop)
         return io_loop
 
-    def connection_ready(self, io_loop, sock, fd, events):
-        while True:
+    def _reload_config(self):
+        """Re-read the configuration on SIGHUP and use it from now on.
+        Sessions which are already running keep the one they started with."""
+        error = self.config.reload()
+        if error:
+            logging.error("Not reloading the configuration: %s", error)
+            return
+        self.config = Config.instance()
+        logging.getLogger().setLevel(self._log_level)
+        logging.info("Reloaded the configuration")
+        if self.config.deferred:
+            logging.warn("Changes to %s only take effect on restart", ', '.join(self.config.deferred))
+
+    def start_lag_monitor(self, io_loop):
+        """Keep an eye on event loop lag, if max_loop_lag is set"""
+        if not self.config.max_loop_lag:
+            return
+        self.lag_monitor = LagMonitor(io_loop, self.config.max_loop_lag, self.config.loop_lag_interval)
+        self.lag_monitor.start()
+        self.on_stop(self.lag_monitor.stop)
+        self.metrics.loop_lag.function = lambda: self.lag_monitor.lag
+
+    def start_profiler(self, io_loop):
+        """SIGUSR1 profiles the event loop for profile_duration seconds (or
+        until the next SIGUSR1), and writes the samples to profile_dir"""
+        if self.config.timing_hooks:
+            install_timing_hooks()
+        self.profiler = SamplingProfiler(self.config.profile_interval)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: io_loop.add_callback_from_signal(self._toggle_profiler, io_loop))
+
+    def _toggle_profiler(self, io_loop):
+        if self.profiler.running:
+            self._stop_profiler()
+            return
+        logging.info("Profiling for %ss", self.config.profile_duration)
+        self.profiler.start()
+        io_loop.add_timeout(time.time() + self.config.profile_duration,
+                            functools.partial(self._profile_expired, self.profiler.started))
+
+    def _profile_expired(self, started):
+        # Unless it was stopped (and maybe started again) meanwhile
+        if self.profiler.started == started:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        self.profiler.stop()
+        path = os.path.join(self.config.profile_dir or tempfile.gettempdir(),
+                            'fakemtpd-%d-%s.folded' % (os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+        try:
+            self.profiler.write(path)
+        except IOError, e:
+            logging.error("Could not write profile %s: %s", path, e)
+            return
+        logging.info("Wrote %d profile samples to %s", self.profiler.samples, path)
+
+    def start_handoff(self, io_loop):
+        """SIGUSR2 starts a replacement process, hands the listening sockets
+        over to it and drains. With workers, the supervisor does the handing
+        over, and then sends each worker SIGUSR2 to drain."""
+        if self.config.workers > 1:
+            action = self._drain
+        else:
+            action = self._upgrade
+        signal.signal(signal.SIGUSR2, lambda signum, frame: io_loop.add_callback_from_signal(action, io_loop))
+
+    def _upgrade(self, io_loop=None):
+        """Start handing the listeners over to a new process. io_loop is
+        None in the supervisor, which never drops privileges."""
+        if self.handoff is not None or self.draining:
+            logging.warn("Already handing over to another process; ignoring SIGUSR2")
+            return
+        self.handoff = Handoff(self.listeners, functools.partial(self._release, io_loop),
+                               functools.partial(self._handed_off, io_loop),
+                               self._handoff_failed, self.config.handoff_timeout)
+        # The replacement has to start out the way we did
+        if io_loop is not None:
+            self._regain_privs()
+        try:
+            self.handoff.start(self._argv, self._cwd)
+        except (OSError, socket.error), e:
+            logging.error("Could not start a replacement process: %s", e)
+            self.handoff = None
+        finally:
+            if io_loop is not None:
+                self.maybe_drop_privs(add_signals=False)
+
+    def _handoff_failed(self):
+        # Called from the handoff thread; we just carry on as we were
+        self.handoff = None
+
+    def _release(self, io_loop):
+        """Called from the handoff thread once the replacement is ready, to
+        get out of its way: it goes on to take the pid file and to bind the
+        admin port. (Workers only stop accepting once they're told to drain;
+        a new worker which can't bind yet is restarted a second later.)"""
+        self._release_pid_file()
+        if io_loop is None:
+            return
+        stopped = threading.Event()
+
+        def stop():
+            self._stop_accepting(io_loop)
+            stopped.set()
+        io_loop.add_callback(stop)
+        stopped.wait(self.config.handoff_timeout)
+
+    def _handed_off(self, io_loop):
+        # Called from the handoff thread once the replacement has been told
+        # to carry on
+        if io_loop is None:
+            self.supervisor.drain()
+        else:
+            io_loop.add_callback(self._drain, io_loop)
+
+    def _stop_accepting(self, io_loop):
+        """Stop accepting connections and admin requests"""
+        for listener in self.listeners:
+            # Take whatever is already queued up: with SO_REUSEPORT the
+            # socket is ours alone, and closing it would reset them
+            self.connection_ready(io_loop, listener, listener.fileno(), io_loop.READ)
+            io_loop.remove_handler(listener.fileno())
+            listener.close()
+        self.listeners = []
+        if self.admin is not None:
+            self.admin.stop()
+
+    def _drain(self, io_loop):
+        """Stop accepting, and stop altogether once the open sessions are
+        done, or after drain_timeout seconds"""
+        if self.draining:
+            return
+        self.draining = True
+        self._stop_accepting(io_loop)
+        logging.warn("No longer accepting connections; draining %d sessions", len(self.connections))
+        if not len(self.connections):
+            self._drained()
+            return
+        io_loop.add_timeout(time.time() + self.config.drain_timeout, self._drained)
+
+    def _drained(self):
+        if not self.draining:
+            return
+        self.draining = False
+        if len(self.connections):
+            logging.warn("Gave up draining with %d sessions still open", len(self.connections))
+        self._signal_stop()
+
+    def _release_pid_file(self):
+        """Let go of the pid file for a replacement to take, without
+        removing it on the way out"""
+        if self.pidfile is None:
+            return
+        if self.pidfile.i_am_locking:
+            self.pidfile.release()
+        if self._daemon_context is not None:
+            self._daemon_context.pidfile = None
+        self.pidfile = None
+
+    def _remove_pid_file(self):
+        if self.pidfile is not None:
+            self.pidfile.destroy()
+
+    def _overloaded(self):
+        """Why a new connection should be turned away, if it should"""
+        if self.config.max_sessions and len(self.connections) >= self.config.max_sessions:
+            return 'sessions'
+        if self.lag_monitor is not None and self.lag_monitor.overloaded:
+            return 'loop_lag'
+        return None
+
+    def start_policy(self, io_loop):
+        """Reload the policy tables on SIGHUP (in the background), even if
+        there are none: the reloaded configuration may add some"""
+        self.on_hup(lambda: Policy.instance().reload(io_loop))
+
+    def start_rate_limiter(self):
+        self.rate_limiter = RateLimiter.from_config(self.config)
+        if self.rate_limiter is not None:
+            self.metrics.rate_limit_entries.function = lambda: len(self.rate_limiter)
+
+    def start_greylist(self, io_loop):
+        """Load the greylist, and snapshot it every
+        greylist_snapshot_interval seconds. Each worker has its own, so
+        worker N's file is greylist_file.N."""
+        if not self.config.greylist:
+            return
+        path = self.config.greylist_file
+        if path and self.config.workers > 1:
+            path = '%s.%d' % (path, self.worker_index)
+        self.greylist = Greylist(delay=self.config.greylist_delay, retry_window=self.config.greylist_retry_window,
+                                 ttl=self.config.greylist_ttl, max_entries=self.config.greylist_max_entries,
+                                 by_network=self.config.greylist_by_network, path=path)
+        self.metrics.greylist_entries.function = lambda: len(self.greylist)
+        if path:
+            snapshots = tornado.ioloop.PeriodicCallback(self.greylist.snapshot, self.config.greylist_snapshot_interval * 1000, io_loop=io_loop)
+            snapshots.start()
+            self.on_stop(self.greylist.save)
+
+    def start_spool(self, io_loop):
+        """Start the spool threads, if messages are to be kept"""
+        if not (self.config.accept_mail and self.config.spool_dir):
+            return
+        self.spool = Spool(self.config.spool_dir, io_loop, threads=self.config.spool_threads)
+        self.on_stop(self.spool.stop)
+
+    def start_capture(self, io_loop):
+        """Open the capture store, if one is configured. Every worker keeps
+        its own segments, so worker N's are named wN.*."""
+        if not self.config.capture_dir:
+            return
+        self.capture = CaptureStore(self.config.capture_dir, io_loop, prefix='w%d' % self.worker_index,
+                                    segment_size=self.config.capture_segment_size,
+                                    max_segments=self.config.capture_max_segments)
+        self.on_stop(self.capture.close)
+        self.metrics.captured.function = lambda: len(self.capture)
+        self.metrics.capture_bytes.function = lambda: self.capture.size
+
+    def start_txn_log(self, io_loop):
+        """Open the transaction log, if one is configured, and flush it
+        every txn_log_flush_interval seconds"""
+        if not self.config.txn_log:
+            return
+        self.txn_log = TransactionLog(self.config.txn_log, self.config.txn_log_flush_bytes)
+        flusher = tornado.ioloop.PeriodicCallback(self.txn_log.flush, self.config.txn_log_flush_interval * 1000, io_loop=io_loop)
+        flusher.start()
+        self.on_stop(self.txn_log.close)
+        self.on_hup(self._reopen_txn_log)
+
+    def _reopen_txn_log(self):
+        self._regain_privs()
+        self.txn_log.reopen()
+        self.maybe_drop_privs(add_signals=False)
+
+    def start_admin(self, io_loop):
+        """Start the metrics and query API HTTP listener, if one is
+        configured. Every worker needs a port (and socket) of its own, so
+        worker N listens on admin_port + N (and admin_socket.N)."""
+        if self.config.admin_port is None and not self.config.admin_socket:
+            return
+        self.envelopes = EnvelopeIndex(io_loop, max_messages=self.config.query_max_messages,
+                                       max_age=self.config.query_max_age)
+        self.admin = AdminServer(io_loop, envelopes=self.envelopes, capture=self.capture)
+        if self.config.admin_port is not None:
+            self.admin.listen(self.config.admin_port + self.worker_index, self.config.admin_address)
+        if self.config.admin_socket:
+            path = self.config.admin_socket
+            if self.config.workers > 1:
+                path = '%s.%d' % (path, self.worker_index)
+            self.admin.listen_unix(path)
+        self.on_stop(self.admin.stop)
+
+    def start_timers(self, io_loop):
+        """Sweep the idle-timeout wheel once per tick"""
+        self.timer_wheel.advance()
+        sweeper = tornado.ioloop.PeriodicCallback(self.timer_wheel.advance, self.timer_wheel.resolution * 1000, io_loop=io_loop)
+        sweeper.start()
+
+    def connection_ready(self, io_loop, listener, fd, events):
+        # Accept at most accept_batch connections per wakeup: the listening
+        # socket is level-triggered, so anything left over is picked up on
+        # the next loop iteration, after the existing sessions have had
+        # their turn.
+        for _ in xrange(self.config.accept_batch):
             try:
-                connection, address = sock.accept()
+                connection, address = listener.accept()
             except socket.error, e:
+                if e[0] == errno.ECONNABORTED:
+                    continue
                 if e[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                     raise
                 return
-            c = Connection(io_loop, self.config.timeout)
-            s = SMTPSession(c)
+            # Shedding has to be as cheap as possible: no Connection or
+            # SMTPSession, just a reply on the raw socket
+            overloaded = self._overloaded()
+            if overloaded:
+                self.metrics.connections_shed.inc(overloaded)
+                self._refuse(io_loop, connection, "421 4.3.2 %s Service not available, closing transmission channel" % self.config.hostname)
+                continue
+            if self.rate_limiter is not None:
+                peer = address[0] if isinstance(address, tuple) else address
+                limited = self.rate_limiter.connect(peer)
+                if limited:
+                    self.metrics.rate_limited.inc(limited)
+                    self._refuse(io_loop, connection, "421 4.7.0 %s Error: too many connections from %s" % (
+                        self.config.hostname, peer), self.rate_limiter.tarpit)
+                    continue
+            if self.config.tcp_nodelay:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = Connection(io_loop, self.config.timeout, timer_wheel=self.timer_wheel)
+            s = SMTPSession(c, tls_mode=listener.mode, spool=self.spool, capture=self.capture,
+                            rate_limiter=self.rate_limiter, greylist=self.greylist)
+            if self.envelopes is not None:
+                s.on_transaction(self._transaction_finished)
             logging.debug("new connection")
+            c.on_closed(functools.partial(self._session_closed, s))
+            self.metrics.connections_accepted.inc()
             c.connect(connection, address)
-            self.connections.append(s)
-            c.on_closed(lambda: self.connections.remove(s) if s in self.connections else None)
+            if c.state != CLOSED:
+                self.connections.add(s)
+
+    def _refuse(self, io_loop, connection, reply, delay=0):
+        """Send reply straight down a new connection and close it, without
+        setting up a session. With a delay, the connection is held on to for
+        that long first, unless max_tarpitted already are."""
+        if delay and self._tarpitted < self.max_tarpitted:
+            self._tarpitted += 1
+
+            def release():
+                self._tarpitted -= 1
+                self._refuse(io_loop, connection, reply)
+            io_loop.add_timeout(time.time() + delay, release)
+            return
+        try:
+            connection.setblocking(0)
+            connection.send(reply + '\r\n')
+        except socket.error:
+            pass
+        connection.close()
+
+    def _transaction_finished(self, session, transaction):
+        self.envelopes.add({
+            'time': time.time(),
+            'session': session.id,
+            'peer': session.peer,
+            'helo': session.remote or None,
+            'tls': session.encrypted,
+            'sender': transaction['mail_from'],
+            'recipients': list(transaction.get('rcpt_to', [])),
+            'status': transaction['status'],
+            'size': transaction.get('size'),
+            'queued_as': transaction.get('queued_as'),
+            'capture_id': transaction.get('capture_id'),
+        })
+
+    def _session_closed(self, session):
+        self.connections.remove(session)
+        if self.rate_limiter is not None:
+            self.rate_limiter.disconnect(session.peer)
+        self.metrics.connections_closed.inc()
+        if session.connected_at:
+            self.metrics.session_duration.observe(time.time() - session.connected_at)
+        if self.txn_log:
+            self.txn_log.record(session.summary())
+        if self.draining and not len(self.connections):
+            self._drained()
 
     def run(self, handle_opts=True):
         if handle_opts:
@@ -167,6 +636,8 @@ class SMTPD(Signalable):
                 errors = self.config.read_file(opts.config_path)
                 if errors:
                     self.die(errors)
+        # Set when we were started by a process handing its listeners over
+        handoff_path = os.environ.pop(HANDOFF_ENV, None)
         (uid, gid) = self.get_uid_gid()
         self.uid = uid
         self.gid = gid
@@ -204,39 +675,139 @@ class SMTPD(Signalable):
             pidfile = BetterLockfile(os.path.realpath(self.config.pid_file))
             try:
                 pidfile.acquire()
+                pidfile.release()
             except lockfile.AlreadyLocked:
-                self.die("%s is already locked; another instance running?" % self.config.pid_file)
-            pidfile.release()
+                # A process handing over to us holds on to it until we're ready
+                if not handoff_path:
+                    self.die("%s is already locked; another instance running?" % self.config.pid_file)
         else:
             pidfile = None
+        if self.config.accept_mail and self.config.spool_dir:
+            try:
+                prepare_spool_dir(self.config.spool_dir, uid, gid)
+            except OSError, e:
+                self.die("Could not create spool directory %s: %s" % (self.config.spool_dir, e))
+        if self.config.capture_dir:
+            try:
+                prepare_capture_dir(self.config.capture_dir, uid, gid)
+            except OSError, e:
+                self.die("Could not create capture directory %s: %s" % (self.config.capture_dir, e))
+        # Load the certificate while we can still complain to the user (and
+        # before workers are forked, so that they share session ticket keys)
+        self.tls = ServerContext.instance()
+        errors = self.tls.reload()
+        if errors:
+            self.die(errors)
+        self.on_hup(self.tls.reload)
+        # Likewise, workers share the policy tables
+        self.policy = Policy.instance()
+        errors = self.policy.load()
+        if errors:
+            self.die(errors)
+        # With SO_REUSEPORT every worker gets its own listening socket and
+        # the kernel balances between them. The supervisor's socket only
+        # holds on to the address (and resolves port 0), so it must never
+        # listen or it would be handed connections nobody accepts.
+        self._reuse_port = self.config.workers > 1 and hasattr(socket, 'SO_REUSEPORT')
         # Do this before daemonizing so that the user can see any errors
         # that may occur
-        sock = self.bind()
-        self.config.merge_sock(sock)
+        if handoff_path:
+            try:
+                takeover = Takeover(handoff_path, self.config.handoff_timeout)
+                listeners = takeover.listeners()
+            except (socket.error, HandoffError), e:
+                self.die("Could not take over the listeners: %s" % e)
+        else:
+            try:
+                listeners = self.bind(listen=not self._reuse_port, reuse_port=self._reuse_port)
+            except socket.error, e:
+                self.die("Could not bind: %s" % e)
+        self.listeners = listeners
+        if self.config.workers > 1:
+            self.supervisor = Supervisor(self.config.workers, functools.partial(self._run_worker, listeners=listeners))
+        self.config.merge_listeners(listeners)
+        if handoff_path:
+            # Past this point, nothing stops us from starting up; the old
+            # process stops accepting and lets go of the pid file
+            try:
+                takeover.ready()
+            except (socket.error, HandoffError), e:
+                self.die("Could not take over from the running process: %s" % e)
         if self.config.daemonize:
-            d = daemon.DaemonContext(files_preserve=[pidfile.file, self.log_file, sock], pidfile=pidfile, stdout=self.log_file, stderr=self.log_file)
+            files_preserve = [pidfile.file, self.log_file] + [listener.sock for listener in listeners]
+            d = daemon.DaemonContext(files_preserve=files_preserve, pidfile=pidfile, stdout=self.log_file, stderr=self.log_file)
+            self._daemon_context = d
             self.on_stop_user(d.close)
             d.open()
         elif self.config.log_file:
             os.dup2(self.log_file.fileno(), sys.stdout.fileno())
             os.dup2(self.log_file.fileno(), sys.stderr.fileno())
         if self.config.pid_file:
-            self.on_stop_user(pidfile.destroy)
-        signal.signal(signal.SIGINT, lambda signum, frame: self._signal_stop())
-        signal.signal(signal.SIGTERM, lambda signum, frame: self._signal_stop())
-        signal.signal(signal.SIGHUP, lambda signum, frame: self._signal_hup())
+            self.pidfile = pidfile
+            self.on_stop_user(self._remove_pid_file)
+        if self.supervisor:
+            signal.signal(signal.SIGINT, lambda signum, frame: self.supervisor.stop())
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.supervisor.stop())
+            # Workers forked from now on start out with the new configuration
+            # and policy tables (running ones reload their own)
+            self.on_hup(self._reload_config, first=True)
+            self.on_hup(self.policy.load)
+            self.on_hup(lambda: self.supervisor.signal_workers(signal.SIGHUP))
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.supervisor.add_callback_from_signal(self._signal_hup))
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.supervisor.signal_workers(signal.SIGUSR1))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.supervisor.add_callback_from_signal(self._upgrade))
+        else:
+            signal.signal(signal.SIGINT, lambda signum, frame: self._signal_stop())
+            signal.signal(signal.SIGTERM, lambda signum, frame: self._signal_stop())
+            # Until create_loop sets up the real handler
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
         # This needs to happen after daemonization
         self._setup_logging()
-        logging.info("Bound on port %d", self.config.port)
+        for listener in listeners:
+            logging.info("Bound on %s", listener)
         if pidfile:
+            # After a handoff, the old process's pid is still in there
+            pidfile.file.truncate(0)
             print >>pidfile.file, os.getpid()
             pidfile.file.flush()
-        io_loop = self.create_loop(sock)
+        if self.supervisor:
+            self.on_stop(self._signal_stop_user)
+            logging.getLogger().handlers[0].flush()
+            self.supervisor.run()
+            self._signal_stop()
+            logging.warn("Shutting down")
+            logging.shutdown()
+            return
+        io_loop = self.create_loop(listeners)
         self.maybe_drop_privs()
         self.on_stop(io_loop.stop)
         logging.getLogger().handlers[0].flush()
         self._start(io_loop)
 
+    def _run_worker(self, index, listeners=None):
+        """Main function of a forked worker process"""
+        self.worker_index = index
+        signal.signal(signal.SIGINT, lambda signum, frame: self._signal_stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._signal_stop())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # The pid file and the daemon context belong to the supervisor, and
+        # HUPs only need to reopen our own log files
+        self._signal_handlers.pop('stop_user', None)
+        self._signal_handlers.pop('hup', None)
+        self._setup_logging()
+        if self.log_file:
+            self.on_hup(lambda: self._reopen_log_files())
+        self.on_hup(self.tls.reload)
+        if self._reuse_port:
+            for listener in listeners:
+                listener.close()
+            listeners = self.bind(reuse_port=True)
+        logging.info("Worker %d accepting connections", index)
+        io_loop = self.create_loop(listeners)
+        self.maybe_drop_privs()
+        self.on_stop(io_loop.stop)
+        self._start(io_loop)
+
     def _check_create_log_file(self, uid, gid):
         """Create the log file if necessary, and give it the right owner"""
         if not os.path.exists(self.config.log_file):
@@ -262,30 +833,50 @@ class SMTPD(Signalable):
             level = logging.WARN
         return level
 
-    def _setup_logging(self):
-        logging.getLogger().setLevel(self._log_level)
-        logging.getLogger().handlers = []
+    def _make_log_handler(self):
+        """The handler which actually writes log records out"""
         if self.config.logging_method == 'file':
-            logging.basicConfig(filename=self.config.log_file, format=self._log_fmt, level=self._log_level)
+            if self.config.log_queue_size:
+                handler = BatchFileHandler(self.config.log_file)
+            else:
+                handler = logging.FileHandler(self.config.log_file)
         elif self.config.logging_method == 'syslog':
             facility = logging.handlers.SysLogHandler.LOG_MAIL
-            if self.config.syslog_domain_socket:
-                syslog_handler = logging.handlers.SysLogHandler(self.config.syslog_connection, facility=facility)
-            else:
-                syslog_handler = logging.handlers.SysLogHandler(self.config.syslog_connection, facility=facility)
-            syslog_handler.setLevel(self._log_level)
-            syslog_handler.setFormatter(logging.Formatter(self._log_fmt))
-            logging.getLogger().addHandler(syslog_handler)
+            handler = logging.handlers.SysLogHandler(self.config.syslog_connection, facility=facility)
         else:
-            logging.basicConfig(stream=sys.stderr, format=self._log_fmt, level=self._log_level)
+            handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(self._log_fmt))
+        return handler
+
+    def _setup_logging(self):
+        """Point the root logger at the configured destination. With
+        log_queue_size set, the IOLoop thread only queues records up and a
+        background thread writes them. Threads don't survive fork(), so
+        workers need to call this again."""
+        root = logging.getLogger()
+        root.setLevel(self._log_level)
+        root.handlers = []
+        handler = self._make_log_handler()
+        if self.config.log_queue_size:
+            handler = QueuedHandler(handler, self.config.log_queue_size)
+        root.addHandler(handler)
+        self._log_handler = handler
 
     def _reopen_log_files(self):
         """Handle a HUP to reload logging"""
         if self.config.log_file:
             logging.warn("re-opening log files")
-            self._restore_privs()
-            logging.getLogger().handlers = []
-            logging.basicConfig(filename=self.config.log_file, format=self._log_fmt, level=self._log_level)
+            # Not _restore_privs: that also runs the stop_user handlers,
+            # which remove the pid file
+            self._regain_privs()
+            handler = self._make_log_handler()
+            if isinstance(self._log_handler, QueuedHandler):
+                if not self._log_handler.set_target(handler):
+                    logging.error("Log queue full; still writing to the old log file")
+            else:
+                logging.getLogger().handlers = [handler]
+                self._log_handler.close()
+                self._log_handler = handler
             self.log_file.close()
             self.log_file = open(self.config.log_file, 'a')
             os.dup2(self.log_file.fileno(), sys.stdout.fileno())
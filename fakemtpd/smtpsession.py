@@ -1,53 +1,142 @@
+import email.utils
+import itertools
 import logging
 import re
+import time
 
 from fakemtpd.config import Config
+from fakemtpd.metrics import Metrics
+from fakemtpd.policy import Policy
+from fakemtpd.signals import Signalable
+from fakemtpd.tls import ServerContext
 
 # SMTP States
 SMTP_DISCONNECTED = 0
 SMTP_CONNECTED = 1
 SMTP_HELO = 2
 SMTP_MAIL_FROM = 3
+SMTP_RCPT_TO = 4
+SMTP_BDAT = 5
 
-# Command REs
+ALL_STATES = (SMTP_DISCONNECTED, SMTP_CONNECTED, SMTP_HELO, SMTP_MAIL_FROM, SMTP_RCPT_TO, SMTP_BDAT)
+
+# Argument REs; only run once the verb has been dispatched
 MAIL_FROM_COMMAND = re.compile(r'MAIL\s+FROM:\s*<([^>]*)>', re.I)
+SIZE_PARAMETER = re.compile(r'\sSIZE=(\d+)', re.I)
 HELO_COMMAND = re.compile(r'^HELO\s+(.*)', re.I)
 EHLO_COMMAND = re.compile(r'^EHLO\s+(.*)', re.I)
 RCPT_TO_COMMAND = re.compile(r'^RCPT\s+TO:\s*<([^>]+)>', re.I)
 VRFY_COMMAND = re.compile(r'^VRFY (<?.+>?)', re.I)
-QUIT_COMMAND = re.compile(r'^QUIT', re.I)
-NOOP_COMMAND = re.compile(r'^NOOP', re.I)
-RSET_COMMAND = re.compile(r'^RSET', re.I)
-DATA_COMMAND = re.compile(r'^DATA', re.I)
-HELP_COMMAND = re.compile(r'^HELP', re.I)
-EXPN_COMMAND = re.compile(r'^EXPN', re.I)
-STARTTLS_COMMAND = re.compile(r'^STARTTLS', re.I)
+BDAT_COMMAND = re.compile(r'^BDAT\s+(\d+)(\s+LAST)?\s*$', re.I)
 
 log = logging.getLogger("smtpsession")
 
+metrics = Metrics.instance()
+
+_session_ids = itertools.count(1)
+
 
-class SMTPSession(object):
-    """Implement the SMTP protocol on top of a Connection"""
+class SMTPSession(Signalable):
+    """Implement the SMTP protocol on top of a Connection.
+
+    tls_mode is the mode of the listener the connection came in on (see
+    fakemtpd.listener.Listener). Message bodies go to spool, and if capture
+    (a fakemtpd.capture.CaptureStore) is given, every transaction which gets
+    as far as a refused recipient or an accepted message is added to it. A
+    recipient refused by policy or greylisting, after which the transaction
+    carries on, counts as a rejected transaction of its own.
+    rate_limiter (a fakemtpd.ratelimit.RateLimiter) limits commands, and
+    greylist (a fakemtpd.greylist.Greylist) holds off new senders.
+    Those transactions are also signalled as transaction(session, state),
+    where state is the dict kept in transactions, with a 'status' of
+    'rejected' or 'accepted'."""
+    _signals = ("state_changed", "transaction")
 
     # Timeout before disconecting (in seconds)
     timeout = 30
 
-    def __init__(self, connection):
+    # Most transactions to remember per session for summary()
+    max_transactions = 100
+
+    # Most recipients per transaction in accept_mail mode
+    max_recipients = 100
+
+    # While receiving DATA, lines longer than this are handled in pieces
+    max_data_line_length = 65536
+
+    def __init__(self, connection, tls_mode='starttls', spool=None, capture=None, rate_limiter=None, greylist=None):
+        super(SMTPSession, self).__init__()
+        self.id = next(_session_ids)
         self.conn = connection
         self.conn.on_connected(self._connect)
         self.conn.on_connected(self._print_banner)
         self.conn.on_timeout(self._print_timeout)
         self.conn.on_data(self._handle_data)
+        self.conn.on_closed(self._handle_close)
         self.config = Config.instance()
+        self.policy = Policy.instance()
         self.remote = ''
-        self._state = SMTP_DISCONNECTED
+        self.connected_at = None
+        self.commands = 0
+        self.responses = {}
+        self.transactions = []
+        self.transactions_dropped = 0
+        self.close_reason = 'disconnect'
+        self._smtp_state = SMTP_DISCONNECTED
         self._message_state = {}
         self._mode = 'HELO'
+        self.tls_mode = tls_mode
+        self.spool = spool
+        self.capture = capture
+        self.rate_limiter = rate_limiter
+        self.greylist = greylist
+        self._receiving = False
+        self._spool_file = None
+        self._captured_body = None
+        self._capture_too_big = False
+        self._disconnected = False
         self._encrypted = False
+        self._output = None
+
+    @property
+    def state(self):
+        """The current SMTP_* state"""
+        return self._smtp_state
+
+    def _get_state(self):
+        return self._smtp_state
+
+    def _set_state(self, state):
+        old_state = self._smtp_state
+        if state != old_state:
+            self._smtp_state = state
+            self._signal_state_changed(self, old_state, state)
+
+    _state = property(_get_state, _set_state)
+
+    @property
+    def encrypted(self):
+        """Whether the session is over TLS"""
+        return self._encrypted
+
+    @property
+    def peer(self):
+        """The remote IP address"""
+        address = self.conn.address
+        return address[0] if isinstance(address, tuple) else address
 
     def _connect(self):
+        self.connected_at = time.time()
+        if self.tls_mode == 'tls':
+            # The banner is queued up until the handshake is done
+            self.conn.starttls(**ServerContext.instance().starttls_options())
+            self._encrypted = True
         self._state = SMTP_CONNECTED
 
+    @property
+    def _starttls_available(self):
+        return self.tls_mode == 'starttls' and bool(self.config.tls_cert) and not self._encrypted
+
     def _print_banner(self):
         self._write("220 %s %s %s" % (self.config.hostname, self.config.smtp_ver, self.config.mtd))
 
@@ -55,133 +144,451 @@ class SMTPSession(object):
     def _prefix(self):
         return hex(hash(self))[2:8]
 
-    def _write(self, data, *args, **kwargs):
+    def _write(self, data, callback=None, st=True):
         log.debug('%s <<< %s', self._prefix, data)
-        self.conn.write(data + '\r\n', *args, **kwargs)
+        if data[3:4] != '-':
+            code = data[:3]
+            metrics.responses.inc(code)
+            self.responses[code] = self.responses.get(code, 0) + 1
+        if self._output is None:
+            self.conn.write(data + '\r\n', callback, st)
+            return
+        self._output.append(data + '\r\n')
+        if callback:
+            self._output_callbacks.append(callback)
+        self._output_st = self._output_st or st
+
+    def _cork(self):
+        """Hold on to everything written until _uncork, so that a multi-line
+        reply goes out as one write (and resets the timeout only once)"""
+        if self._output is None:
+            self._output = []
+            self._output_callbacks = []
+            self._output_st = False
+
+    def _uncork(self):
+        if self._output is None:
+            return
+        output, callbacks, st = self._output, self._output_callbacks, self._output_st
+        self._output = None
+        if not output:
+            return
+        if len(callbacks) > 1:
+            def callback():
+                for c in callbacks:
+                    c()
+        else:
+            callback = callbacks[0] if callbacks else None
+        self.conn.write(''.join(output), callback, st)
+
+    def _handle_close(self):
+        self._disconnected = True
+        self._abort_message()
+
+    def _abort_message(self):
+        """Throw away the message being received, if any"""
+        self._captured_body = None
+        if self._spool_file is not None:
+            self._spool_file.abort()
+            self._spool_file = None
+
+    def _finish_transaction(self, status, body=None, state=None, capture=True):
+        """Capture (unless told not to) and signal a transaction: the
+        current one, unless state is given"""
+        if state is None:
+            state = self._message_state
+        state['status'] = status
+        if capture and self.capture is not None:
+            state['capture_id'] = self.capture.append(state['mail_from'], state.get('rcpt_to', []), body, self.id)
+        self._signal_transaction(self, state)
+
+    def _refuse_recipient(self, recipient, reason, reply):
+        """Refuse one recipient (reason is 'refused' or 'greylisted') and
+        record that as a rejected transaction, without ending this one"""
+        self._message_state.setdefault(reason, []).append(recipient)
+        self._write(reply)
+        self._finish_transaction('rejected', state={
+            'mail_from': self._message_state['mail_from'],
+            'rcpt_to': [recipient],
+        })
 
     def _handle_data(self, data):
-        rv = False
+        if self._receiving:
+            self._data_line(data)
+            return
+        if self.rate_limiter is not None:
+            limited = self.rate_limiter.command(self.peer)
+            if limited:
+                metrics.rate_limited.inc(limited)
+                self._rate_limited(data)
+                return
+        started = time.time()
         data = data.rstrip('\r\n')
         log.debug('%s >>> %s', self._prefix, data)
-        if self._state_all(data):
-            return
-        if self._state >= SMTP_HELO:
-            rv = self._state_after_helo(data)
-        if self._state == SMTP_CONNECTED:
-            rv = self._state_connected(data)
-            # Some people don't HELO before sending commands; lame
-            if not rv:
-                rv = self._state_helo(data)
-        elif self._state == SMTP_HELO:
-            rv = self._state_helo(data) or rv
-        elif self._state == SMTP_MAIL_FROM:
-            rv = self._state_mail_from(data)
-        if rv is False:
+        parts = data.split(None, 1)
+        verb = parts[0].upper() if parts else ''
+        handler = _COMMANDS.get((self._state, verb))
+        self.commands += 1
+        # Keep the label set bounded no matter what clients send
+        metrics.commands.inc(verb if verb in _VERBS else 'unknown')
+        if handler is None or handler(self, data) is False:
             self._write("503 Commands out of sync or unrecognized")
-            log.warn("Bad command '%s' from %s" % (data, self.conn.address))
+            log.warn("Bad command '%s' from %s", data, self.conn.address)
+            self._abort_message()
             self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
+        metrics.command_latency.observe(time.time() - started)
 
-    def _state_all(self, data):
-        quit_match = QUIT_COMMAND.match(data)
-        rset_match = RSET_COMMAND.match(data)
-        noop_match = NOOP_COMMAND.match(data)
-        help_match = HELP_COMMAND.match(data)
-        if quit_match:
-            self._write("221 2.0.0 Bye", self.conn.close, False)
-            return True
-        elif rset_match:
-            self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
-            self._message_state = {}
-            self._write("250 2.0.0 Ok")
-            return True
-        elif noop_match:
-            self._write("250 2.0.0 Ok")
-            return True
-        elif help_match:
-            self.write_help()
-            return True
-
-    def _state_connected(self, data):
+    def _rate_limited(self, data):
+        """Hold on to a command for rate_limiter.tarpit seconds (without
+        reading anything else meanwhile), or hang up if there's no tarpit"""
+        self.conn.pause_reading()
+        if self.rate_limiter.tarpit:
+            self.conn.io_loop.add_timeout(time.time() + self.rate_limiter.tarpit, lambda: self._tarpit_done(data))
+            return
+        self.close_reason = 'rate_limited'
+        self._write("421 4.7.0 %s Error: too many commands, closing connection" % self.config.hostname, self.conn.close, False)
+
+    def _tarpit_done(self, data):
+        if self._disconnected:
+            return
+        # Buffered lines are picked up on the next loop iteration, so this
+        # one still goes first (and may well pause reading again)
+        self.conn.resume_reading()
+        self._handle_data(data)
+
+    # Command handlers. Each one is looked up by (state, verb) in _COMMANDS
+    # and gets the whole line; returning False means the arguments didn't
+    # parse and the command is treated as unrecognized.
+
+    def _cmd_quit(self, data):
+        self.close_reason = 'quit'
+        self.conn.pause_reading()
+        self._write("221 2.0.0 Bye", self.conn.close, False)
+
+    def _cmd_rset(self, data):
+        self._abort_message()
+        self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
+        self._message_state = {}
+        self._write("250 2.0.0 Ok")
+
+    def _cmd_noop(self, data):
+        self._write("250 2.0.0 Ok")
+
+    def _cmd_help(self, data):
+        self.write_help()
+
+    def _cmd_helo(self, data):
         helo_match = HELO_COMMAND.match(data)
+        if not helo_match:
+            return False
+        self.remote = helo_match.group(1)
+        self._write("250 %s" % self.config.hostname)
+        self._state = SMTP_HELO
+        self._mode = 'HELO'
+
+    def _cmd_ehlo(self, data):
         ehlo_match = EHLO_COMMAND.match(data)
-        if helo_match:
-            self.remote = helo_match.group(1)
-            self._write("250 %s" % self.config.hostname)
-            self._state = SMTP_HELO
-            self._mode = 'HELO'
-            return True
-        elif ehlo_match:
-            self.remote = ehlo_match.group(1)
-            self._write("250-%s" % self.config.hostname)
-            if self.config.tls_cert:
-                self._write("250 STARTTLS")
-            self._state = SMTP_HELO
-            self._mode = 'EHLO'
-            return True
-        return False
+        if not ehlo_match:
+            return False
+        self.remote = ehlo_match.group(1)
+        extensions = ['PIPELINING']
+        if self.config.accept_mail:
+            extensions.append('SIZE %d' % self.config.max_message_size)
+            extensions.append('CHUNKING')
+        if self._starttls_available:
+            extensions.append('STARTTLS')
+        self._cork()
+        self._write("250-%s" % self.config.hostname)
+        for extension in extensions[:-1]:
+            self._write("250-%s" % extension)
+        self._write("250 %s" % extensions[-1])
+        self._uncork()
+        self._state = SMTP_HELO
+        self._mode = 'EHLO'
 
-    def _state_helo(self, data):
+    def _cmd_mail(self, data):
         mail_from_match = MAIL_FROM_COMMAND.match(data)
-        vrfy_match = VRFY_COMMAND.match(data)
-        expn_match = EXPN_COMMAND.match(data)
-        if mail_from_match:
-            self._message_state = {}
-            self._message_state['mail_from'] = mail_from_match.group(1)
-            self._write("250 2.1.0 Ok")
-            self._state = SMTP_MAIL_FROM
-            return True
-        elif vrfy_match:
-            self._write("502 5.5.1 VRFY command is disabled")
-            self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
-            return True
-        elif expn_match:
-            self._write("502 5.5.1 EXPN command is disabled")
-            self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
-            return True
-        return False
-
-    def _state_after_helo(self, data):
-        starttls_match = STARTTLS_COMMAND.match(data)
-        if starttls_match:
-            if self._encrypted:
-                self._write("554 5.5.1 Error: TLS already active")
-                return True
-            if self.config.tls_cert and self._mode == 'EHLO':
-                self._write("220 Go Ahead", self._starttls)
-            else:
-                self._write('502 5.5.1 STARTTLS not supported in RFC821 mode (meant to say EHLO?)')
-            return True
-        return False
+        if not mail_from_match:
+            return False
+        if self.config.accept_mail and self.config.max_message_size:
+            size_match = SIZE_PARAMETER.search(data, mail_from_match.end())
+            if size_match and int(size_match.group(1)) > self.config.max_message_size:
+                self._write("552 5.3.4 Message size exceeds fixed limit")
+                return
+        rule = self.policy.sender(mail_from_match.group(1))
+        if rule is not None:
+            metrics.policy_decisions.inc('sender_' + rule.action)
+            if rule.action != 'accept':
+                self._write(rule.reply(mail_from_match.group(1), 'Sender'))
+                return
+        self._message_state = {
+            'mail_from': mail_from_match.group(1),
+            'at': round(time.time() - self.connected_at, 3),
+        }
+        if len(self.transactions) < self.max_transactions:
+            self.transactions.append(self._message_state)
+        else:
+            self.transactions_dropped += 1
+        self._write("250 2.1.0 Ok")
+        self._state = SMTP_MAIL_FROM
+
+    def _cmd_vrfy(self, data):
+        if not VRFY_COMMAND.match(data):
+            return False
+        self._write("502 5.5.1 VRFY command is disabled")
+        self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
+
+    def _cmd_expn(self, data):
+        self._write("502 5.5.1 EXPN command is disabled")
+        self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
+
+    def _cmd_starttls(self, data):
+        if self._encrypted:
+            self._write("554 5.5.1 Error: TLS already active")
+        elif self._starttls_available and self._mode == 'EHLO':
+            # Nothing sent after STARTTLS may be read until the handshake is done
+            self.conn.pause_reading()
+            self._write("220 Go Ahead", self._starttls)
+        else:
+            self._write('502 5.5.1 STARTTLS not supported in RFC821 mode (meant to say EHLO?)')
 
     def _starttls(self):
-        self.conn.starttls(keyfile=self.config.tls_key, certfile=self.config.tls_cert, ssl_version=self.config.ssl_version)
+        self.conn.starttls(**ServerContext.instance().starttls_options())
         self._encrypted = True
+        metrics.starttls.inc()
+        # RFC 3207: forget everything learned before the handshake; the
+        # client has to EHLO again
+        self.remote = ''
+        self._message_state = {}
+        self._mode = 'HELO'
+        self._state = SMTP_CONNECTED
 
-    def _state_mail_from(self, data):
+    def _cmd_rcpt(self, data):
         rcpt_to_match = RCPT_TO_COMMAND.match(data)
-        data_match = DATA_COMMAND.match(data)
-        mail_from_match = MAIL_FROM_COMMAND.match(data)
-        if rcpt_to_match:
-            self._message_state.setdefault('rcpt_to', []).append(rcpt_to_match.group(1))
-            self._write("554 5.7.1 <%s>: Relay access denied" % self._message_state['mail_from'])
-            log.info("Relay access denied to %s (%s)", self.conn.address, self._message_state['mail_from'])
-            self._state = SMTP_HELO
-            return True
-        elif data_match:
+        if not rcpt_to_match:
+            return False
+        recipient = rcpt_to_match.group(1)
+        rule = self.policy.recipient(recipient)
+        if rule is not None:
+            metrics.policy_decisions.inc('recipient_' + rule.action)
+            if rule.action != 'accept':
+                self._refuse_recipient(recipient, 'refused', rule.reply(recipient, 'Recipient'))
+                return
+        elif self.greylist is not None:
+            wait = self.greylist.check(self.peer, self._message_state['mail_from'], recipient)
+            metrics.greylist.inc('greylisted' if wait else 'passed')
+            if wait:
+                self._refuse_recipient(recipient, 'greylisted',
+                                       "451 4.7.1 <%s>: Greylisted, try again in %d seconds" % (recipient, wait))
+                return
+        if self.config.accept_mail or rule is not None:
+            recipients = self._message_state.setdefault('rcpt_to', [])
+            if len(recipients) >= self.max_recipients:
+                self._write("452 4.5.3 Error: too many recipients")
+                return
+            recipients.append(recipient)
+            self._write("250 2.1.5 Ok")
+            self._state = SMTP_RCPT_TO
+            return
+        self._message_state.setdefault('rcpt_to', []).append(rcpt_to_match.group(1))
+        self._write("554 5.7.1 <%s>: Relay access denied" % self._message_state['mail_from'])
+        log.info("Relay access denied to %s (%s)", self.conn.address, self._message_state['mail_from'])
+        metrics.relay_denied.inc()
+        self._finish_transaction('rejected')
+        self._state = SMTP_HELO
+
+    def _cmd_data(self, data):
+        # Without accept_mail, recipients can still be accepted by policy
+        if not self.config.accept_mail and self._state != SMTP_RCPT_TO:
             self._write("502 5.5.1 DATA command is disabled")
             self._state = SMTP_HELO
-            return True
-        elif mail_from_match:
-            self._write("503 5.5.1 Error: nested MAIL command")
-            self._state = SMTP_HELO
-            return True
-        return False
+            return
+        if self._state != SMTP_RCPT_TO:
+            self._write("554 5.5.1 Error: no valid recipients")
+            return
+        self._receiving = True
+        self._data_at_line_start = True
+        self.conn.max_line_length = self.max_data_line_length
+        self._start_message()
+        self._write("354 End data with <CR><LF>.<CR><LF>")
+
+    def _start_message(self):
+        self._data_size = 0
+        self._data_too_big = False
+        self._capture_too_big = False
+        if self.capture is not None:
+            self._captured_body = []
+        if self.spool is not None:
+            self._spool_file = self.spool.open()
+            self._spool_file.write(self._trace_headers())
+
+    def _trace_headers(self):
+        headers = ["Return-Path: <%s>\r\n" % self._message_state['mail_from']]
+        for recipient in self._message_state['rcpt_to']:
+            headers.append("X-Fakemtpd-Envelope-To: <%s>\r\n" % recipient)
+        headers.append("Received: from %s ([%s])\r\n\tby %s (%s) with %s id %d;\r\n\t%s\r\n" % (
+            self.remote or 'unknown', self.peer, self.config.hostname, self.config.mtd,
+            'ESMTPS' if self._encrypted else ('ESMTP' if self._mode == 'EHLO' else 'SMTP'),
+            self.id, email.utils.formatdate(localtime=True)))
+        return ''.join(headers)
+
+    def _data_line(self, line):
+        """Handle one line (or a piece of a very long one) of message body"""
+        if self._data_at_line_start and line[:1] == '.':
+            if line == '.\r\n' or line == '.\n':
+                self._end_data()
+                return
+            line = line[1:]
+        self._data_at_line_start = line[-1:] == '\n'
+        self._data_size += len(line)
+        if self._data_too_big:
+            return
+        if self.config.max_message_size and self._data_size > self.config.max_message_size:
+            # Keep reading up to the final dot, but don't store any of it
+            self._data_too_big = True
+            self._abort_message()
+            return
+        self._capture_chunk(line)
+        if self._spool_file is not None and not self._spool_file.write(line):
+            self.conn.pause_reading()
+            self._spool_file.wait_for_drain(self.conn.resume_reading)
+
+    def _capture_chunk(self, chunk):
+        """Hold on to a piece of the body for capture, as long as the whole
+        body could still fit in a capture segment; past that, the message
+        won't be captured, so let go of it"""
+        if self._captured_body is None:
+            return
+        if self._data_size > self.capture.segment_size:
+            self._captured_body = None
+            self._capture_too_big = True
+            metrics.capture_skipped.inc('too_big')
+            return
+        self._captured_body.append(chunk)
+
+    def _end_data(self):
+        self._receiving = False
+        self.conn.max_line_length = None
+        self._store_message()
+
+    def _cmd_bdat(self, data):
+        """RFC 3030 CHUNKING: the command line is followed by exactly size
+        bytes of message, which are read as they are (no dot-stuffing, no
+        line scanning). Those bytes have to be read even if the command is
+        refused, so the reply only goes out once they're in."""
+        bdat_match = BDAT_COMMAND.match(data)
+        if not bdat_match:
+            return False
+        size = int(bdat_match.group(1))
+        last = bool(bdat_match.group(2))
+        if not self.config.accept_mail and self._state not in (SMTP_RCPT_TO, SMTP_BDAT):
+            self._discard_chunk(size, "502 5.5.1 BDAT command is disabled")
+        elif self._state == SMTP_MAIL_FROM:
+            self._discard_chunk(size, "554 5.5.1 Error: no valid recipients")
+        elif self._state not in (SMTP_RCPT_TO, SMTP_BDAT):
+            self._discard_chunk(size, "503 5.5.1 Error: need MAIL command")
+        else:
+            if self._state == SMTP_RCPT_TO:
+                self._start_message()
+                self._state = SMTP_BDAT
+            self.conn.read_bytes(size, self._bdat_chunk, lambda: self._bdat_done(size, last))
+
+    def _discard_chunk(self, size, reply):
+        self.conn.read_bytes(size, lambda chunk: None, lambda: self._write(reply))
+        self._state = SMTP_HELO if self._state >= SMTP_HELO else SMTP_CONNECTED
+
+    def _bdat_chunk(self, chunk):
+        self._data_size += len(chunk)
+        if self._data_too_big:
+            return
+        if self.config.max_message_size and self._data_size > self.config.max_message_size:
+            self._data_too_big = True
+            self._abort_message()
+            return
+        self._capture_chunk(chunk)
+        if self._spool_file is not None and not self._spool_file.write(chunk):
+            self.conn.pause_reading()
+            self._spool_file.wait_for_drain(self.conn.resume_reading)
+
+    def _bdat_done(self, size, last):
+        if self._disconnected:
+            return
+        if last or self._data_too_big:
+            # RFC 3030: a failed chunk ends the transaction
+            self._store_message()
+        else:
+            self._write("250 2.0.0 Ok: %d octets received" % size)
+
+    def _store_message(self):
+        self._message_state['size'] = self._data_size
+        self._state = SMTP_HELO
+        if self._data_too_big:
+            metrics.messages_rejected.inc()
+            self._write("552 5.3.4 Message size exceeds fixed limit")
+            return
+        if self._spool_file is None:
+            self._message_stored(None)
+            return
+        # Replies (and so commands) have to stay in order, so nothing more
+        # is read until the message is safely in the spool
+        spool_file, self._spool_file = self._spool_file, None
+        self.conn.pause_reading()
+        spool_file.commit(lambda error: self._message_stored(error, spool_file.name))
+
+    def _message_stored(self, error, queue_id=None):
+        if self._disconnected:
+            return
+        body, self._captured_body = self._captured_body, None
+        if error is not None:
+            metrics.messages_rejected.inc()
+            self._write("451 4.3.0 Error: queue file write error")
+        else:
+            metrics.messages_accepted.inc()
+            self._message_state['queued_as'] = queue_id
+            self._finish_transaction('accepted', body, capture=not self._capture_too_big)
+            if queue_id:
+                self._write("250 2.0.0 Ok: queued as %s" % queue_id)
+            else:
+                self._write("250 2.0.0 Ok")
+        self.conn.resume_reading()
+
+    def _cmd_nested_mail(self, data):
+        if not MAIL_FROM_COMMAND.match(data):
+            return False
+        self._abort_message()
+        self._write("503 5.5.1 Error: nested MAIL command")
+        self._state = SMTP_HELO
 
     def _print_timeout(self):
+        self.close_reason = 'timeout'
+        metrics.connections_timed_out.inc()
         self._timeout_handle = None
         self._write("421 4.4.2 %s Error: timeout exceeded" % self.config.hostname, self.conn.close, False)
 
+    def summary(self):
+        """Everything worth keeping about this session, for the transaction
+        log. Times are in seconds; a transaction's 'at' is relative to the
+        start of the session."""
+        address = self.conn.address
+        return {
+            'session': self.id,
+            'peer': self.peer,
+            'port': address[1] if isinstance(address, tuple) else None,
+            'listener': self.tls_mode,
+            'helo': self.remote or None,
+            'esmtp': self._mode == 'EHLO',
+            'tls': self._encrypted,
+            'started': self.connected_at,
+            'duration': round(time.time() - self.connected_at, 3) if self.connected_at else None,
+            'commands': self.commands,
+            'responses': self.responses,
+            'transactions': self.transactions,
+            'transactions_dropped': self.transactions_dropped,
+            'end': self.close_reason,
+        }
+
     def write_help(self):
+        self._cork()
         self._write("250 Ok")
         message = [
             "HELO",
@@ -192,12 +599,44 @@ class SMTPSession(object):
             "MAIL FROM:<address>",
             "RCPT TO:<address>",
             "DATA",
+            "BDAT <size> [LAST]",
             "VRFY",
             "EXPN",
             "RSET",
         ]
-        if self.config.tls_cert:
+        if self._starttls_available:
             message.append("STARTTLS")
         for msg in message:
             self._write("250-HELP " + msg)
         self._write("250-HELP Ok")
+        self._uncork()
+
+
+def _build_command_table():
+    """Build the (state, verb) -> handler dispatch table for SMTPSession"""
+    table = {}
+    for verb, states, handler in (
+        ('QUIT', ALL_STATES, SMTPSession._cmd_quit),
+        ('RSET', ALL_STATES, SMTPSession._cmd_rset),
+        ('NOOP', ALL_STATES, SMTPSession._cmd_noop),
+        ('HELP', ALL_STATES, SMTPSession._cmd_help),
+        ('HELO', (SMTP_CONNECTED,), SMTPSession._cmd_helo),
+        ('EHLO', (SMTP_CONNECTED,), SMTPSession._cmd_ehlo),
+        # Some people don't HELO before sending commands; lame
+        ('MAIL', (SMTP_CONNECTED, SMTP_HELO), SMTPSession._cmd_mail),
+        ('VRFY', (SMTP_CONNECTED, SMTP_HELO), SMTPSession._cmd_vrfy),
+        ('EXPN', (SMTP_CONNECTED, SMTP_HELO), SMTPSession._cmd_expn),
+        ('STARTTLS', (SMTP_HELO, SMTP_MAIL_FROM), SMTPSession._cmd_starttls),
+        ('RCPT', (SMTP_MAIL_FROM, SMTP_RCPT_TO), SMTPSession._cmd_rcpt),
+        ('DATA', (SMTP_MAIL_FROM, SMTP_RCPT_TO), SMTPSession._cmd_data),
+        ('MAIL', (SMTP_MAIL_FROM, SMTP_RCPT_TO, SMTP_BDAT), SMTPSession._cmd_nested_mail),
+        # Always read the chunk, so that it isn't mistaken for commands
+        ('BDAT', ALL_STATES, SMTPSession._cmd_bdat),
+    ):
+        for state in states:
+            table[(state, verb)] = handler
+    return table
+
+
+_COMMANDS = _build_command_table()
+_VERBS = frozenset(verb for _, verb in _COMMANDS)
@@ -0,0 +1,190 @@
+import Queue
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger("spool")
+
+
+def prepare_spool_dir(directory, uid=None, gid=None):
+    """Create the tmp/ and new/ subdirectories of a spool directory, owned
+    by uid and gid (if given) so that they stay writable after dropping
+    privileges"""
+    for path in (directory, os.path.join(directory, 'tmp'), os.path.join(directory, 'new')):
+        if not os.path.isdir(path):
+            os.mkdir(path, 0755)
+            if uid or gid:
+                os.chown(path, uid if uid else -1, gid if gid else -1)
+
+
+class Spool(object):
+    """A maildir-style directory which message bodies are streamed into.
+
+    All of the file I/O happens on background threads; the IOLoop thread
+    only hands over chunks of data, and results come back to it through
+    io_loop.add_callback. Each file sticks to one thread, so its writes
+    happen in order."""
+
+    def __init__(self, directory, io_loop, chunk_size=65536, max_pending=4, threads=1):
+        self.directory = directory
+        self.io_loop = io_loop
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.hostname = socket.gethostname().replace('/', '_')
+        self._sequence = itertools.count(1)
+        self._queues = []
+        self._threads = []
+        for i in range(threads):
+            queue = Queue.Queue()
+            thread = threading.Thread(target=self._run, args=(queue,), name='spool-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    def open(self):
+        """Start a new message; returns a SpoolFile"""
+        sequence = next(self._sequence)
+        name = '%d.P%dQ%d.%s' % (int(time.time()), os.getpid(), sequence, self.hostname)
+        return SpoolFile(self, name, self._queues[sequence % len(self._queues)])
+
+    def stop(self):
+        """Finish everything queued so far, then stop the threads"""
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Error in spool thread")
+
+
+class SpoolFile(object):
+    """One message being written into the spool. Only write, wait_for_drain,
+    commit and abort may be called, and only from the IOLoop thread.
+
+    write takes strs or bytearrays. A bytearray of at least chunk_size bytes
+    is written out as it is, without copying, so the caller must not change
+    it afterwards.
+
+    Data is gathered into chunk_size pieces before being handed to the spool
+    thread. write returns False once more than max_pending chunks are
+    waiting to hit the disk; the caller should stop reading from its client
+    and call wait_for_drain. So no matter how large the message, at most
+    about (max_pending + 1) * chunk_size bytes of it are in memory."""
+
+    def __init__(self, spool, name, queue):
+        self.spool = spool
+        self.name = name
+        self.tmp_path = os.path.join(spool.directory, 'tmp', name)
+        self.path = os.path.join(spool.directory, 'new', name)
+        self.pending = 0
+        self.error = None
+        self._queue = queue
+        self._chunks = []
+        self._buffered = 0
+        self._drain_callback = None
+        self._file = None
+        self._submit(self._open)
+
+    def write(self, data):
+        if isinstance(data, bytearray) and len(data) >= self.spool.chunk_size:
+            # Already a whole chunk; hand it over as it is
+            self._submit_chunk()
+            self._submit_data(data)
+        else:
+            self._chunks.append(str(data))
+            self._buffered += len(data)
+            if self._buffered >= self.spool.chunk_size:
+                self._submit_chunk()
+        return self.pending <= self.spool.max_pending * self.spool.chunk_size
+
+    def wait_for_drain(self, callback):
+        """Call callback once the spool thread has caught up"""
+        self._drain_callback = callback
+
+    def commit(self, callback):
+        """Write out the rest of the message and move it into new/. Calls
+        callback(error) on the IOLoop thread once that's done; error is None
+        on success."""
+        self._submit_chunk()
+        self._submit(self._commit, callback)
+
+    def abort(self):
+        """Throw the message away"""
+        self._chunks = []
+        self._buffered = 0
+        self._submit(self._abort)
+
+    def _submit(self, function, *args):
+        self._queue.put((function, args))
+
+    def _submit_chunk(self):
+        if not self._chunks:
+            return
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        self._submit_data(data)
+
+    def _submit_data(self, data):
+        self.pending += len(data)
+        self._submit(self._write, data)
+
+    def _written(self, size):
+        self.pending -= size
+        if self._drain_callback and self.pending <= self.spool.max_pending * self.spool.chunk_size:
+            callback, self._drain_callback = self._drain_callback, None
+            callback()
+
+    # Everything below runs on a spool thread
+
+    def _open(self):
+        try:
+            self._file = open(self.tmp_path, 'wb')
+        except IOError, e:
+            self.error = e
+
+    def _write(self, data):
+        if self._file is not None and self.error is None:
+            try:
+                self._file.write(data)
+            except IOError, e:
+                self.error = e
+        self.spool.io_loop.add_callback(lambda: self._written(len(data)))
+
+    def _commit(self, callback):
+        error = self.error
+        if self._file is not None:
+            try:
+                self._file.close()
+                if error is None:
+                    os.rename(self.tmp_path, self.path)
+            except (IOError, OSError), e:
+                error = e
+        if error is not None:
+            log.error("Could not spool %s: %s", self.name, error)
+            self._unlink()
+        self.spool.io_loop.add_callback(lambda: callback(error))
+
+    def _abort(self):
+        if self._file is not None:
+            self._file.close()
+        self._unlink()
+
+    def _unlink(self):
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
@@ -0,0 +1,165 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import time
+
+
+class Supervisor(object):
+    """Pre-fork a fixed number of worker processes and keep them running.
+
+    worker_main is called in each child with the worker's index and should
+    only return once the worker is done; the child exits right after."""
+
+    # Minimum time (in seconds) between two starts of the same worker, so
+    # that a worker which dies on startup doesn't turn into a fork bomb
+    respawn_delay = 1
+
+    def __init__(self, num_workers, worker_main):
+        self.num_workers = num_workers
+        self.worker_main = worker_main
+        self.workers = {}
+        self._started = {}
+        self._running = False
+        self._stop_signal = None
+        self._callbacks = []
+        self._wakeup = None
+
+    def add_callback_from_signal(self, callback):
+        """Call callback from run()'s loop, outside of the signal handler
+        this is called from (the signal itself wakes the loop up)"""
+        self._callbacks.append(callback)
+
+    def _run_callbacks(self):
+        while self._callbacks:
+            callback = self._callbacks.pop(0)
+            try:
+                callback()
+            except Exception:
+                logging.exception("Exception in supervisor callback %r", callback)
+
+    def spawn(self, index):
+        not_before = self._started.get(index, 0) + self.respawn_delay
+        # Signals cut sleeps short
+        while time.time() < not_before:
+            time.sleep(not_before - time.time())
+        self._started[index] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            # The child is not anybody's supervisor
+            self.workers = {}
+            self._running = False
+            self._callbacks = []
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+            status = 0
+            try:
+                self.worker_main(index)
+            except SystemExit, e:
+                status = e.code or 0
+            except Exception:
+                logging.exception("Worker %d crashed", index)
+                status = 1
+            os._exit(status)
+        self.workers[pid] = index
+        logging.info("Started worker %d as pid %d", index, pid)
+        if self._stop_signal is not None:
+            # We were told to stop while forking this one
+            self._signal_worker(pid, self._stop_signal)
+
+    def run(self):
+        """Start all of the workers, then reap and restart them until stop
+        is called. Returns once every worker has exited."""
+        self._running = True
+        self._stop_signal = None
+        # Python only runs signal handlers between bytecodes, so one which
+        # arrives just before select() would wait until something else
+        # woke us up; with set_wakeup_fd, every signal also writes to the
+        # pipe from C. SIGCHLD needs a handler for that.
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        old_wakeup = signal.set_wakeup_fd(self._wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        try:
+            for index in range(self.num_workers):
+                if not self._running:
+                    break
+                self.spawn(index)
+            while self.workers:
+                self._run_callbacks()
+                if not self._reap():
+                    break
+                if self.workers:
+                    self._sleep()
+        finally:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(old_wakeup)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def _sleep(self):
+        try:
+            select.select([self._wakeup[0]], [], [])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _reap(self):
+        """Collect every worker that has exited, restarting them if we're
+        still running. Returns False if there are no children left."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    return False
+                raise
+            if pid == 0:
+                return True
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+            if self._running:
+                logging.warn("Worker %d (pid %d) died with status %d; restarting", index, pid, status)
+                self.spawn(index)
+            else:
+                logging.info("Worker %d (pid %d) exited", index, pid)
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def signal_workers(self, signum):
+        for pid in self.workers.keys():
+            self._signal_worker(pid, signum)
+
+    def stop(self):
+        """Stop restarting workers and ask the running ones to exit"""
+        self._running = False
+        self._stop_signal = signal.SIGTERM
+        self.signal_workers(signal.SIGTERM)
+
+    def drain(self):
+        """Stop restarting workers and ask the running ones to finish their
+        sessions (see SMTPD._drain) and exit"""
+        self._running = False
+        self._stop_signal = signal.SIGUSR2
+        self.signal_workers(signal.SIGUSR2)
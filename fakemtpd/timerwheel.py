@@ -0,0 +1,73 @@
+import time
+
+
+class TimerWheel(object):
+    """Coarse-grained hashed timing wheel for idle timeouts.
+
+    Anything with a `deadline` attribute (seconds since the epoch) and a
+    `timed_out` method can be scheduled. Pushing a deadline back is just an
+    assignment to `deadline`: when the slot the object was filed under comes
+    up, it gets re-filed under its new deadline instead of firing, so
+    activity never touches the wheel itself. `advance` should be called
+    every `resolution` seconds to fire whatever has expired.
+
+    `now` is the time of the last call to `advance`, which is good enough
+    (and much cheaper than time.time()) for computing new deadlines."""
+
+    def __init__(self, resolution=1.0, num_slots=64, now=None):
+        self.resolution = float(resolution)
+        self.num_slots = num_slots
+        self.now = time.time() if now is None else now
+        self._tick = int(self.now / self.resolution)
+        self._slots = [set() for _ in range(num_slots)]
+        self._slot_of = {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, timer):
+        return timer in self._slot_of
+
+    def schedule(self, timer):
+        """Start watching timer.deadline. A no-op if timer is already scheduled."""
+        if timer in self._slot_of:
+            return
+        self._file(timer)
+
+    def cancel(self, timer):
+        slot = self._slot_of.pop(timer, None)
+        if slot is not None:
+            self._slots[slot].discard(timer)
+
+    def _file(self, timer):
+        tick = int(timer.deadline / self.resolution) + 1
+        if tick <= self._tick:
+            tick = self._tick + 1
+        slot = tick % self.num_slots
+        self._slots[slot].add(timer)
+        self._slot_of[timer] = slot
+
+    def advance(self, now=None):
+        """Move the wheel up to now, calling timed_out() on every expired timer"""
+        self.now = time.time() if now is None else now
+        target = int(self.now / self.resolution)
+        # After a long stall every slot is due, but each only needs visiting once
+        ticks = min(target - self._tick, self.num_slots)
+        self._tick = target - ticks
+        expired = []
+        for _ in xrange(ticks):
+            self._tick += 1
+            slot = self._tick % self.num_slots
+            timers = self._slots[slot]
+            if not timers:
+                continue
+            self._slots[slot] = set()
+            for timer in timers:
+                del self._slot_of[timer]
+                if timer.deadline <= self.now:
+                    expired.append(timer)
+                else:
+                    self._file(timer)
+        for timer in expired:
+            timer.timed_out()
+        return len(expired)
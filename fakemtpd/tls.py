@@ -0,0 +1,83 @@
+import logging
+import ssl
+
+from fakemtpd.config import Config
+
+log = logging.getLogger("tls")
+
+# Not exported by the ssl module before Python 3.6
+OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+
+
+class ServerContext(object):
+    """Singleton holding the server's TLS state. Use the instance method to
+    get handles to it.
+
+    Where the ssl module has SSLContext, the certificate and key are loaded
+    once (at startup, and again on reload) into a single context shared by
+    every session, which also gives clients session resumption: the context
+    keeps a session cache, and hands out session tickets. Ticket keys are
+    generated when the context is created, so workers forked after startup
+    can resume each other's sessions. A reload starts over in every process
+    separately, though: from then on, each worker only takes its own
+    tickets (and workers respawned by the supervisor the supervisor's),
+    until they are all restarted.
+
+    Older Pythons fall back to handing the file names to ssl.wrap_socket,
+    which reads them on every handshake."""
+
+    def __init__(self):
+        self.context = None
+
+    @classmethod
+    def instance(cls):
+        """Get a handle to the ServerContext singleton"""
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def config(self):
+        # Always the current snapshot, so reload() picks up new files
+        return Config.instance()
+
+    @property
+    def available(self):
+        return bool(self.config.tls_cert)
+
+    def build(self):
+        """Build a context from the current config. Raises on bad
+        certificates or keys."""
+        context = ssl.SSLContext(self.config.ssl_version)
+        context.load_cert_chain(self.config.tls_cert, self.config.tls_key)
+        if self.config.tls_session_tickets:
+            context.options &= ~OP_NO_TICKET
+        else:
+            context.options |= OP_NO_TICKET
+        return context
+
+    def reload(self):
+        """(Re)build the shared context. If that fails, the old one is kept
+        and the error is returned."""
+        if not self.available or not hasattr(ssl, 'SSLContext'):
+            self.context = None
+            return None
+        try:
+            self.context = self.build()
+        except (IOError, ssl.SSLError), e:
+            log.error("Could not load TLS certificate %s: %s", self.config.tls_cert, e)
+            return "Could not load TLS certificate %s: %s" % (self.config.tls_cert, e)
+        log.info("Loaded TLS certificate %s", self.config.tls_cert)
+        return None
+
+    def starttls_options(self):
+        """Keyword arguments for Connection.starttls"""
+        if self.context is None and hasattr(ssl, 'SSLContext'):
+            self.reload()
+        if self.context is not None:
+            return {'ssl_context': self.context}
+        return {
+            'keyfile': self.config.tls_key,
+            'certfile': self.config.tls_cert,
+            'ssl_version': self.config.ssl_version,
+        }
@@ -0,0 +1,71 @@
+import errno
+import json
+import logging
+import os
+
+log = logging.getLogger("txnlog")
+
+
+def dumps(entry):
+    """entry as compact JSON"""
+    try:
+        return json.dumps(entry, separators=(',', ':'))
+    except UnicodeDecodeError:
+        # Clients can send anything at all as an address
+        return json.dumps(entry, separators=(',', ':'), encoding='latin-1')
+
+
+class TransactionLog(object):
+    """Append-only log of finished sessions, one JSON object per line.
+
+    Lines are buffered and written out with a single write() once
+    flush_bytes have built up, or whenever flush is called (SMTPD does
+    that on a timer). The file is opened with O_APPEND, so workers can share
+    it without their lines getting mixed up."""
+
+    def __init__(self, path, flush_bytes=65536):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.fd = None
+        self._buffer = []
+        self._size = 0
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    def reopen(self):
+        """Flush, then start writing to a fresh file at self.path (for log
+        rotation)"""
+        self.flush()
+        os.close(self.fd)
+        self.open()
+
+    def record(self, entry):
+        line = dumps(entry) + '\n'
+        self._buffer.append(line)
+        self._size += len(line)
+        if self._size >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                log.error("Could not write to transaction log %s: %s", self.path, e)
+                return
+            data = data[written:]
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
@@ -18,5 +18,5 @@ setup(
     ],
     requires=["tornado (>=1.0)", "lockfile (>=0.7)", "yaml", "daemon"],
     packages=["fakemtpd"],
-    scripts=["bin/fakemtpd"],
+    scripts=["bin/fakemtpd", "bin/fakemtpd-bench"],
 )
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+
+import tornado.ioloop
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.capture import CaptureStore
+from fakemtpd.metrics import Metrics
+
+
+class CaptureStoreTestCase(TestCase):
+
+    @setup
+    def create_store(self):
+        self.directory = tempfile.mkdtemp()
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.store = self.open_store()
+
+    @teardown
+    def remove_store(self):
+        self.store.close()
+        self.io_loop.close()
+        shutil.rmtree(self.directory)
+
+    def open_store(self, **kwargs):
+        kwargs.setdefault('segment_size', 1024)
+        return CaptureStore(self.directory, self.io_loop, **kwargs)
+
+    def reopen(self, **kwargs):
+        self.store.close()
+        self.store = self.open_store(**kwargs)
+
+    def run_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.io_loop.add_timeout(time.time() + 0.01, self.io_loop.stop)
+            self.io_loop.start()
+        assert condition()
+
+    def append(self, *args, **kwargs):
+        """Append once the store has its next segment ready"""
+        self.run_until(lambda: self.store._spare is not None)
+        return self.store.append(*args, **kwargs)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def test_append_and_get(self):
+        record_id = self.append('a@example.com', ['b@example.net', 'c@example.net'], ['Subject: hi\r\n', bytearray('\r\nbody\r\n')],
+                                session=7, timestamp=1000.5)
+        message = self.store.get(record_id)
+        assert_equal(message.sender, 'a@example.com')
+        assert_equal(message.recipients, ['b@example.net', 'c@example.net'])
+        assert_equal(message.session, 7)
+        assert_equal(message.timestamp, 1000.5)
+        # Bodies point straight into the segment
+        assert isinstance(message.body, buffer)
+        assert_equal(str(message.body), 'Subject: hi\r\n\r\nbody\r\n')
+        assert_equal(self.store.get(record_id + 1), None)
+        empty = self.store.get(self.append('a@example.com', ['b@example.net']))
+        assert_equal(str(empty.body), '')
+
+    def test_find(self):
+        first = self.append('a@example.com', ['b@example.net'], timestamp=100)
+        second = self.append('A@example.com', ['c@example.net'], timestamp=200)
+        third = self.append('d@example.com', ['B@example.net', 'c@example.net'], timestamp=300)
+        assert_equal(self.store.find(sender='a@EXAMPLE.com'), [first, second])
+        assert_equal(self.store.find(recipient='b@example.net'), [first, third])
+        assert_equal(self.store.find(sender='a@example.com', recipient='c@example.net'), [second])
+        assert_equal(self.store.find(since=200), [second, third])
+        assert_equal(self.store.find(since=100, until=300), [first, second])
+        assert_equal(self.store.find(recipient='c@example.net', since=250), [third])
+        assert_equal(self.store.find(limit=2), [first, second])
+        assert_equal(self.store.find(sender='nobody@example.com'), [])
+
+    def test_rotate_and_reload(self):
+        ids = [self.append('a@example.com', ['b@example.net'], 'x' * 200) for _ in range(20)]
+        assert len(self.segments()) > 3, self.segments()
+        self.store.delete(ids[3])
+        self.reopen()
+        assert_equal(len(self.store), 19)
+        assert_equal(self.store.find(sender='a@example.com'), ids[:3] + ids[4:])
+        assert_equal(str(self.store.get(ids[-1]).body), 'x' * 200)
+        # New records carry on after the old ones
+        assert_equal(self.append('a@example.com', ['b@example.net']), ids[-1] + 1)
+
+    def test_skipped(self):
+        skipped = Metrics.instance().capture_skipped
+        too_big, no_segment = skipped.values.get('too_big', 0), skipped.values.get('no_segment', 0)
+        assert_equal(self.append('a@example.com', ['b@example.net'], 'x' * 5000), None)
+        assert_equal(skipped.values.get('too_big', 0), too_big + 1)
+        # The next segment is created in the background, never right away
+        self.append('a@example.com', ['b@example.net'], 'x' * 600)
+        assert_equal(self.store.append('a@example.com', ['b@example.net'], 'x' * 600), None)
+        assert_equal(skipped.values.get('no_segment', 0), no_segment + 1)
+        # Smaller records still go in the current one meanwhile
+        record_id = self.store.append('a@example.com', ['b@example.net'], 'x' * 100)
+        assert_equal(len(self.store.get(record_id).body), 100)
+        assert_equal(len(self.store), 2)
+
+    def test_compaction(self):
+        # Three of these fit in a segment
+        ids = [self.append('a@example.com', ['b@example.net'], str(i) * 200) for i in range(10)]
+        segment = self.store._segments[self.store._segment_of[0]]
+        self.store.delete(ids[0])
+        self.store.delete(ids[1])
+        self.run_until(lambda: self.store._segments[segment.number] is not segment)
+        compacted = self.store._segments[segment.number]
+        assert_equal(compacted.used, segment.used / 3)
+        assert_equal(os.path.getsize(compacted.path), compacted.used)
+        assert_equal(str(self.store.get(ids[2]).body), '2' * 200)
+        assert_equal(self.store.find(limit=2), ids[2:4])
+        self.reopen()
+        assert_equal(str(self.store.get(ids[2]).body), '2' * 200)
+        assert_equal(len(self.store), 8)
+
+    def test_max_segments(self):
+        self.reopen(max_segments=2)
+        ids = [self.append('a@example.com', ['b@example.net'], 'x' * 400) for _ in range(10)]
+        assert_equal(len(self.store._segments), 2)
+        assert_equal(self.store.get(ids[0]), None)
+        remaining = self.store.find(recipient='b@example.net')
+        assert_equal(remaining, ids[-len(remaining):])
+        assert_equal(len(self.store), len(remaining))
+
+
+if __name__ == "__main__":
+    run()
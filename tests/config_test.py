@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 
+import os
+import shutil
 import ssl
+import tempfile
 from cStringIO import StringIO
 
 import fakemtpd.config
+from fakemtpd.listener import Listener
 
-from testify import TestCase, assert_equal, assert_is, run
+from testify import TestCase, assert_equal, assert_is, run, setup, teardown
 
 
 def _config_with(config_string):
@@ -35,5 +39,59 @@ class ConfigTestCase(TestCase):
         assert_equal(ssl.PROTOCOL_TLSv1, c.ssl_version)
 
 
+class ReloadTestCase(TestCase):
+
+    @setup
+    def create_config(self):
+        self.saved = fakemtpd.config.Config.instance()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'fakemtpd.yaml')
+        self.write('hostname: one\ntimeout: 10\nport: 2525\n')
+        self.config = fakemtpd.config.Config()
+        self.config.read_file(self.path)
+
+    @teardown
+    def restore_config(self):
+        fakemtpd.config.Config._instance = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def test_reload(self):
+        self.write('hostname: two\ntimeout: 20\nport: 2626\n')
+        assert_equal(self.config.reload(), None)
+        config = fakemtpd.config.Config.instance()
+        assert_equal(config.hostname, 'two')
+        assert_equal(config.timeout, 20)
+        # The port needs a rebind
+        assert_equal(config.port, 2525)
+        assert_equal(config.deferred, ['port'])
+        # Whoever has the old snapshot still sees it as it was
+        assert_equal(self.config.hostname, 'one')
+
+    def test_reload_invalid(self):
+        fakemtpd.config.Config._instance = self.config
+        self.write('hostname: two\nmax_message_size: -1\n')
+        assert self.config.reload().startswith('max_message_size')
+        self.write('hostname: [two\n')
+        assert self.config.reload().startswith('Could not read')
+        assert_is(fakemtpd.config.Config.instance(), self.config)
+
+    def test_bound_listeners(self):
+        self.write('port: 0\n')
+        self.config = fakemtpd.config.Config()
+        self.config.read_file(self.path)
+        listener = Listener('inet', '127.0.0.1', 0, 'plain')
+        listener.bind(5)
+        self.config.merge_listeners([listener])
+        listener.close()
+        assert_equal(self.config.reload(), None)
+        config = fakemtpd.config.Config.instance()
+        assert_equal(config.deferred, [])
+        assert_equal(config.port, listener.port)
+
+
 if __name__ == "__main__":
     run()
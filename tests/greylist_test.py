@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.greylist import Greylist, TripletTable
+
+
+class TripletTableTestCase(TestCase):
+
+    def test_set_and_get(self):
+        table = TripletTable(8)
+        # These all want the same slot
+        for key in (3, 11, 19):
+            table.set(key, key, key + 1)
+        table.set(11, 0, 50)
+        assert_equal(table.count, 3)
+        assert_equal(table.get(3), (3, 4))
+        assert_equal(table.get(11), (0, 50))
+        assert_equal(table.get(19), (19, 20))
+        assert_equal(table.get(27), None)
+        assert_equal(sorted(table.items()), [(3, 3, 4), (11, 0, 50), (19, 19, 20)])
+
+
+class GreylistTestCase(TestCase):
+
+    @setup
+    def create_directory(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'greylist')
+
+    @teardown
+    def remove_directory(self):
+        shutil.rmtree(self.directory)
+
+    def test_greylisting(self):
+        greylist = Greylist(delay=300, retry_window=3600, ttl=86400, max_entries=64)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1000), 300)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1100), 200)
+        # Another host on the same network is the same peer
+        assert_equal(greylist.check('192.0.2.2', 'A@example.com', 'b@example.net', now=1300), None)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=50000), None)
+        # But other triplets are new
+        assert_equal(greylist.check('198.51.100.1', 'a@example.com', 'b@example.net', now=1300), 300)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'c@example.net', now=1300), 300)
+
+    def test_expiry(self):
+        greylist = Greylist(delay=300, retry_window=3600, ttl=86400, max_entries=64, by_network=False)
+        greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1000)
+        # Too late to retry
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=5000), 300)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=5300), None)
+        # Not seen for longer than the ttl
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=100000), 300)
+        assert_equal(greylist.check('192.0.2.2', 'a@example.com', 'b@example.net', now=100000), 300)
+
+    def test_bounded(self):
+        greylist = Greylist(delay=1, max_entries=64)
+        greylist.check('192.0.2.1', 'kept@example.com', 'b@example.net', now=1000)
+        greylist.check('192.0.2.1', 'kept@example.com', 'b@example.net', now=1001)
+        for i in range(1000):
+            greylist.check('192.0.2.1', '%d@example.com' % i, 'b@example.net', now=1002)
+            # Triplets in use keep being carried over
+            assert_equal(greylist.check('192.0.2.1', 'kept@example.com', 'b@example.net', now=1002), None)
+            assert len(greylist) <= 64
+        assert_equal(greylist.young.capacity, 64)
+        assert_equal(greylist.check('192.0.2.1', '0@example.com', 'b@example.net', now=1002), 1)
+
+    def test_snapshot(self):
+        greylist = Greylist(delay=300, max_entries=64, path=self.path)
+        greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1000)
+        greylist.save()
+        greylist = Greylist(delay=300, max_entries=64, path=self.path)
+        assert_equal(len(greylist), 1)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1300), None)
+        greylist.save()
+        # Read into tables of another size
+        greylist = Greylist(delay=300, max_entries=1000, path=self.path)
+        assert_equal(greylist.young.capacity, 1024)
+        assert_equal(greylist.check('192.0.2.1', 'a@example.com', 'b@example.net', now=1400), None)
+
+    def test_bad_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('nonsense')
+        greylist = Greylist(max_entries=64, path=self.path)
+        assert_equal(len(greylist), 0)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+import os
+import socket
+import sys
+import threading
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.handoff import Handoff
+from fakemtpd.listener import Listener
+
+# Stands in for the replacement process: takes the listeners over, then
+# answers one connection on the first with what it received
+TAKEOVER = '''
+import os
+from fakemtpd.handoff import HANDOFF_ENV, Takeover
+takeover = Takeover(os.environ[HANDOFF_ENV])
+listeners = takeover.listeners()
+takeover.ready()
+listener = listeners[0]
+listener.sock.setblocking(1)
+connection, _ = listener.accept()
+connection.sendall('%s %d %d\\n' % (listener.mode, listener.port, len(listeners)))
+connection.close()
+'''
+
+
+class HandoffTestCase(TestCase):
+
+    @setup
+    def bind(self):
+        self.listener = Listener('inet', '127.0.0.1', 0, 'starttls')
+        self.listener.bind(5)
+        self.finished = threading.Event()
+        self.results = []
+
+    @teardown
+    def close(self):
+        self.listener.close()
+
+    def release(self):
+        self.results.append('release')
+
+    def handed_off(self):
+        self.results.append('handed_off')
+        self.finished.set()
+
+    def failed(self):
+        self.results.append('failed')
+        self.finished.set()
+
+    def test_hand_off(self):
+        handoff = Handoff([self.listener], self.release, self.handed_off, self.failed, timeout=10)
+        handoff.start([sys.executable, '-c', TAKEOVER], cwd=os.getcwd())
+        self.finished.wait(10)
+        assert_equal(self.results, ['release', 'handed_off'])
+        # The socket lives on in the new process
+        port = self.listener.port
+        self.listener.close()
+        client = socket.create_connection(('127.0.0.1', port), 10)
+        assert_equal(client.makefile().readline(), 'starttls %d 1\n' % port)
+        client.close()
+        assert_equal(handoff.process.wait(), 0)
+
+    def test_replacement_fails(self):
+        handoff = Handoff([self.listener], self.release, self.handed_off, self.failed, timeout=0.5)
+        handoff.start([sys.executable, '-c', 'pass'])
+        self.finished.wait(10)
+        assert_equal(self.results, ['failed'])
+        assert_equal(handoff.process.wait(), 0)
+
+
+if __name__ == "__main__":
+    run()
@@ -2,52 +2,86 @@ from __future__ import absolute_import
 
 import functools
 import os
+import shutil
 import signal
 import socket
+import subprocess
+import sys
+import tempfile
+import time
 
 import tornado.ioloop
 
-from testify import TestCase, assert_equal, run
+from testify import TestCase, assert_equal, run, setup, teardown
 
 import fakemtpd.server
+from fakemtpd.listener import Listener
 
 
 class PartialMockServer(fakemtpd.server.SMTPD):
-    def create_loop(self, sock):
-        self._saved_socket = sock
+    def create_loop(self, listeners):
+        self._saved_listeners = listeners
         return self
 
     def _start(self, *args):
         pass
 
     def stop(self):
-        if hasattr(self, '_io_loop'):
-            self._io_loop.stop()
+        # A SIGTERM can come in before the loop starts, and then start()
+        # returns right away
+        tornado.ioloop.IOLoop.instance().stop()
 
     def _actually_start(self):
         io_loop = tornado.ioloop.IOLoop.instance()
-        new_connection_handler = functools.partial(self.connection_ready, io_loop, self._saved_socket)
-        io_loop.add_handler(self._saved_socket.fileno(), new_connection_handler, io_loop.READ)
-        self._io_loop = io_loop
+        for listener in self._saved_listeners:
+            new_connection_handler = functools.partial(self.connection_ready, io_loop, listener)
+            io_loop.add_handler(listener.fileno(), new_connection_handler, io_loop.READ)
+        self.start_timers(io_loop)
+        self.start_spool(io_loop)
         io_loop.start()
 
 
-class ServerManager(object):
+class EndlessListener(object):
+    """A listening socket with an infinite backlog"""
+    mode = 'plain'
+
     def __init__(self):
+        self.accepted = []
+
+    def accept(self):
+        ours, theirs = socket.socketpair()
+        self.accepted.append(theirs)
+        return ours, ('127.0.0.1', len(self.accepted))
+
+
+class ServerManager(object):
+    def __init__(self, extra_config=None):
         self.server = PartialMockServer()
         self.server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
+        if extra_config:
+            self.server.config.read_file_obj(extra_config)
         self.server.run(handle_opts=False)
 
     def __enter__(self):
+        ready_r, ready_w = os.pipe()
         self.pid = os.fork()
         if self.pid == 0:
+            # Python drops signals which come in before the child is running
+            # its own code, so __exit__ waits for the go-ahead
+            os.close(ready_r)
+            os.write(ready_w, '.')
+            os.close(ready_w)
             self.server._actually_start()
             os._exit(0)
         else:
+            os.close(ready_w)
+            os.read(ready_r, 1)
+            os.close(ready_r)
             return self.server.config
 
     def __exit__(self, *args):
         os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
 
 
 class IntegrationTest(TestCase):
@@ -56,6 +90,76 @@ class IntegrationTest(TestCase):
         self.server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
         self.server.run(handle_opts=False)
 
+    def test_accept_batch(self):
+        server = PartialMockServer()
+        server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
+        server.config.read_file_obj('accept_batch: 3\ntcp_nodelay: false')
+        listener = EndlessListener()
+        # Not the shared instance: that would leak into the forked servers
+        io_loop = tornado.ioloop.IOLoop()
+        server.connection_ready(io_loop, listener, None, io_loop.READ)
+        assert_equal(len(listener.accepted), 3)
+        assert_equal(len(server.connections), 3)
+        for session in list(server.connections):
+            session.conn.close()
+        assert_equal(len(server.connections), 0)
+        io_loop.close()
+
+    def test_max_sessions(self):
+        server = PartialMockServer()
+        server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
+        server.config.read_file_obj('accept_batch: 5\ntcp_nodelay: false\nmax_sessions: 3')
+        listener = EndlessListener()
+        io_loop = tornado.ioloop.IOLoop()
+        server.connection_ready(io_loop, listener, None, io_loop.READ)
+        assert_equal(len(server.connections), 3)
+        for sock in listener.accepted[3:]:
+            assert_equal(sock.recv(1024), '421 4.3.2 %s Service not available, closing transmission channel\r\n' % server.config.hostname)
+        for session in list(server.connections):
+            session.conn.close()
+        io_loop.close()
+
+    def test_rate_limited_connections(self):
+        server = PartialMockServer()
+        server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
+        server.config.read_file_obj('accept_batch: 5\ntcp_nodelay: false\nip_max_sessions: 2')
+        server.start_rate_limiter()
+        listener = EndlessListener()
+        io_loop = tornado.ioloop.IOLoop()
+        server.connection_ready(io_loop, listener, None, io_loop.READ)
+        assert_equal(len(server.connections), 2)
+        # The rest are turned away without a session
+        for sock in listener.accepted[2:]:
+            assert sock.recv(1024).startswith('421 4.7.0 ')
+            assert_equal(sock.recv(1024), '')
+        for session in list(server.connections):
+            session.conn.close()
+        assert_equal(server.rate_limiter.sessions, ({}, {}))
+        io_loop.close()
+
+    def test_drain(self):
+        server = PartialMockServer()
+        server.config.read_file(os.path.join(os.path.dirname(__file__), 'data', 'mock_config.yaml'))
+        server.config.read_file_obj('tcp_nodelay: false')
+        stopped = []
+        server.on_stop(lambda: stopped.append(True))
+        listener = Listener('inet', '127.0.0.1', 0, 'plain')
+        listener.bind(5)
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.add_handler(listener.fileno(), functools.partial(server.connection_ready, io_loop, listener), io_loop.READ)
+        server.listeners = [listener]
+        client = socket.create_connection(('127.0.0.1', listener.port))
+        # The connection which was already queued up still gets a session
+        server._drain(io_loop)
+        assert_equal(listener.sock, None)
+        assert_equal(len(server.connections), 1)
+        assert_equal(stopped, [])
+        for session in list(server.connections):
+            session.conn.close()
+        assert_equal(stopped, [True])
+        client.close()
+        io_loop.close()
+
     def test_listen(self):
         with ServerManager() as config:
             sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
@@ -82,9 +186,162 @@ class IntegrationTest(TestCase):
             assert_equal("220 mock_hostname SMTP FakeMTPD\r\n", data)
             sock.send("EHLO google.com\r\n")
             data = sock.recv(1024)
-            assert_equal("250-mock_hostname\r\n", data)
+            assert_equal("250-mock_hostname\r\n250 PIPELINING\r\n", data)
             sock.send("QUIT")
             sock.close()
 
+    def test_pipelining(self):
+        with ServerManager() as config:
+            sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            sock.connect((config.address, config.port))
+            data = sock.recv(1024)
+            assert_equal("220 mock_hostname SMTP FakeMTPD\r\n", data)
+            sock.send("EHLO google.com\r\n")
+            sock.recv(1024)
+            sock.send("NOOP\r\nMAIL FROM:<a@google.com>\r\nRSET\r\nQUIT\r\nNOOP\r\n")
+            data = sock.recv(1024)
+            assert_equal("250 2.0.0 Ok\r\n250 2.1.0 Ok\r\n250 2.0.0 Ok\r\n221 2.0.0 Bye\r\n", data)
+            assert_equal("", sock.recv(1024))
+            sock.close()
+
+    def test_multiple_listeners(self):
+        listeners = 'listeners:\n- {address: 127.0.0.1, port: 0}\n- {address: 127.0.0.1, port: 0}\n'
+        with ServerManager(listeners) as config:
+            assert_equal(len(config.listeners), 2)
+            for listener in config.listeners:
+                sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+                sock.connect((listener['address'], listener['port']))
+                assert_equal("220 mock_hostname SMTP FakeMTPD\r\n", sock.recv(1024))
+                sock.close()
+
+    def test_bdat(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            with ServerManager('accept_mail: true\nspool_dir: %s\n' % spool_dir) as config:
+                sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+                sock.connect((config.address, config.port))
+                sock.recv(1024)
+                sock.send("EHLO google.com\r\n")
+                sock.recv(1024)
+                body = ''.join(chr(i % 256) for i in range(200000))
+                # The first chunk arrives along with the commands; most of the
+                # second one is received straight into the read buffers
+                sock.sendall("MAIL FROM:<a@google.com>\r\nRCPT TO:<b@example.com>\r\n"
+                             "BDAT 4\r\nHi\r\nBDAT %d LAST\r\n%sQUIT\r\n" % (len(body), body))
+                data = ''
+                while True:
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        break
+                    data += chunk
+                sock.close()
+            replies = data.split('\r\n')
+            assert_equal(replies[:3], ["250 2.1.0 Ok", "250 2.1.5 Ok", "250 2.0.0 Ok: 4 octets received"])
+            assert replies[3].startswith("250 2.0.0 Ok: queued as "), replies
+            assert_equal(replies[4:], ["221 2.0.0 Bye", ""])
+            with open(os.path.join(spool_dir, 'new', replies[3].split()[-1])) as f:
+                assert f.read().endswith("\r\nHi\r\n" + body)
+        finally:
+            shutil.rmtree(spool_dir)
+
+
+class WorkersTest(TestCase):
+    """Runs the real thing, with a supervisor and two workers"""
+
+    @setup
+    def start_server(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'fakemtpd.yaml')
+        self.policy = os.path.join(self.tmpdir, 'recipients')
+        self.write_policy('reject')
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.write_config('one')
+        script = os.path.join(os.path.dirname(__file__), '..', 'bin', 'fakemtpd')
+        self.process = subprocess.Popen([sys.executable, script, '-c', self.path])
+
+    @teardown
+    def stop_server(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, hostname):
+        with open(self.path, 'w') as f:
+            f.write('address: 127.0.0.1\nport: %d\nworkers: 2\nhostname: %s\nrecipient_policy: %s\n' % (self.port, hostname, self.policy))
+
+    def write_policy(self, action):
+        with open(self.policy, 'w') as f:
+            f.write('example.com %s\n' % action)
+
+    def wait_for_banner(self, banner):
+        deadline = time.time() + 10
+        while True:
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port), 1)
+                data = sock.recv(1024)
+                sock.close()
+            except socket.error:
+                data = None
+            if data == banner:
+                return
+            assert time.time() < deadline, data
+            time.sleep(0.05)
+
+    def wait_for_rcpt_reply(self, code):
+        deadline = time.time() + 10
+        while True:
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port), 1)
+                sock.recv(1024)
+                sock.send("HELO google.com\r\n")
+                sock.recv(1024)
+                sock.send("MAIL FROM:<a@google.com>\r\n")
+                sock.recv(1024)
+                sock.send("RCPT TO:<b@example.com>\r\n")
+                data = sock.recv(1024)
+                sock.close()
+            except socket.error:
+                data = ''
+            if data.startswith(code + ' '):
+                return
+            assert time.time() < deadline, data
+            time.sleep(0.05)
+
+    def workers(self):
+        return [int(pid) for pid in subprocess.check_output(['ps', '-o', 'pid=', '--ppid', str(self.process.pid)]).split()]
+
+    def respawn_workers(self):
+        old_workers = self.workers()
+        assert_equal(len(old_workers), 2)
+        for pid in old_workers:
+            os.kill(pid, signal.SIGKILL)
+        deadline = time.time() + 10
+        while set(self.workers()) & set(old_workers) or len(self.workers()) < 2:
+            assert time.time() < deadline, self.workers()
+            time.sleep(0.05)
+
+    def test_respawned_workers_see_reloaded_config(self):
+        self.wait_for_banner("220 one SMTP FakeMTPD\r\n")
+        self.write_config('two')
+        self.process.send_signal(signal.SIGHUP)
+        self.wait_for_banner("220 two SMTP FakeMTPD\r\n")
+        self.respawn_workers()
+        # Only the new workers are left to answer
+        for _ in range(10):
+            self.wait_for_banner("220 two SMTP FakeMTPD\r\n")
+
+    def test_respawned_workers_see_reloaded_policy(self):
+        self.wait_for_rcpt_reply('554')
+        self.write_policy('tempfail')
+        self.process.send_signal(signal.SIGHUP)
+        self.wait_for_rcpt_reply('450')
+        self.respawn_workers()
+        for _ in range(10):
+            self.wait_for_rcpt_reply('450')
+
+
 if __name__ == "__main__":
     run()
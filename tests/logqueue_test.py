@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from testify import TestCase, assert_equal, assert_in, run, setup, teardown
+
+from fakemtpd.logqueue import QueuedHandler
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, gate=None):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.closed = False
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate:
+            self.gate.wait()
+        self.messages.append(record.getMessage())
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
+
+
+class QueuedHandlerTestCase(TestCase):
+
+    @setup
+    def create_logger(self):
+        self.logger = logging.getLogger('logqueue_test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = None
+
+    @teardown
+    def remove_handler(self):
+        if self.handler:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    def use(self, target, maxsize=100):
+        self.handler = QueuedHandler(target, maxsize)
+        self.logger.addHandler(self.handler)
+
+    def test_records_arrive_in_order(self):
+        target = ListHandler()
+        self.use(target)
+        for i in range(10):
+            self.logger.info('record %d', i)
+        self.handler.flush()
+        assert_equal(target.messages, ['record %d' % i for i in range(10)])
+
+    def test_overflow_is_dropped_and_reported(self):
+        gate = threading.Event()
+        target = ListHandler(gate)
+        self.use(target, maxsize=2)
+        try:
+            for i in range(10):
+                self.logger.info('record %d', i)
+        finally:
+            gate.set()
+        self.handler.flush()
+        # Up to two records may already have been taken off the queue (to
+        # get stuck in the gate), and two more fit in it
+        assert self.handler.dropped in (6, 7, 8), self.handler.dropped
+        assert_equal(len(target.messages), 11 - self.handler.dropped)
+        assert_in('Log queue full; dropped %d records' % self.handler.dropped, target.messages)
+
+    def test_set_target(self):
+        old, new = ListHandler(), ListHandler()
+        self.use(old)
+        self.logger.info('before')
+        self.handler.set_target(new)
+        self.logger.info('after')
+        self.handler.flush()
+        assert_equal(old.messages, ['before'])
+        assert_equal(old.closed, True)
+        assert_equal(new.messages, ['after'])
+
+    def test_set_target_times_out(self):
+        gate = threading.Event()
+        old, new = ListHandler(gate), ListHandler()
+        self.use(old, maxsize=1)
+        try:
+            # One record stuck in the target, one filling the queue
+            self.logger.info('stuck')
+            while self.handler.queue.qsize():
+                pass
+            self.logger.info('queued')
+            assert_equal(self.handler.set_target(new, timeout=0.01), False)
+        finally:
+            gate.set()
+        self.handler.flush()
+        assert_equal(old.messages, ['stuck', 'queued'])
+        assert_equal(old.closed, False)
+        assert_equal(new.closed, True)
+
+    def test_close_drains_queue(self):
+        target = ListHandler()
+        self.use(target)
+        self.logger.info('last words')
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.handler = None
+        assert_equal(target.messages, ['last words'])
+        assert_equal(target.closed, True)
+
+
+if __name__ == "__main__":
+    run()
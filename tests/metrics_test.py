@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+
+from testify import TestCase, assert_equal, assert_in, run
+
+from fakemtpd.metrics import Counter, Gauge, Histogram, LabeledCounter, Metrics
+
+
+class HistogramTestCase(TestCase):
+
+    def test_buckets_are_cumulative(self):
+        h = Histogram('h', 'help', (1, 5))
+        for value in (0.5, 1, 3, 10):
+            h.observe(value)
+        assert_equal(list(h.samples()), [
+            ('h_bucket', '{le="1"}', 2),
+            ('h_bucket', '{le="5"}', 3),
+            ('h_bucket', '{le="+Inf"}', 4),
+            ('h_sum', '', 14.5),
+            ('h_count', '', 4),
+        ])
+
+
+class RenderTestCase(TestCase):
+
+    def test_render(self):
+        m = Metrics()
+        m.connections_accepted.inc()
+        m.commands.inc('HELO')
+        m.commands.inc('HELO')
+        m.commands.inc('MAIL')
+        m.sessions.function = lambda: 7
+        text = m.render()
+        assert_in('# TYPE fakemtpd_connections_accepted_total counter\nfakemtpd_connections_accepted_total 1\n', text)
+        assert_in('fakemtpd_commands_total{verb="HELO"} 2\nfakemtpd_commands_total{verb="MAIL"} 1\n', text)
+        assert_in('# TYPE fakemtpd_sessions gauge\nfakemtpd_sessions 7\n', text)
+
+    def test_collect_finds_everything(self):
+        m = Metrics()
+        for metric in m.collect():
+            assert isinstance(metric, (Counter, LabeledCounter, Gauge, Histogram)), metric
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+
+import time
+
+import tornado.ioloop
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.overload import LagMonitor
+
+
+class LagMonitorTestCase(TestCase):
+
+    @setup
+    def create_monitor(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.monitor = LagMonitor(self.io_loop, threshold=0.1, interval=0.01)
+        self.monitor.start()
+
+    @teardown
+    def close_loop(self):
+        self.monitor.stop()
+        self.io_loop.close()
+
+    def run_for(self, seconds):
+        self.io_loop.add_timeout(time.time() + seconds, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_overload(self):
+        self.run_for(0.05)
+        assert_equal(self.monitor.overloaded, False)
+        # Hog the loop
+        self.io_loop.add_callback(time.sleep, 0.2)
+        self.run_for(0.05)
+        assert_equal(self.monitor.overloaded, True)
+        assert self.monitor.lag > 0.1, self.monitor.lag
+        self.run_for(0.05)
+        assert_equal(self.monitor.overloaded, False)
+
+
+if __name__ == "__main__":
+    run()
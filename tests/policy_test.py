@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+
+import tornado.ioloop
+
+from testify import TestCase, assert_equal, assert_lt, assert_raises, run, setup, teardown
+
+import fakemtpd.config
+import fakemtpd.policy
+from fakemtpd.policy import Policy, PolicyError, PolicyTable, Rule
+
+
+class PolicyTableTestCase(TestCase):
+
+    def test_lookup(self):
+        table = PolicyTable([
+            '# comment',
+            '',
+            'example.com reject',
+            'sub.example.com accept',
+            'vip@sub.example.com tempfail Come back later',
+            'Boss@Example.com accept',
+            'org tempfail',
+        ])
+        assert_equal(len(table), 5)
+        assert_equal(table.lookup('a@example.com'), Rule('reject', None))
+        assert_equal(table.lookup('a@deep.down.example.com'), Rule('reject', None))
+        assert_equal(table.lookup('a@sub.example.com'), Rule('accept', None))
+        assert_equal(table.lookup('a@x.SUB.example.com'), Rule('accept', None))
+        assert_equal(table.lookup('VIP@sub.example.com'), Rule('tempfail', 'Come back later'))
+        assert_equal(table.lookup('boss@example.com'), Rule('accept', None))
+        assert_equal(table.lookup('a@example.org'), Rule('tempfail', None))
+        # Only whole labels match
+        assert_equal(table.lookup('a@badexample.com'), None)
+        assert_equal(table.lookup('a@com'), None)
+        assert_equal(table.lookup('a@example.net'), None)
+
+    def test_later_lines_win(self):
+        table = PolicyTable(['a@example.com reject', 'example.com reject', 'a@example.com accept', 'example.com tempfail'])
+        assert_equal(table.lookup('a@example.com'), Rule('accept', None))
+        assert_equal(table.lookup('b@example.com'), Rule('tempfail', None))
+        assert_equal(len(table), 2)
+
+    def test_hash_collisions(self):
+        # Everything hashes the same: only the keys tell entries apart
+        fakemtpd.policy.hash = lambda key: 0
+        try:
+            table = PolicyTable(['a@example.com reject', 'b@example.com tempfail', 'example.com accept', 'sub.example.org reject'])
+            assert_equal(table.lookup('a@example.com'), Rule('reject', None))
+            assert_equal(table.lookup('b@example.com'), Rule('tempfail', None))
+            assert_equal(table.lookup('c@example.com'), Rule('accept', None))
+            assert_equal(table.lookup('c@sub.example.org'), Rule('reject', None))
+            assert_equal(table.lookup('c@example.org'), None)
+            assert_equal(table.lookup('c@sub.example.com'), Rule('accept', None))
+            assert_equal(table.lookup('c@example.net'), None)
+        finally:
+            del fakemtpd.policy.hash
+
+    def test_bad_lines(self):
+        assert_raises(PolicyError, PolicyTable, ['example.com'])
+        assert_raises(PolicyError, PolicyTable, ['example.com bounce'])
+
+    def test_reply(self):
+        assert_equal(Rule('accept', None).reply('a@example.com', 'Recipient'), None)
+        assert_equal(Rule('reject', None).reply('a@example.com', 'Sender'), '554 5.7.1 <a@example.com>: Sender address rejected')
+        assert_equal(Rule('tempfail', 'Greylisted').reply('a@example.com', 'Recipient'), '450 4.7.1 <a@example.com>: Greylisted')
+
+
+class PolicyTestCase(TestCase):
+
+    @setup
+    def create_files(self):
+        self.directory = tempfile.mkdtemp()
+        self.recipients = os.path.join(self.directory, 'recipients')
+        self.write(self.recipients, 'example.com reject\n')
+        self.config = fakemtpd.config.Config.instance()
+        self.config.read_file_obj('recipient_policy: %s\nsender_policy: null' % self.recipients)
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.policy = Policy()
+
+    @teardown
+    def remove_files(self):
+        self.config.read_file_obj('recipient_policy: null')
+        self.io_loop.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def reload(self):
+        self.policy.reload(self.io_loop)
+        deadline = time.time() + 5
+        while self.policy._reloading and time.time() < deadline:
+            self.io_loop.add_timeout(time.time() + 0.01, self.io_loop.stop)
+            self.io_loop.start()
+
+    def test_load_and_reload(self):
+        assert_equal(self.policy.load(), None)
+        assert_equal(self.policy.recipient('a@example.com'), Rule('reject', None))
+        assert_equal(self.policy.sender('a@example.com'), None)
+        self.write(self.recipients, 'example.com accept\n')
+        self.reload()
+        assert_equal(self.policy.recipient('a@example.com'), Rule('accept', None))
+        # A bad file leaves the old tables in place
+        self.write(self.recipients, 'example.com\n')
+        self.reload()
+        assert_equal(self.policy.recipient('a@example.com'), Rule('accept', None))
+        os.unlink(self.recipients)
+        assert self.policy.load().startswith('Could not read policy')
+
+    def test_reload_keeps_the_loop_running(self):
+        self.write(self.recipients, ''.join('user%d@example.com reject\nhost%d.example.net accept\n' % (i, i) for i in xrange(100000)))
+        ticks = []
+        ticker = tornado.ioloop.PeriodicCallback(lambda: ticks.append(time.time()), 5, self.io_loop)
+        ticker.start()
+        self.reload()
+        ticker.stop()
+        assert_equal(self.policy.recipient('user99999@example.com'), Rule('reject', None))
+        assert_equal(self.policy.recipient('a@host5.example.net'), Rule('accept', None))
+        # Compiling never held the GIL for long enough to stall the loop
+        assert_lt(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.metrics import Metrics
+from fakemtpd.profiler import SamplingProfiler, install_timing_hooks, remove_timing_hooks
+from fakemtpd.smtpsession import SMTPSession
+
+
+def spin(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class SamplingProfilerTestCase(TestCase):
+
+    @setup
+    def create_directory(self):
+        self.directory = tempfile.mkdtemp()
+
+    @teardown
+    def remove_directory(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        spin(0.2)
+        profiler.stop()
+        assert_equal(profiler.running, False)
+        assert profiler.samples > 10, profiler.samples
+        path = os.path.join(self.directory, 'profile.folded')
+        profiler.write(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        stack, count = lines[0].rsplit(' ', 1)
+        assert stack.endswith(';spin (profiler_test.py:%d)' % spin.func_code.co_firstlineno), stack
+        assert_equal(sum(int(line.rsplit(' ', 1)[1]) for line in lines), profiler.samples)
+
+
+class TimingHooksTestCase(TestCase):
+
+    @teardown
+    def remove_hooks(self):
+        remove_timing_hooks()
+
+    def test_hooks(self):
+        original = SMTPSession.__dict__['_handle_data']
+        install_timing_hooks()
+        assert SMTPSession.__dict__['_handle_data'] is not original
+        assert_equal(Metrics.instance().hook_handle_data.count, 0)
+        remove_timing_hooks()
+        assert SMTPSession.__dict__['_handle_data'] is original
+        assert not hasattr(Metrics.instance(), 'hook_handle_data')
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+
+import json
+import time
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd import query
+from fakemtpd.query import EnvelopeIndex, Query
+
+
+def envelope(sender, recipients, peer='127.0.0.1', at=None):
+    return {
+        'time': time.time() if at is None else at,
+        'peer': peer,
+        'sender': sender,
+        'recipients': recipients,
+        'status': 'accepted',
+    }
+
+
+class EnvelopeIndexTestCase(TestCase):
+
+    @setup
+    def create_index(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.index = EnvelopeIndex(self.io_loop, max_messages=0, max_age=0)
+
+    @teardown
+    def close_loop(self):
+        self.io_loop.close()
+
+    def ids(self, entries):
+        return [entry['id'] for entry in entries]
+
+    def test_find(self):
+        first = self.index.add(envelope('a@example.com', ['b@example.net'], at=100))
+        second = self.index.add(envelope('A@example.com', ['c@example.net'], peer='10.0.0.1', at=200))
+        third = self.index.add(envelope('d@example.com', ['B@example.net', 'c@example.net'], at=300))
+        assert_equal(self.ids(self.index.find(Query())), [first, second, third])
+        assert_equal(self.ids(self.index.find(Query(sender='a@EXAMPLE.com'))), [first, second])
+        assert_equal(self.ids(self.index.find(Query(recipient='b@example.net'))), [first, third])
+        assert_equal(self.ids(self.index.find(Query(peer='10.0.0.1'))), [second])
+        assert_equal(self.ids(self.index.find(Query(since=200))), [second, third])
+        assert_equal(self.ids(self.index.find(Query(since=100, until=300))), [first, second])
+        assert_equal(self.ids(self.index.find(Query(recipient='c@example.net', after=second))), [third])
+        assert_equal(self.ids(self.index.find(Query(after=first), limit=1)), [second])
+        assert_equal(self.index.get(second)['peer'], '10.0.0.1')
+
+    def test_delete(self):
+        ids = [self.index.add(envelope('a@example.com', ['%d@example.net' % i])) for i in range(3)]
+        assert_equal(self.ids(self.index.delete(Query(recipient='1@example.net'))), [ids[1]])
+        assert_equal(self.ids(self.index.find(Query(sender='a@example.com'))), [ids[0], ids[2]])
+        assert_equal(self.index.get(ids[1]), None)
+        assert_equal(len(self.index), 2)
+
+    def test_retention(self):
+        self.index.max_messages = 1000
+        self.index.max_age = 60
+        old = self.index.add(envelope('a@example.com', ['b@example.net'], at=time.time() - 120))
+        assert_equal(self.index.get(old), None)
+        ids = [self.index.add(envelope('a@example.com', ['%d@example.net' % (i % 10)])) for i in range(5000)]
+        assert_equal(len(self.index), 1000)
+        assert_equal(self.ids(self.index.find(Query(), limit=1)), [ids[4000]])
+        assert_equal(self.ids(self.index.find(Query(recipient='3@example.net')))[0], ids[4003])
+        # Addresses which are gone drop out of the indexes
+        assert 'b@example.net' not in self.index._by_recipient
+
+    def test_wait(self):
+        found = []
+        self.index.add(envelope('a@example.com', ['b@example.net']))
+        self.index.wait(Query(recipient='b@example.net'), found.append, 1)
+        assert_equal(self.ids(found), [1])
+        waiter = self.index.wait(Query(recipient='c@example.net'), found.append, 1)
+        self.index.wait(Query(sender='d@example.com'), found.append, 1)
+        self.index.add(envelope('a@example.com', ['b@example.net']))
+        assert_equal(len(found), 1)
+        self.index.add(envelope('a@example.com', ['C@example.net']))
+        assert_equal(self.ids(found), [1, 3])
+        # Each waiter is only called once
+        self.index.add(envelope('a@example.com', ['c@example.net']))
+        assert_equal(len(found), 2)
+        self.index.cancel(waiter)
+        self.io_loop.add_timeout(time.time() + 1.5, self.io_loop.stop)
+        self.io_loop.start()
+        assert_equal(found[2:], [None])
+
+
+class QueryAPITestCase(TestCase):
+
+    @setup
+    def start_server(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        # HTTPServer's coroutines run on the current IOLoop
+        self.io_loop.make_current()
+        self.index = EnvelopeIndex(self.io_loop)
+        application = tornado.web.Application(query.handlers(self.index))
+        self.server = tornado.httpserver.HTTPServer(application, io_loop=self.io_loop)
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server.add_socket(sock)
+        self.client = tornado.httpclient.AsyncHTTPClient(self.io_loop, force_instance=True)
+
+    @teardown
+    def stop_server(self):
+        self.client.close()
+        self.server.stop()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def fetch(self, path, **kwargs):
+        responses = []
+
+        def done(response):
+            responses.append(response)
+            self.io_loop.stop()
+        self.client.fetch('http://127.0.0.1:%d%s' % (self.port, path), done, **kwargs)
+        self.io_loop.add_timeout(time.time() + 5, self.io_loop.stop)
+        self.io_loop.start()
+        return responses[0]
+
+    def test_messages(self):
+        self.index.add(envelope('a@example.com', ['b@example.net']))
+        self.index.add(envelope('c@example.com', ['d@example.net']))
+        response = json.loads(self.fetch('/messages?recipient=d@example.net').body)
+        assert_equal([m['sender'] for m in response['messages']], ['c@example.com'])
+        assert_equal(response['last_id'], 2)
+        assert_equal(json.loads(self.fetch('/messages/1').body)['sender'], 'a@example.com')
+        assert_equal(self.fetch('/messages/3').code, 404)
+        assert_equal(self.fetch('/messages?since=soon').code, 400)
+        assert_equal(json.loads(self.fetch('/messages?sender=a@example.com', method='DELETE').body), {'deleted': 1})
+        assert_equal(len(self.index), 1)
+        # Forgetting everything has to be asked for
+        assert_equal(self.fetch('/messages', method='DELETE').code, 400)
+        assert_equal(len(self.index), 1)
+        assert_equal(json.loads(self.fetch('/messages?all=1', method='DELETE').body), {'deleted': 1})
+        assert_equal(len(self.index), 0)
+
+    def test_wait(self):
+        self.io_loop.add_timeout(time.time() + 0.1, lambda: self.index.add(envelope('a@example.com', ['b@example.net'])))
+        response = self.fetch('/wait?recipient=b@example.net&timeout=2')
+        assert_equal(response.code, 200)
+        assert_equal(json.loads(response.body)['id'], 1)
+        assert_equal(self.fetch('/wait?recipient=c@example.net&timeout=0.1').code, 204)
+        started = time.time()
+        assert_equal(self.fetch('/wait?recipient=c@example.net&timeout=0').code, 204)
+        assert time.time() - started < 1
+        assert_equal(self.fetch('/wait?recipient=b@example.net&timeout=0').code, 200)
+
+
+if __name__ == "__main__":
+    run()
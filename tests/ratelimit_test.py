@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+import socket
+
+from testify import TestCase, assert_equal, run
+
+from fakemtpd.ratelimit import GenerationalDict, RateLimiter, RateTable, address_keys
+
+
+class AddressKeysTestCase(TestCase):
+
+    def test_ipv4(self):
+        assert_equal(address_keys('192.0.2.7'), (socket.inet_aton('192.0.2.7'), socket.inet_aton('192.0.2.0')[:3]))
+        assert_equal(address_keys('::ffff:192.0.2.7'), address_keys('192.0.2.7'))
+
+    def test_ipv6(self):
+        host, network = address_keys('2001:db8:1:2:3:4:5:6')
+        assert_equal(len(host), 16)
+        assert_equal(network, address_keys('2001:db8:1:2::1')[1])
+        assert network != address_keys('2001:db8:1:3::1')[1]
+
+    def test_other(self):
+        assert_equal(address_keys('/tmp/socket'), ('/tmp/socket', '/tmp/socket'))
+
+
+class GenerationalDictTestCase(TestCase):
+
+    def test_bounded(self):
+        d = GenerationalDict(100)
+        for i in range(1000):
+            d[i] = i
+            # Keep one key busy
+            assert_equal(d.get(0), 0)
+        assert len(d) <= 100
+        assert_equal(d.get(999), 999)
+        assert_equal(d.get(1), None)
+        assert_equal(d.get(1, 'gone'), 'gone')
+
+
+class RateTableTestCase(TestCase):
+
+    def test_burst_and_refill(self):
+        table = RateTable(rate=2, burst=2, max_entries=10)
+        now = 1000.0
+        # Two seconds at two a second: four tokens
+        for _ in range(4):
+            table.take('a', table.check('a', now))
+        assert_equal(table.check('a', now), None)
+        assert table.check('b', now) is not None
+        # Half a second later, there's one more
+        table.take('a', table.check('a', now + 0.5))
+        assert_equal(table.check('a', now + 0.5), None)
+
+
+class RateLimiterTestCase(TestCase):
+
+    def test_sessions(self):
+        limiter = RateLimiter(ip_max_sessions=2, net_max_sessions=3)
+        assert_equal(limiter.connect('192.0.2.1'), None)
+        assert_equal(limiter.connect('192.0.2.1'), None)
+        assert_equal(limiter.connect('192.0.2.1'), 'ip_sessions')
+        assert_equal(limiter.connect('192.0.2.2'), None)
+        assert_equal(limiter.connect('192.0.2.3'), 'net_sessions')
+        assert_equal(limiter.connect('198.51.100.1'), None)
+        limiter.disconnect('192.0.2.1')
+        assert_equal(limiter.connect('192.0.2.3'), None)
+        for address in ('192.0.2.1', '192.0.2.2', '192.0.2.3', '198.51.100.1'):
+            limiter.disconnect(address)
+        assert_equal(limiter.sessions, ({}, {}))
+
+    def test_rates(self):
+        limiter = RateLimiter(ip_connection_rate=1, net_connection_rate=2, ip_command_rate=1, burst=1)
+        assert_equal(limiter.connect('192.0.2.1'), None)
+        assert_equal(limiter.connect('192.0.2.1'), 'ip_connections')
+        assert_equal(limiter.connect('192.0.2.2'), None)
+        assert_equal(limiter.connect('192.0.2.3'), 'net_connections')
+        # A connection which is refused doesn't use up the host's token
+        assert_equal(limiter.connect('192.0.2.3'), 'net_connections')
+        assert_equal(len(limiter.connection_rates[0]), 2)
+        assert_equal(limiter.command('192.0.2.1'), None)
+        assert_equal(limiter.command('192.0.2.1'), 'ip_commands')
+
+
+if __name__ == "__main__":
+    run()
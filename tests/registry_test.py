@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+
+from testify import TestCase, assert_equal, run, setup
+
+from fakemtpd.registry import SessionRegistry
+from fakemtpd.signals import Signalable
+
+
+class FakeSession(Signalable):
+    _signals = ("state_changed",)
+
+    def __init__(self, session_id, peer, state=1):
+        super(FakeSession, self).__init__()
+        self.id = session_id
+        self.peer = peer
+        self.state = state
+
+    def set_state(self, state):
+        old_state, self.state = self.state, state
+        self._signal_state_changed(self, old_state, state)
+
+
+class SessionRegistryTestCase(TestCase):
+
+    @setup
+    def create_registry(self):
+        self.registry = SessionRegistry()
+
+    def test_add_remove(self):
+        s = FakeSession(1, '10.0.0.1')
+        self.registry.add(s)
+        assert_equal(len(self.registry), 1)
+        assert s in self.registry
+        assert_equal(self.registry.get(1), s)
+        self.registry.remove(s)
+        assert_equal(len(self.registry), 0)
+        assert_equal(self.registry.count_for_peer('10.0.0.1'), 0)
+        assert_equal(self.registry.peer_count, 0)
+        # removing twice is harmless
+        self.registry.remove(s)
+
+    def test_peer_index(self):
+        sessions = [FakeSession(1, '10.0.0.1'), FakeSession(2, '10.0.0.1'), FakeSession(3, '10.0.0.2')]
+        for s in sessions:
+            self.registry.add(s)
+        assert_equal(self.registry.count_for_peer('10.0.0.1'), 2)
+        assert_equal(self.registry.count_for_peer('10.0.0.2'), 1)
+        assert_equal(self.registry.count_for_peer('10.0.0.3'), 0)
+        assert_equal(sorted(s.id for s in self.registry.for_peer('10.0.0.1')), [1, 2])
+        assert_equal(self.registry.peer_count, 2)
+
+    def test_state_index(self):
+        s1 = FakeSession(1, '10.0.0.1')
+        s2 = FakeSession(2, '10.0.0.2')
+        self.registry.add(s1)
+        self.registry.add(s2)
+        assert_equal(self.registry.count_in_state(1), 2)
+        s1.set_state(2)
+        assert_equal(self.registry.counts_by_state(), {1: 1, 2: 1})
+        self.registry.remove(s1)
+        assert_equal(self.registry.counts_by_state(), {1: 1})
+
+    def test_state_change_after_removal(self):
+        s = FakeSession(1, '10.0.0.1')
+        self.registry.add(s)
+        self.registry.remove(s)
+        s.set_state(2)
+        assert_equal(self.registry.counts_by_state(), {})
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,478 @@
+from __future__ import absolute_import
+
+import os
+
+from testify import TestCase, assert_equal, run, setup
+
+import fakemtpd.config
+from fakemtpd.greylist import Greylist
+from fakemtpd.policy import Policy, PolicyTable
+from fakemtpd.ratelimit import RateLimiter, address_keys
+from fakemtpd.signals import Signalable
+from fakemtpd.smtpsession import SMTPSession, SMTP_BDAT, SMTP_CONNECTED, SMTP_HELO, SMTP_MAIL_FROM
+from fakemtpd.tls import ServerContext
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class FakeConnection(Signalable):
+    """Just enough of a Connection to drive an SMTPSession by hand"""
+    _signals = ["connected", "closed", "timeout", "data"]
+
+    def __init__(self):
+        super(FakeConnection, self).__init__()
+        self.address = ('127.0.0.1', 12345)
+        self.written = []
+        self.closed = False
+        self.reading = True
+        self.tls_options = None
+        self.bytes_wanted = None
+
+    def write(self, data, callback=None, st=True):
+        self.written.append(data)
+        if callback:
+            callback()
+
+    def close(self):
+        self.closed = True
+        self._signal_closed()
+
+    def starttls(self, **ssl_options):
+        self.tls_options = ssl_options
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def read_bytes(self, num_bytes, chunk_callback, callback):
+        self.bytes_wanted = (num_bytes, chunk_callback, callback)
+
+
+class FakeIOLoop(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+
+class FakeSpoolFile(object):
+    def __init__(self, name):
+        self.name = name
+        self.data = []
+        self.committed = False
+        self.aborted = False
+
+    def write(self, data):
+        self.data.append(data)
+        return True
+
+    def commit(self, callback):
+        self.committed = True
+        callback(None)
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeSpool(object):
+    def __init__(self):
+        self.files = []
+
+    def open(self):
+        self.files.append(FakeSpoolFile('Q%d' % (len(self.files) + 1)))
+        return self.files[-1]
+
+
+class FakeCapture(object):
+    def __init__(self, segment_size=1024):
+        self.records = []
+        self.segment_size = segment_size
+
+    def append(self, sender, recipients, body=None, session=0):
+        self.records.append((sender, list(recipients), ''.join(str(chunk) for chunk in body) if body is not None else None))
+        return len(self.records)
+
+
+class SMTPSessionTestCase(TestCase):
+
+    @setup
+    def create_session(self):
+        self.config = fakemtpd.config.Config.instance()
+        self.config.read_file_obj('hostname: mock_hostname\nsmtp_ver: SMTP\ntls_cert: null\ntls_key: null\n'
+                                  'accept_mail: false\nmax_message_size: 100')
+        self.conn = FakeConnection()
+        self.session = SMTPSession(self.conn)
+        self.conn._signal_connected()
+        self.conn.written = []
+
+    def use_tls(self):
+        self.config.read_file_obj('tls_cert: %s\ntls_key: %s' % (
+            os.path.join(DATA, 'mock_cert.pem'), os.path.join(DATA, 'mock_key.pem')))
+        ServerContext.instance().reload()
+
+    def send(self, line):
+        self.conn.written = []
+        self.conn._signal_data(line + '\r\n')
+        return ''.join(self.conn.written)
+
+    def bdat(self, payload, last=False):
+        self.conn.written = []
+        self.conn._signal_data('BDAT %d%s\r\n' % (len(payload), ' LAST' if last else ''))
+        num_bytes, chunk_callback, callback = self.conn.bytes_wanted
+        assert_equal(num_bytes, len(payload))
+        if payload:
+            chunk_callback(bytearray(payload))
+        callback()
+        return ''.join(self.conn.written)
+
+    def test_banner(self):
+        conn = FakeConnection()
+        SMTPSession(conn)
+        conn._signal_connected()
+        assert_equal(conn.written, ['220 mock_hostname SMTP FakeMTPD\r\n'])
+
+    def test_config_reload(self):
+        config = fakemtpd.config.Config()
+        config.read_file_obj('hostname: reloaded\nsmtp_ver: SMTP')
+        fakemtpd.config.Config._instance = config
+        try:
+            conn = FakeConnection()
+            SMTPSession(conn)
+            conn._signal_connected()
+            assert_equal(conn.written, ['220 reloaded SMTP FakeMTPD\r\n'])
+            # Sessions from before the reload keep the old snapshot
+            assert_equal(self.send('HELO example.com'), '250 mock_hostname\r\n')
+        finally:
+            fakemtpd.config.Config._instance = self.config
+
+    def test_helo(self):
+        assert_equal(self.send('HELO example.com'), '250 mock_hostname\r\n')
+        assert_equal(self.session.remote, 'example.com')
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_ehlo(self):
+        assert_equal(self.send('EHLO example.com'), '250-mock_hostname\r\n250 PIPELINING\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_help_is_one_write(self):
+        self.send('HELP')
+        assert_equal(len(self.conn.written), 1)
+        assert_equal(self.conn.written[0].count('\r\n'), 14)
+
+    def test_verbs_are_case_insensitive(self):
+        assert_equal(self.send('helo example.com'), '250 mock_hostname\r\n')
+        assert_equal(self.send('NoOp'), '250 2.0.0 Ok\r\n')
+
+    def test_helo_requires_argument(self):
+        assert_equal(self.send('HELO'), '503 Commands out of sync or unrecognized\r\n')
+        assert_equal(self.session._state, SMTP_CONNECTED)
+
+    def test_mail_without_helo(self):
+        assert_equal(self.send('MAIL FROM:<a@example.com>'), '250 2.1.0 Ok\r\n')
+        assert_equal(self.session._state, SMTP_MAIL_FROM)
+
+    def test_relay_denied(self):
+        self.send('HELO example.com')
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '554 5.7.1 <a@example.com>: Relay access denied\r\n')
+        assert_equal(self.session._message_state['rcpt_to'], ['b@example.net'])
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_nested_mail(self):
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('MAIL FROM:<a@example.com>'), '503 5.5.1 Error: nested MAIL command\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_rcpt_out_of_order(self):
+        self.send('HELO example.com')
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '503 Commands out of sync or unrecognized\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_no_helo_twice(self):
+        self.send('HELO example.com')
+        assert_equal(self.send('EHLO example.com'), '503 Commands out of sync or unrecognized\r\n')
+
+    def test_rset(self):
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('RSET'), '250 2.0.0 Ok\r\n')
+        assert_equal(self.session._message_state, {})
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_disabled_commands(self):
+        assert_equal(self.send('VRFY <a@example.com>'), '502 5.5.1 VRFY command is disabled\r\n')
+        assert_equal(self.send('EXPN list'), '502 5.5.1 EXPN command is disabled\r\n')
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('DATA'), '502 5.5.1 DATA command is disabled\r\n')
+
+    def test_starttls_without_cert(self):
+        self.send('EHLO example.com')
+        assert_equal(self.send('STARTTLS'), '502 5.5.1 STARTTLS not supported in RFC821 mode (meant to say EHLO?)\r\n')
+
+    def test_starttls(self):
+        self.use_tls()
+        self.send('EHLO example.com')
+        assert_equal(self.send('STARTTLS'), '220 Go Ahead\r\n')
+        assert_equal(self.conn.tls_options, ServerContext.instance().starttls_options())
+        assert_equal(self.session._state, SMTP_CONNECTED)
+        assert_equal(self.send('EHLO example.com'), '250-mock_hostname\r\n250 PIPELINING\r\n')
+        assert_equal(self.send('STARTTLS'), '554 5.5.1 Error: TLS already active\r\n')
+
+    def test_plain_listener_has_no_starttls(self):
+        self.use_tls()
+        conn = FakeConnection()
+        SMTPSession(conn, tls_mode='plain')
+        conn._signal_connected()
+        conn.written = []
+        conn._signal_data('EHLO example.com\r\n')
+        assert_equal(conn.written, ['250-mock_hostname\r\n250 PIPELINING\r\n'])
+
+    def test_implicit_tls(self):
+        self.use_tls()
+        conn = FakeConnection()
+        SMTPSession(conn, tls_mode='tls')
+        conn._signal_connected()
+        assert_equal(conn.tls_options, ServerContext.instance().starttls_options())
+        assert_equal(conn.written, ['220 mock_hostname ESMTP FakeMTPD\r\n'])
+        conn.written = []
+        conn._signal_data('EHLO example.com\r\n')
+        assert_equal(conn.written, ['250-mock_hostname\r\n250 PIPELINING\r\n'])
+
+    def test_unknown_verb(self):
+        assert_equal(self.send('FROB'), '503 Commands out of sync or unrecognized\r\n')
+        assert_equal(self.send(''), '503 Commands out of sync or unrecognized\r\n')
+
+    def test_summary(self):
+        self.send('EHLO client.example.com')
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.send('MAIL FROM:<d@example.com>')
+        self.send('QUIT')
+        summary = self.session.summary()
+        assert_equal(summary['peer'], '127.0.0.1')
+        assert_equal(summary['helo'], 'client.example.com')
+        assert_equal(summary['esmtp'], True)
+        assert_equal(summary['tls'], False)
+        assert_equal(summary['commands'], 5)
+        assert_equal(summary['responses'], {'220': 1, '250': 3, '554': 1, '221': 1})
+        assert_equal([(t['mail_from'], t.get('rcpt_to')) for t in summary['transactions']],
+                     [('a@example.com', ['b@example.net']), ('d@example.com', None)])
+        assert_equal(summary['end'], 'quit')
+
+    def accept_mail(self):
+        self.config.read_file_obj('accept_mail: true')
+        self.spool = FakeSpool()
+        self.session.spool = self.spool
+        self.send('EHLO example.com')
+
+    def test_accept_mail(self):
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('DATA'), '554 5.5.1 Error: no valid recipients\r\n')
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '250 2.1.5 Ok\r\n')
+        assert_equal(self.send('RCPT TO:<c@example.net>'), '250 2.1.5 Ok\r\n')
+        assert_equal(self.send('DATA'), '354 End data with <CR><LF>.<CR><LF>\r\n')
+        assert_equal(self.send('Subject: hi'), '')
+        assert_equal(self.send(''), '')
+        assert_equal(self.send('..leading dot'), '')
+        assert_equal(self.send('.'), '250 2.0.0 Ok: queued as Q1\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+        spooled = ''.join(self.spool.files[0].data)
+        assert spooled.startswith('Return-Path: <a@example.com>\r\nX-Fakemtpd-Envelope-To: <b@example.net>\r\n'), spooled
+        assert spooled.endswith('\r\nSubject: hi\r\n\r\n.leading dot\r\n'), spooled
+        assert_equal(self.send('NOOP'), '250 2.0.0 Ok\r\n')
+
+    def test_message_size_limit(self):
+        self.accept_mail()
+        assert_equal(self.send('EHLO example.com'), '503 Commands out of sync or unrecognized\r\n')
+        assert_equal(self.send('MAIL FROM:<a@example.com> SIZE=101'), '552 5.3.4 Message size exceeds fixed limit\r\n')
+        self.send('MAIL FROM:<a@example.com> SIZE=100')
+        self.send('RCPT TO:<b@example.net>')
+        self.send('DATA')
+        for _ in range(20):
+            assert_equal(self.send('0123456789'), '')
+        assert_equal(self.send('.'), '552 5.3.4 Message size exceeds fixed limit\r\n')
+        assert_equal(self.spool.files[0].aborted, True)
+
+    def test_ehlo_advertises_size(self):
+        self.config.read_file_obj('accept_mail: true')
+        assert_equal(self.send('EHLO example.com'), '250-mock_hostname\r\n250-PIPELINING\r\n250-SIZE 100\r\n250 CHUNKING\r\n')
+
+    def test_close_during_data_aborts(self):
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.send('DATA')
+        self.conn.close()
+        assert_equal(self.spool.files[0].aborted, True)
+
+    def test_bdat(self):
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        assert_equal(self.bdat('Subject: hi\r\n'), '250 2.0.0 Ok: 13 octets received\r\n')
+        assert_equal(self.session._state, SMTP_BDAT)
+        assert_equal(self.send('DATA'), '503 Commands out of sync or unrecognized\r\n')
+        assert_equal(self.spool.files[0].aborted, True)
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.bdat('Subject: hi\r\n')
+        assert_equal(self.bdat('\r\n.no unstuffing\r\n', last=True), '250 2.0.0 Ok: queued as Q2\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+        assert_equal(self.session._message_state['size'], 31)
+        spooled = ''.join(str(data) for data in self.spool.files[1].data)
+        assert spooled.endswith('\r\nSubject: hi\r\n\r\n.no unstuffing\r\n'), spooled
+
+    def test_refused_bdat_still_reads_chunk(self):
+        assert_equal(self.bdat('x' * 10), '502 5.5.1 BDAT command is disabled\r\n')
+        self.accept_mail()
+        assert_equal(self.bdat('x' * 10), '503 5.5.1 Error: need MAIL command\r\n')
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.bdat('x' * 10, last=True), '554 5.5.1 Error: no valid recipients\r\n')
+        assert_equal(self.session._state, SMTP_HELO)
+        assert_equal(self.spool.files, [])
+
+    def test_bdat_size_limit(self):
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.bdat('x' * 60)
+        assert_equal(self.bdat('x' * 60), '552 5.3.4 Message size exceeds fixed limit\r\n')
+        assert_equal(self.spool.files[0].aborted, True)
+        assert_equal(self.session._state, SMTP_HELO)
+
+    def test_capture(self):
+        capture = self.session.capture = FakeCapture()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        assert_equal(capture.records, [('a@example.com', ['b@example.net'], None)])
+        assert_equal(self.session._message_state['capture_id'], 1)
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.send('DATA')
+        self.send('..hi')
+        self.send('.')
+        self.send('MAIL FROM:<c@example.com>')
+        self.send('RCPT TO:<d@example.net>')
+        self.bdat('hello ')
+        self.bdat('there', last=True)
+        # Nothing is captured for a transaction which doesn't finish
+        self.send('MAIL FROM:<e@example.com>')
+        self.send('RCPT TO:<f@example.net>')
+        self.bdat('hello ')
+        self.send('RSET')
+        assert_equal(capture.records[1:], [
+            ('a@example.com', ['b@example.net'], '.hi\r\n'),
+            ('c@example.com', ['d@example.net'], 'hello there'),
+        ])
+
+    def test_capture_too_big(self):
+        # Under max_message_size, but over what the capture store can take
+        capture = self.session.capture = FakeCapture(segment_size=50)
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.bdat('x' * 30)
+        self.bdat('x' * 30)
+        # Nothing more is held on to once it can't be captured
+        assert_equal(self.session._captured_body, None)
+        assert_equal(self.bdat('x' * 30, last=True), '250 2.0.0 Ok: queued as Q1\r\n')
+        assert_equal(capture.records, [])
+        assert 'capture_id' not in self.session.transactions[-1]
+        # The next message starts over
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.bdat('hi', last=True)
+        assert_equal(capture.records, [('a@example.com', ['b@example.net'], 'hi')])
+
+    def test_transaction_signal(self):
+        transactions = []
+        self.session.on_transaction(lambda session, state: transactions.append(dict(state)))
+        self.send('MAIL FROM:<a@example.com>')
+        self.send('RCPT TO:<b@example.net>')
+        self.accept_mail()
+        self.send('MAIL FROM:<c@example.com>')
+        self.send('RCPT TO:<d@example.net>')
+        self.send('DATA')
+        self.send('hi')
+        self.send('.')
+        assert_equal([(t['mail_from'], t['status']) for t in transactions], [
+            ('a@example.com', 'rejected'),
+            ('c@example.com', 'accepted'),
+        ])
+        assert_equal(transactions[1]['size'], 4)
+
+    def use_policy(self, recipients='', senders=''):
+        self.session.policy = Policy()
+        self.session.policy.tables = (PolicyTable(recipients.splitlines()), PolicyTable(senders.splitlines()))
+
+    def test_policy(self):
+        self.use_policy(
+            recipients='example.net accept\nspam.example.net reject\nslow@example.net tempfail Try later',
+            senders='bad.example.com reject',
+        )
+        transactions = []
+        self.session.on_transaction(lambda session, state: transactions.append(dict(state)))
+        self.send('HELO example.com')
+        assert_equal(self.send('MAIL FROM:<x@bad.example.com>'), '554 5.7.1 <x@bad.example.com>: Sender address rejected\r\n')
+        assert_equal(self.send('MAIL FROM:<a@example.com>'), '250 2.1.0 Ok\r\n')
+        assert_equal(self.send('RCPT TO:<a@spam.example.net>'), '554 5.7.1 <a@spam.example.net>: Recipient address rejected\r\n')
+        assert_equal(self.send('RCPT TO:<slow@example.net>'), '450 4.7.1 <slow@example.net>: Try later\r\n')
+        # Accepted by policy, even without accept_mail
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '250 2.1.5 Ok\r\n')
+        assert_equal(self.send('DATA'), '354 End data with <CR><LF>.<CR><LF>\r\n')
+        self.send('hi')
+        assert_equal(self.send('.'), '250 2.0.0 Ok\r\n')
+        assert_equal(self.session.transactions[-1]['refused'], ['a@spam.example.net', 'slow@example.net'])
+        assert_equal([(t['rcpt_to'], t['status']) for t in transactions], [
+            (['a@spam.example.net'], 'rejected'),
+            (['slow@example.net'], 'rejected'),
+            (['b@example.net'], 'accepted'),
+        ])
+        # Anything else gets the usual treatment
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('RCPT TO:<b@example.org>'), '554 5.7.1 <a@example.com>: Relay access denied\r\n')
+
+    def test_greylist(self):
+        self.session.greylist = Greylist(delay=300, max_entries=64)
+        capture = self.session.capture = FakeCapture()
+        self.accept_mail()
+        self.send('MAIL FROM:<a@example.com>')
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '451 4.7.1 <b@example.net>: Greylisted, try again in 300 seconds\r\n')
+        assert_equal(self.session._message_state['greylisted'], ['b@example.net'])
+        assert_equal(capture.records, [('a@example.com', ['b@example.net'], None)])
+        self.session.greylist.delay = 0
+        assert_equal(self.send('RCPT TO:<b@example.net>'), '250 2.1.5 Ok\r\n')
+
+    def test_rate_limited_commands(self):
+        self.session.rate_limiter = RateLimiter(ip_command_rate=1, burst=2)
+        assert_equal(self.send('NOOP'), '250 2.0.0 Ok\r\n')
+        assert_equal(self.send('NOOP'), '250 2.0.0 Ok\r\n')
+        assert_equal(self.send('NOOP'), '421 4.7.0 mock_hostname Error: too many commands, closing connection\r\n')
+        assert_equal(self.conn.closed, True)
+        assert_equal(self.session.close_reason, 'rate_limited')
+
+    def test_tarpit(self):
+        self.session.rate_limiter = RateLimiter(ip_command_rate=1, burst=1, tarpit=5)
+        self.conn.io_loop = FakeIOLoop()
+        assert_equal(self.send('NOOP'), '250 2.0.0 Ok\r\n')
+        assert_equal(self.send('NOOP'), '')
+        assert_equal(self.conn.reading, False)
+        deadline, callback = self.conn.io_loop.timeouts.pop()
+        # Time passes
+        self.session.rate_limiter.command_rates[0].buckets[address_keys('127.0.0.1')[0]] = 0
+        callback()
+        assert_equal(''.join(self.conn.written), '250 2.0.0 Ok\r\n')
+        assert_equal(self.conn.reading, True)
+
+    def test_quit(self):
+        assert_equal(self.send('QUIT'), '221 2.0.0 Bye\r\n')
+        assert_equal(self.conn.closed, True)
+        assert_equal(self.conn.reading, False)
+
+
+if __name__ == "__main__":
+    run()
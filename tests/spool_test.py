@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+
+import tornado.ioloop
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.spool import Spool, prepare_spool_dir
+
+
+class SpoolTestCase(TestCase):
+
+    @setup
+    def create_spool(self):
+        self.directory = tempfile.mkdtemp()
+        prepare_spool_dir(self.directory)
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.spool = Spool(self.directory, self.io_loop, chunk_size=10, max_pending=2)
+
+    @teardown
+    def remove_spool(self):
+        self.spool.stop()
+        self.io_loop.close()
+        shutil.rmtree(self.directory)
+
+    def commit(self, spool_file):
+        results = []
+
+        def done(error):
+            results.append(error)
+            self.io_loop.stop()
+        spool_file.commit(done)
+        self.io_loop.start()
+        return results[0]
+
+    def test_commit(self):
+        spool_file = self.spool.open()
+        for _ in range(5):
+            spool_file.write('0123456\r\n')
+        assert_equal(self.commit(spool_file), None)
+        assert_equal(os.listdir(os.path.join(self.directory, 'tmp')), [])
+        with open(os.path.join(self.directory, 'new', spool_file.name)) as f:
+            assert_equal(f.read(), '0123456\r\n' * 5)
+
+    def test_backpressure(self):
+        spool_file = self.spool.open()
+        results = [spool_file.write('x' * 10) for _ in range(4)]
+        # Nothing has been acknowledged by the IOLoop yet
+        assert_equal(results, [True, True, False, False])
+        drained = []
+        spool_file.wait_for_drain(lambda: drained.append(True))
+        self.commit(spool_file)
+        assert_equal(drained, [True])
+        assert_equal(spool_file.pending, 0)
+
+    def test_abort(self):
+        spool_file = self.spool.open()
+        spool_file.write('x' * 25)
+        spool_file.abort()
+        self.spool.stop()
+        self.spool = Spool(self.directory, self.io_loop)
+        assert_equal(os.listdir(os.path.join(self.directory, 'tmp')), [])
+        assert_equal(os.listdir(os.path.join(self.directory, 'new')), [])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from testify import TestCase, assert_equal, assert_gte, run, setup, teardown
+
+from fakemtpd.supervisor import Supervisor
+
+
+class SupervisorTestCase(TestCase):
+    """The workers here report back by appending lines to a file, and poke
+    the test process (which is the supervisor) with signals"""
+
+    @setup
+    def create_log(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'workers.log')
+        open(self.path, 'w').close()
+        self.handlers = dict((signum, signal.getsignal(signum)) for signum in (signal.SIGUSR1, signal.SIGUSR2))
+
+    @teardown
+    def remove_log(self):
+        for signum, handler in self.handlers.iteritems():
+            signal.signal(signum, handler)
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, *words):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, ' '.join(str(word) for word in words) + '\n')
+        finally:
+            os.close(fd)
+
+    def lines(self, first=None):
+        lines = [line.split() for line in open(self.path)]
+        if first is not None:
+            lines = [line for line in lines if line[0] == first]
+        return lines
+
+    def wait_for_term(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        while True:
+            signal.pause()
+
+    def test_spawn_workers(self):
+        supervisor = Supervisor(3, None)
+
+        def worker_main(index):
+            self.record('started', index, os.getpid())
+            if len(self.lines()) == 3:
+                os.kill(os.getppid(), signal.SIGUSR1)
+            self.wait_for_term()
+        supervisor.worker_main = worker_main
+        signal.signal(signal.SIGUSR1, lambda signum, frame: supervisor.stop())
+        supervisor.run()
+        lines = self.lines()
+        assert_equal(sorted(int(line[1]) for line in lines), [0, 1, 2])
+        assert_equal(len(set(line[2] for line in lines)), 3)
+        assert_equal(supervisor.workers, {})
+
+    def test_restart(self):
+        supervisor = Supervisor(1, None)
+        supervisor.respawn_delay = 0.5
+
+        def worker_main(index):
+            self.record('started', index, repr(time.time()))
+            if len(self.lines()) == 1:
+                # Exit right away, to be restarted
+                return
+            os.kill(os.getppid(), signal.SIGUSR1)
+            self.wait_for_term()
+        supervisor.worker_main = worker_main
+        signal.signal(signal.SIGUSR1, lambda signum, frame: supervisor.stop())
+        supervisor.run()
+        lines = self.lines()
+        assert_equal([line[1] for line in lines], ['0', '0'])
+        # The delay runs from just before the first fork
+        assert_gte(float(lines[1][2]) - float(lines[0][2]), 0.4)
+
+    def test_signal_workers(self):
+        supervisor = Supervisor(2, None)
+
+        def worker_main(index):
+            hups = []
+
+            def hup(signum, frame):
+                hups.append(signum)
+                self.record('hup', index)
+            signal.signal(signal.SIGHUP, hup)
+            # Keep asking until the supervisor knows about every worker
+            while not hups:
+                os.kill(os.getppid(), signal.SIGUSR1)
+                time.sleep(0.05)
+            if len(set(line[1] for line in self.lines('hup'))) == 2:
+                os.kill(os.getppid(), signal.SIGUSR2)
+            self.wait_for_term()
+
+        def forward(signum, frame):
+            if len(supervisor.workers) == 2:
+                supervisor.signal_workers(signal.SIGHUP)
+        supervisor.worker_main = worker_main
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: supervisor.stop())
+        supervisor.run()
+        assert_equal(set(line[1] for line in self.lines('hup')), set(['0', '1']))
+        assert_equal(supervisor.workers, {})
+
+    def test_callback_from_signal(self):
+        supervisor = Supervisor(1, None)
+
+        def worker_main(index):
+            os.kill(os.getppid(), signal.SIGUSR1)
+            self.wait_for_term()
+
+        def callback():
+            self.record('callback', os.getpid())
+            supervisor.stop()
+        supervisor.worker_main = worker_main
+        signal.signal(signal.SIGUSR1, lambda signum, frame: supervisor.add_callback_from_signal(callback))
+        supervisor.run()
+        assert_equal(self.lines('callback'), [['callback', str(os.getpid())]])
+        assert_equal(supervisor.workers, {})
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+from testify import TestCase, assert_equal, run, setup
+
+from fakemtpd.timerwheel import TimerWheel
+
+
+class Timer(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.fired = 0
+
+    def timed_out(self):
+        self.fired += 1
+
+
+class TimerWheelTestCase(TestCase):
+
+    @setup
+    def create_wheel(self):
+        self.wheel = TimerWheel(resolution=1, num_slots=8, now=1000)
+
+    def test_fires_after_deadline(self):
+        t = Timer(1003)
+        self.wheel.schedule(t)
+        assert_equal(self.wheel.advance(1002.5), 0)
+        assert_equal(t.fired, 0)
+        assert_equal(self.wheel.advance(1004), 1)
+        assert_equal(t.fired, 1)
+        assert_equal(len(self.wheel), 0)
+
+    def test_pushing_deadline_back(self):
+        t = Timer(1003)
+        self.wheel.schedule(t)
+        t.deadline = 1006
+        self.wheel.advance(1005)
+        assert_equal(t.fired, 0)
+        assert t in self.wheel
+        self.wheel.advance(1007)
+        assert_equal(t.fired, 1)
+
+    def test_deadline_past_one_revolution(self):
+        t = Timer(1020)
+        self.wheel.schedule(t)
+        for now in range(1001, 1020):
+            self.wheel.advance(now)
+        assert_equal(t.fired, 0)
+        self.wheel.advance(1021)
+        assert_equal(t.fired, 1)
+
+    def test_long_stall(self):
+        timers = [Timer(1000 + i) for i in range(1, 8)]
+        for t in timers:
+            self.wheel.schedule(t)
+        assert_equal(self.wheel.advance(5000), 7)
+
+    def test_cancel(self):
+        t = Timer(1002)
+        self.wheel.schedule(t)
+        self.wheel.cancel(t)
+        self.wheel.advance(1010)
+        assert_equal(t.fired, 0)
+        assert_equal(len(self.wheel), 0)
+
+    def test_schedule_twice(self):
+        t = Timer(1002)
+        self.wheel.schedule(t)
+        self.wheel.schedule(t)
+        assert_equal(len(self.wheel), 1)
+        self.wheel.advance(1003)
+        assert_equal(t.fired, 1)
+
+
+if __name__ == "__main__":
+    run()
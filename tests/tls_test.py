@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+
+import os
+
+from testify import TestCase, assert_equal, assert_is, run, setup
+
+import fakemtpd.config
+from fakemtpd.tls import OP_NO_TICKET, ServerContext
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class ServerContextTestCase(TestCase):
+
+    @setup
+    def configure(self):
+        self.config = fakemtpd.config.Config.instance()
+        self.config.read_file_obj('tls_cert: %s\ntls_key: %s\ntls_session_tickets: true' % (
+            os.path.join(DATA, 'mock_cert.pem'), os.path.join(DATA, 'mock_key.pem')))
+        self.tls = ServerContext()
+
+    def test_context_is_shared(self):
+        assert_equal(self.tls.reload(), None)
+        assert_is(self.tls.starttls_options()['ssl_context'], self.tls.context)
+        assert_is(self.tls.starttls_options()['ssl_context'], self.tls.context)
+
+    def test_tickets(self):
+        self.tls.reload()
+        assert_equal(self.tls.context.options & OP_NO_TICKET, 0)
+        self.config.read_file_obj('tls_session_tickets: false')
+        self.tls.reload()
+        assert_equal(self.tls.context.options & OP_NO_TICKET, OP_NO_TICKET)
+
+    def test_bad_reload_keeps_old_context(self):
+        self.tls.reload()
+        context = self.tls.context
+        self.config.read_file_obj('tls_cert: %s' % os.path.join(DATA, 'missing.pem'))
+        assert self.tls.reload() is not None
+        assert_is(self.tls.context, context)
+
+    def test_no_certificate(self):
+        self.config.read_file_obj('tls_cert: null\ntls_key: null')
+        assert_equal(self.tls.reload(), None)
+        assert_equal(self.tls.context, None)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+
+from testify import TestCase, assert_equal, run, setup, teardown
+
+from fakemtpd.txnlog import TransactionLog
+
+
+class TransactionLogTestCase(TestCase):
+
+    @setup
+    def create_log(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'txn.log')
+        self.log = TransactionLog(self.path, flush_bytes=100)
+
+    @teardown
+    def remove_log(self):
+        self.log.close()
+        shutil.rmtree(self.tempdir)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_buffers_until_flush(self):
+        self.log.record({'session': 1})
+        assert_equal(self.read(), [])
+        self.log.flush()
+        assert_equal(self.read(), [{'session': 1}])
+
+    def test_flushes_on_size(self):
+        for i in range(10):
+            self.log.record({'session': i, 'padding': 'x' * 20})
+        assert len(self.read()) >= 3, self.read()
+        self.log.flush()
+        assert_equal([r['session'] for r in self.read()], range(10))
+
+    def test_reopen(self):
+        self.log.record({'session': 1})
+        os.rename(self.path, self.path + '.1')
+        self.log.reopen()
+        self.log.record({'session': 2})
+        self.log.flush()
+        assert_equal(self.read(self.path + '.1'), [{'session': 1}])
+        assert_equal(self.read(), [{'session': 2}])
+
+    def test_binary_addresses(self):
+        self.log.record({'mail_from': 'caf\xe9@example.com'})
+        self.log.flush()
+        assert_equal(self.read(), [{'mail_from': u'caf\xe9@example.com'}])
+
+
+if __name__ == "__main__":
+    run()